@@ -1,11 +1,29 @@
-from fastapi import FastAPI, UploadFile, File, Form
+import asyncio
+import json
+import logging
+import os
+from fastapi import FastAPI, UploadFile, File, Form, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from starlette.formparsers import MultiPartParser
 from pydantic import BaseModel
-from typing import Optional
+from typing import List, Optional
 
-from Agent_request_call import agent_request_process, creative_reaction_request_process
+from Agent_request_call import async_agent_request_process_session, async_creative_reaction_request_process
+import Agent_orchestrator
+from utils.creative_batch import CreativeBatchJob, run_creative_batch_job, list_resumable_jobs, parse_persona_sets
+from utils.sse import stream_events
+from utils.cpu_offload import cpu_offload
+from utils.metrics_query import GROUP_COLUMNS, parse_time, summarize_metrics
+from utils.prometheus_metrics import METRICS_CONTENT_TYPE, REQUEST_PEAK_MEMORY, render_metrics
+from utils.memory_monitor import memory_monitor
+from utils.uploads import (
+    AGENT_UPLOAD_MAX_BYTES, CREATIVE_BATCH_MAX_BYTES, CREATIVE_IMAGE_MAX_BYTES, UPLOAD_SPOOL_BYTES,
+    UploadTooLarge, check_upload_size, read_binary_upload, read_text_upload,
+)
 
 app = FastAPI(title="Agent API")
+logger = logging.getLogger(__name__)
 
 app.add_middleware(
     CORSMiddleware,
@@ -18,26 +36,164 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    # Readable by the UI scripts (the streaming endpoint returns the session in this header)
+    expose_headers=["X-Session-Id"],
 )
 
+# Uploaded files stay in memory up to UPLOAD_SPOOL_BYTES, larger ones are spooled to a temporary file
+MultiPartParser.spool_max_size = UPLOAD_SPOOL_BYTES
+
+# Body size limit of the upload endpoints, checked from Content-Length before the body is parsed
+UPLOAD_ENDPOINTS = {
+    "/agent/process": AGENT_UPLOAD_MAX_BYTES,
+    "/agent/process/stream": AGENT_UPLOAD_MAX_BYTES,
+    "/creative/react": CREATIVE_IMAGE_MAX_BYTES,
+    "/creative/react/stream": CREATIVE_IMAGE_MAX_BYTES,
+    "/creative/batch": CREATIVE_BATCH_MAX_BYTES,
+}
+# Room for the form fields sent with the file
+UPLOAD_FORM_OVERHEAD = 1024 * 1024
+
+
+@app.middleware("http")
+async def bound_uploads(request, call_next):
+    """Rejects upload requests over the limit of the endpoint with 413 before reading the body, and reports
+    the peak memory of the worker during the request (until the last byte of the response is sent)."""
+    limit = UPLOAD_ENDPOINTS.get(request.url.path)
+    if limit is None:
+        return await call_next(request)
+    content_length = request.headers.get("content-length", "")
+    if content_length.isdigit() and int(content_length) > limit + UPLOAD_FORM_OVERHEAD:
+        return JSONResponse({"detail": f"Request body exceeds the upload limit of {limit} bytes"}, status_code=413)
+
+    watch = memory_monitor.start()
+    try:
+        response = await call_next(request)
+    except BaseException:
+        memory_monitor.stop(watch)
+        raise
+
+    body = response.body_iterator
+
+    async def tracked_body():
+        try:
+            async for chunk in body:
+                yield chunk
+        finally:
+            memory_monitor.stop(watch)
+            REQUEST_PEAK_MEMORY.labels(request.url.path).observe(watch.peak_growth)
+            logger.info(f"Upload request {request.url.path} ({content_length or '?'} bytes) memory: {watch.as_dict()}")
+
+    response.body_iterator = tracked_body()
+    return response
+
+
 class AgentResponse(BaseModel):
     answer: str
+    session_id: Optional[str] = None
+
+
+class BatchJobStatus(BaseModel):
+    job_id: str
+    status: str
+    total: int
+    completed: int
+    failed: int
+    results_file: Optional[str] = None
+
+# Creative batch jobs running in this worker
+batch_tasks = {}
+
+
+def start_batch_job(job: CreativeBatchJob):
+    if job.job_id in batch_tasks and not batch_tasks[job.job_id].done():
+        return
+    batch_tasks[job.job_id] = asyncio.create_task(
+        run_creative_batch_job(Agent_orchestrator.Orchestrator(), job)
+    )
+
+
+@app.on_event("startup")
+async def setup_logging():
+    """Logging is configured by the app (or the first orchestrator), never on import."""
+    Agent_orchestrator.configure_logging()
+
+
+@app.on_event("startup")
+async def open_rag_table():
+    """Open the shared LanceDB table once at startup instead of on the first request."""
+    try:
+        await Agent_orchestrator.rag_table.get_table()
+    except Exception as e:
+        # The agent flow reports the error per request, the creative flow does not need the table
+        logger.error(f"LanceDB table could not be opened at startup: {e}")
+
+
+@app.on_event("startup")
+async def resume_batch_jobs():
+    """Resume creative batch jobs left unfinished by a crash or restart (completed cells are skipped).
+    Every worker tries, only the one taking the lease of a job runs it."""
+    for job in list_resumable_jobs():
+        start_batch_job(job)
+
+
+@app.on_event("shutdown")
+def stop_cpu_offload_pool():
+    cpu_offload.shutdown()
 
 
 @app.post("/agent/process", response_model=AgentResponse)
 async def process_agent_request(
     prompt_text: str = Form(...),
     file: Optional[UploadFile] = File(None),
+    session_id: Optional[str] = Form(None),
 ):
+    """session_id continues the conversation of a previous response (a new session is started if omitted)."""
     file_content = None
     if file is not None:
-        file_content = await file.read()
+        try:
+            file_content = await read_text_upload(file)
+        except UploadTooLarge as e:
+            raise HTTPException(status_code=413, detail=str(e))
 
-    answer = agent_request_process(
+    answer, session_id = await async_agent_request_process_session(
         prompt_text=prompt_text,
-        file_content=file_content
+        file_content=file_content,
+        session_id=session_id
+    )
+    return AgentResponse(answer=answer, session_id=session_id)
+
+
+@app.post("/agent/process/stream")
+async def process_agent_request_stream(
+    prompt_text: str = Form(...),
+    file: Optional[UploadFile] = File(None),
+    session_id: Optional[str] = Form(None),
+):
+    """Same flow as /agent/process as server-sent events: stage events (routed, retrieved, acted),
+    token events with the synthesized answer and a final done event with the full answer.
+    The session id is sent in a first session event and in the done event (and in the X-Session-Id
+    header when it was given)."""
+    file_content = None
+    if file is not None:
+        try:
+            file_content = await read_text_upload(file)
+        except UploadTooLarge as e:
+            raise HTTPException(status_code=413, detail=str(e))
+
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    if session_id:
+        headers["X-Session-Id"] = session_id
+    return StreamingResponse(
+        stream_events(lambda emit: async_agent_request_process_session(
+            prompt_text=prompt_text,
+            file_content=file_content,
+            on_event=emit,
+            session_id=session_id
+        ), lambda result: {"answer": result[0], "session_id": result[1]}),
+        media_type="text/event-stream",
+        headers=headers,
     )
-    return AgentResponse(answer=answer)
 
 
 # NEW: Creative reaction endpoint (image + headline + personas)
@@ -46,6 +202,8 @@ async def creative_react(
     headline: str = Form(...),
     personas_json: str = Form(...),
     image: UploadFile = File(...),
+    fan_out: bool = Form(False),
+    no_cache: bool = Form(False),
 ):
     """
     personas_json example:
@@ -55,12 +213,169 @@ async def creative_react(
       "patient_new": "Newly diagnosed patient...",
       "patient_long": "Long-term patient..."
     }
+
+    fan_out=true runs one concurrent call per persona (extra persona keys are accepted)
+    and returns partial results if some personas fail.
+    no_cache=true skips the result cache and always calls the model.
     """
-    image_bytes = await image.read()
-    answer = creative_reaction_request_process(
+    try:
+        image_bytes = await read_binary_upload(image, CREATIVE_IMAGE_MAX_BYTES)
+    except UploadTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    answer = await async_creative_reaction_request_process(
         headline=headline,
         personas_json=personas_json,
         image_bytes=image_bytes,
-        image_mime=image.content_type or "image/png"
+        image_mime=image.content_type or "image/png",
+        fan_out=fan_out,
+        use_cache=not no_cache
     )
-    return AgentResponse(answer=answer)
\ No newline at end of file
+    return AgentResponse(answer=answer)
+
+
+@app.post("/creative/react/stream")
+async def creative_react_stream(
+    headline: str = Form(...),
+    personas_json: str = Form(...),
+    image: UploadFile = File(...),
+    fan_out: bool = Form(False),
+    no_cache: bool = Form(False),
+):
+    """Same flow as /creative/react as server-sent events: stage events, token events of the vision
+    answer (or one persona event per finished persona with fan_out=true) and a final done event."""
+    try:
+        image_bytes = await read_binary_upload(image, CREATIVE_IMAGE_MAX_BYTES)
+    except UploadTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    image_mime = image.content_type or "image/png"
+
+    return StreamingResponse(
+        stream_events(lambda emit: async_creative_reaction_request_process(
+            headline=headline,
+            personas_json=personas_json,
+            image_bytes=image_bytes,
+            image_mime=image_mime,
+            fan_out=fan_out,
+            use_cache=not no_cache,
+            on_event=emit
+        )),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.get("/rag/stats")
+async def rag_stats():
+    return {
+        **Agent_orchestrator.rag_table.stats(),
+        "embedding_cache": Agent_orchestrator.embedding_cache.stats(),
+        "semantic_cache": Agent_orchestrator.semantic_cache.stats(),
+    }
+
+
+@app.get("/cpu/stats")
+async def cpu_stats():
+    """Calls, inline/offloaded counts and timings of the CPU-bound preprocessing tasks of this worker."""
+    return cpu_offload.stats()
+
+
+@app.get("/llm/stats")
+async def llm_stats():
+    """Calls, retries, average queueing delay and token estimate per model of this worker's LLM client."""
+    if not Agent_orchestrator.client._initialized:
+        return {}
+    return Agent_orchestrator.client.stats()
+
+
+@app.get("/coalescing/stats")
+async def coalescing_stats():
+    """Computations started and duplicate requests that joined one in flight, per kind."""
+    return {
+        flights.name: flights.stats()
+        for flights in (Agent_orchestrator.agent_flights, Agent_orchestrator.creative_flights, Agent_orchestrator.llm_call_flights)
+    }
+
+
+@app.get("/router/stats")
+async def router_stats():
+    return Agent_orchestrator.local_router.stats()
+
+
+@app.get("/metrics")
+async def prometheus_metrics():
+    """Per-stage latency histograms, token and error counters and in-flight gauges in Prometheus text format."""
+    return Response(render_metrics(), media_type=METRICS_CONTENT_TYPE)
+
+
+@app.get("/metrics/summary")
+async def metrics_summary(since: Optional[str] = "24h", until: Optional[str] = None, group_by: str = "Step,Tool"):
+    """p50/p95/p99 latency, tokens and success rate per Step/Tool over [since, until) (15m, 24h, 7d or ISO dates)."""
+    try:
+        columns = [column.strip() for column in group_by.split(",") if column.strip()] or list(GROUP_COLUMNS)
+        rows = await asyncio.to_thread(
+            summarize_metrics, Agent_orchestrator.metrics_sink.directory, parse_time(since), parse_time(until), columns
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"since": since, "until": until, "group_by": columns, "rows": rows, "sink": Agent_orchestrator.metrics_sink.stats()}
+
+
+@app.get("/creative/cache/stats")
+async def creative_cache_stats():
+    return Agent_orchestrator.creative_cache.stats()
+
+
+@app.post("/creative/batch", response_model=BatchJobStatus)
+async def creative_batch(
+    headlines_json: str = Form(...),
+    persona_sets_json: str = Form(...),
+    images: List[UploadFile] = File(...),
+    fan_out: bool = Form(False),
+):
+    """
+    Runs every creative (images[i] + headlines[i]) against every persona set in the background.
+
+    headlines_json: JSON list with one headline per image, e.g. ["Headline A", "Headline B"]
+    persona_sets_json: JSON list of personas_json objects (same format as /creative/react),
+    or an object {"persona_set_id": {...personas...}}
+    """
+    try:
+        headlines = await cpu_offload.run("json", json.loads, headlines_json, size=len(headlines_json))
+        persona_sets = parse_persona_sets(persona_sets_json)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=f"Invalid batch definition: {e}")
+    if not isinstance(headlines, list) or len(headlines) != len(images):
+        raise HTTPException(status_code=422, detail="headlines_json must be a list with one headline per image")
+
+    # The spooled uploads are copied chunk by chunk to the job directory, never read whole
+    try:
+        for image in images:
+            check_upload_size(image, CREATIVE_IMAGE_MAX_BYTES)
+        creatives = [
+            {"headline": headline, "image_stream": image.file, "image_mime": image.content_type or "image/png"}
+            for headline, image in zip(headlines, images)
+        ]
+        job = await asyncio.to_thread(CreativeBatchJob.create, creatives, persona_sets, fan_out)
+    except UploadTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    start_batch_job(job)
+    return BatchJobStatus(**job.status())
+
+
+def load_batch_job(job_id: str) -> CreativeBatchJob:
+    job = CreativeBatchJob(job_id)
+    if not job_id.isalnum() or not os.path.exists(job.job_file):
+        raise HTTPException(status_code=404, detail=f"Batch job {job_id} not found")
+    return job
+
+
+@app.get("/creative/batch/{job_id}", response_model=BatchJobStatus)
+async def creative_batch_status(job_id: str):
+    return BatchJobStatus(**load_batch_job(job_id).status())
+
+
+@app.post("/creative/batch/{job_id}/resume", response_model=BatchJobStatus)
+async def creative_batch_resume(job_id: str):
+    job = load_batch_job(job_id)
+    start_batch_job(job)
+    return BatchJobStatus(**job.status())
\ No newline at end of file
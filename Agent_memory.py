@@ -3,9 +3,18 @@
 
 # %%
 from pydantic import BaseModel
-from typing import List, Dict
+from typing import List, Dict, Optional
+from collections import OrderedDict, deque
+from itertools import islice
+import atexit
 import json
+import logging
 import os
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
 
 # %% [markdown]
 # #### Class Memory
@@ -48,3 +57,158 @@ def clear_memory_file(file_name_memory):
         os.remove(file_name_memory)
 
 
+# %% [markdown]
+# #### Session memory store
+
+# %%
+class MemoryStore:
+    """Conversation history by session id, shared by the threads of a process and by the uvicorn workers.
+
+    Every session keeps its max_messages most recent messages in memory (at most max_sessions sessions,
+    least recently used first out). New messages are written behind to a SQLite file in WAL mode by a
+    background thread every flush_interval seconds; the file is the source for sessions not in memory
+    and for the messages added by other workers, which are fetched by id on every read."""
+
+    def __init__(self, path: str, max_messages: int = 20, max_sessions: int = 10_000, flush_interval: float = 0.5):
+        self.path = path
+        self.max_messages = max_messages
+        self.max_sessions = max_sessions
+        self.flush_interval = flush_interval
+        # session_id -> {"messages": deque, "last_id": last row read from the file, "own_ids": rows written by this process}
+        self._sessions: "OrderedDict[str, Dict]" = OrderedDict()
+        self._pending: List[tuple] = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._local = threading.local()
+        self._stop = threading.Event()
+
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        conn = self._connection()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS messages ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, session_id TEXT NOT NULL, role TEXT NOT NULL, content TEXT NOT NULL, created REAL NOT NULL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS messages_session ON messages (session_id, id)")
+        conn.commit()
+
+        self._writer = threading.Thread(target=self._write_behind, name="memory-write-behind", daemon=True)
+        self._writer.start()
+        atexit.register(self.close)
+
+    def _connection(self) -> sqlite3.Connection:
+        """One connection per thread (sqlite3 connections are not shared across threads)."""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _session(self, session_id: str) -> Dict:
+        """In-memory state of the session (loaded from the file if needed), with the messages of other workers appended."""
+        with self._lock:
+            session = self._sessions.get(session_id)
+            pending = any(row[0] == session_id for row in self._pending)
+        if session is None and pending:
+            # Evicted with unwritten messages: write them before reloading the session
+            self.flush()
+
+        conn = self._connection()
+        if session is None:
+            rows = conn.execute(
+                "SELECT id, role, content FROM messages WHERE session_id = ? ORDER BY id DESC LIMIT ?",
+                (session_id, self.max_messages),
+            ).fetchall()[::-1]
+            session = {"messages": deque(maxlen=self.max_messages), "last_id": 0, "own_ids": set()}
+        else:
+            rows = conn.execute(
+                "SELECT id, role, content FROM messages WHERE session_id = ? AND id > ? ORDER BY id",
+                (session_id, session["last_id"]),
+            ).fetchall()
+
+        with self._lock:
+            session = self._sessions.setdefault(session_id, session)
+            for row_id, role, content in rows:
+                if row_id in session["own_ids"]:
+                    continue
+                if row_id > session["last_id"]:
+                    session["messages"].append({"role": role, "content": content})
+            if rows:
+                session["last_id"] = max(session["last_id"], rows[-1][0])
+            session["own_ids"] = {row_id for row_id in session["own_ids"] if row_id > session["last_id"]}
+            self._sessions.move_to_end(session_id)
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+        return session
+
+    def add_message(self, session_id: str, role: str, content: str):
+        session = self._session(session_id)
+        with self._lock:
+            session["messages"].append({"role": role, "content": content})
+            self._pending.append((session_id, role, content, time.time()))
+
+    def get_recent_messages(self, session_id: str, num: int = 5) -> List[Dict[str, str]]:
+        """Last num messages of the session, oldest first."""
+        session = self._session(session_id)
+        with self._lock:
+            recent = list(islice(reversed(session["messages"]), num))
+        return recent[::-1]
+
+    def clear_session(self, session_id: str):
+        self.flush()
+        with self._lock:
+            self._sessions.pop(session_id, None)
+        conn = self._connection()
+        conn.execute("DELETE FROM messages WHERE session_id = ?", (session_id,))
+        conn.commit()
+
+    def flush(self):
+        """Write the pending messages and keep only the max_messages most recent rows of their sessions."""
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, []
+            if not pending:
+                return
+            conn = self._connection()
+            try:
+                written = []
+                for session_id, role, content, created in pending:
+                    cursor = conn.execute(
+                        "INSERT INTO messages (session_id, role, content, created) VALUES (?, ?, ?, ?)",
+                        (session_id, role, content, created),
+                    )
+                    written.append((session_id, cursor.lastrowid))
+                for session_id in {session_id for session_id, _ in written}:
+                    conn.execute(
+                        "DELETE FROM messages WHERE session_id = ? AND id NOT IN ("
+                        "SELECT id FROM messages WHERE session_id = ? ORDER BY id DESC LIMIT ?)",
+                        (session_id, session_id, self.max_messages),
+                    )
+                # Marked before the commit so a concurrent read never takes them for messages of another worker
+                with self._lock:
+                    for session_id, row_id in written:
+                        session = self._sessions.get(session_id)
+                        if session is not None:
+                            session["own_ids"].add(row_id)
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                with self._lock:
+                    for session_id, row_id in written:
+                        session = self._sessions.get(session_id)
+                        if session is not None:
+                            session["own_ids"].discard(row_id)
+                    self._pending = pending + self._pending
+                raise
+
+    def _write_behind(self):
+        while not self._stop.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Memory write-behind failed, retrying: {e}")
+
+    def close(self):
+        self._stop.set()
+        self.flush()
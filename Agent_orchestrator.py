@@ -2,27 +2,42 @@
 # ##### Libraries
 
 # %%
-import base64
+# Heavy or side-effect libraries (openai, pandas, lancedb, smtplib) are imported where they are first used,
+# and the clients, caches and writers below are built on first use (utils.lazy): importing this module
+# opens no file and starts no thread
+import asyncio
 import json
 import requests
 import os
-import pandas as pd
 import logging
 import requests
 import Agent_memory 
-import lancedb
-from openai import OpenAI
+from functools import lru_cache
 from pydantic import BaseModel, Field
-from typing import Optional, Literal, Dict, Literal, List
+from typing import Optional, Literal, Dict, Literal, List, Tuple
 from dotenv import load_dotenv
 import time
-from openai._exceptions import BadRequestError
-import smtplib
-from email.message import EmailMessage
-import seaborn as sns
-import matplotlib.pyplot as plt
+import uuid
 import warnings
 import utils.ReportFiles as rf
+from utils.metrics_sink import MetricsSink, METRICS_COLUMNS
+from utils.result_cache import ResultCache, normalize_personas_json
+from utils.image_preprocess import image_preprocessor
+from utils.sse import Emit
+from utils.lancedb_store import LanceTableHandle
+from utils.embedding_cache import EmbeddingCache
+from utils.semantic_cache import SemanticCache
+from utils.rank_fusion import reciprocal_rank_fusion
+from utils.token_budget import TokenBudget
+from utils.stage_graph import StageGraph
+from utils.local_router import LOCAL_ROUTE_TOOL, NearestCentroidRouter
+from utils.prometheus_metrics import instrument_stage, observe_stage
+from utils.lazy import Lazy
+from utils.llm_client import create_llm_client
+from utils.single_flight import SingleFlight, canonical_key, coalesce
+from utils.cpu_offload import cpu_offload, reformat_json
+from utils.attachment_index import AttachmentIndex, AttachmentIndexCache, count_tokens, split_attachment
+from utils.background_loop import background_loop
 warnings.filterwarnings("ignore")
 
 USE_AZURE=False   #switch this off for local runs
@@ -32,34 +47,51 @@ USE_AZURE=False   #switch this off for local runs
 # %%
 report_metrics_file = "report_metrics.csv"
 reports_dir = "reports"
-memory_file = "memory.json"
 tools_schema = "tools_schema.json"
 
-header = ['Datetime_request', 'Input_prompt', 'Total_time_request',  'Step' , 'Tool', 'Success', 'Latency', 'Confidence', 'Tokens', 'Calls_API', 'Response']
+# Columns of the metrics report (Parquet segments and CSV export)
+header = list(METRICS_COLUMNS)
+
+# Metrics rows are written off the request path: Parquet segments in reports/metrics and the CSV report
+metrics_sink = Lazy(lambda: MetricsSink(
+    os.getenv("METRICS_DIR", os.path.join(reports_dir, "metrics")),
+    csv_path=os.path.join(reports_dir, report_metrics_file) if os.getenv("METRICS_CSV_EXPORT", "1") == "1" else None,
+    segment_max_bytes=int(os.getenv("METRICS_SEGMENT_MAX_BYTES", str(64 * 1024 * 1024))),
+    segment_max_seconds=float(os.getenv("METRICS_SEGMENT_MAX_SECONDS", "300")),
+))
 
-# Set up logging configuration
-logging.basicConfig(
-    filename="application.log",                 
-    filemode="w",
-    level=logging.INFO,
-    format="\n%(asctime)s - %(levelname)s - %(message)s",
-    datefmt="%Y-%m-%d %H:%M:%S",
-    force=True    
-    
-)
 logger = logging.getLogger(__name__)
+_logging_configured = False
+
+def configure_logging():
+    """Set up the application.log logging configuration, once per process (appending: several workers share the file)."""
+    global _logging_configured
+    if _logging_configured:
+        return
+    _logging_configured = True
+    logging.basicConfig(
+        filename="application.log",                 
+        filemode="a",
+        level=logging.INFO,
+        format="\n%(asctime)s - %(levelname)s - %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S",
+        force=True    
+    )
 
 # Setup LLM 
 # Load environment variables
 load_dotenv()
 # Initialize OpenAI client
 
-if USE_AZURE:
-    client = OpenAI(
-    api_key=os.getenv("AZURE_FDRY_KEY"),
-    base_url=os.getenv("AZURE_FDRY_ENDPOINT").rstrip("/") + "/openai/v1/"
-    )
+# Shared client layer (utils/llm_client.py): pooled connections, timeouts, per-model RPM/TPM limits and retries
+client = Lazy(lambda: create_llm_client(azure=USE_AZURE))
 
+def openai_request_errors() -> tuple:
+    """OpenAI errors handled as a failed request (imported on use, openai is loaded by then)"""
+    from openai import BadRequestError
+    return (BadRequestError,)
+
+if USE_AZURE:
     # In Azure: model == deployment name
     model = os.getenv("AZURE_OPENAI_CHAT_DEPLOYMENT")
     model_tools = os.getenv("AZURE_OPENAI_CHAT_DEPLOYMENT")
@@ -67,64 +99,188 @@ if USE_AZURE:
     # Embedding deployment for RAG
     embed_model = os.getenv("AZURE_OPENAI_EMBED_DEPLOYMENT")
 else:
-    client = OpenAI()
     model = "gpt-4o-mini"
     model_tools = "gpt-4"
 
+    # Embedding model of the docling table (LanceDB openai embedding function)
+    embed_model = "text-embedding-3-large"
+
+# Creative testing fan-out mode (one vision call per persona)
+CREATIVE_FAN_OUT_CONCURRENCY = int(os.getenv("CREATIVE_FAN_OUT_CONCURRENCY", "4"))
+CREATIVE_PERSONA_MAX_TOKENS = 700
+CREATIVE_MERGE_MAX_TOKENS = 400
+CREATIVE_TEMPERATURE = 0.4
+
+# Creative reaction result cache (LRU + TTL in memory, optional SQLite tier when CREATIVE_CACHE_PATH is set)
+creative_cache = Lazy(lambda: ResultCache(
+    max_entries=int(os.getenv("CREATIVE_CACHE_SIZE", "256")),
+    ttl_seconds=float(os.getenv("CREATIVE_CACHE_TTL", str(24 * 3600))),
+    disk_path=os.getenv("CREATIVE_CACHE_PATH") or None,
+))
+
+
+# Prompt token budgets per call (exact counts with the tiktoken encoding of each model)
+TOKEN_BUDGET_ROUTER = int(os.getenv("TOKEN_BUDGET_ROUTER", "4000"))
+TOKEN_BUDGET_ANALYSIS = int(os.getenv("TOKEN_BUDGET_ANALYSIS", "12000"))
+# Part of the analysis budget kept for the retrieved chunks
+TOKEN_BUDGET_RAG_CONTEXT = int(os.getenv("TOKEN_BUDGET_RAG_CONTEXT", "3000"))
+# Tool calls run on model_tools (gpt-4: 8k context)
+TOKEN_BUDGET_ACTION = int(os.getenv("TOKEN_BUDGET_ACTION", "6000"))
+EMBED_MAX_TOKENS = 8000
+token_budget = TokenBudget(model)
+action_token_budget = TokenBudget(model_tools)
+
+# Shared LanceDB table for RAG
+rag_db_path = "data/lancedb"
+rag_table_name = "docling"
+rag_table = LanceTableHandle(rag_db_path, rag_table_name)
+
+# ANN index search settings, chosen with lancedb_index.py bench
+RAG_NPROBES = int(os.getenv("RAG_NPROBES", "0")) or None
+RAG_REFINE_FACTOR = int(os.getenv("RAG_REFINE_FACTOR", "0")) or None
+
+# Retrieval mode: "vector" or "hybrid" (BM25 full-text + vector fused with reciprocal rank fusion)
+RAG_SEARCH_MODE = os.getenv("RAG_SEARCH_MODE", "vector")
+RAG_VECTOR_CANDIDATES = int(os.getenv("RAG_VECTOR_CANDIDATES", "10"))
+RAG_FTS_CANDIDATES = int(os.getenv("RAG_FTS_CANDIDATES", "10"))
+RAG_RRF_K = int(os.getenv("RAG_RRF_K", "60"))
+
+# Start the retrieval of analyze_test_results while the request is routed
+SPECULATIVE_RETRIEVAL = os.getenv("SPECULATIVE_RETRIEVAL", "1") == "1"
+
+# Local nearest-centroid router trained from the report metrics (train_local_router.py), LLM router below the threshold
+LOCAL_ROUTER_ENABLED = os.getenv("LOCAL_ROUTER_ENABLED", "1") == "1"
+local_router = NearestCentroidRouter(
+    os.getenv("LOCAL_ROUTER_PATH", "data/local_router.npz"),
+    threshold=float(os.getenv("LOCAL_ROUTER_THRESHOLD", "0.9")),
+)
+
+# Query embeddings cache shared by all workers
+embedding_cache = Lazy(lambda: EmbeddingCache(
+    os.getenv("EMBEDDING_CACHE_PATH", "data/embedding_cache.sqlite"),
+    max_entries=int(os.getenv("EMBEDDING_CACHE_SIZE", "100000")),
+))
+
+# Answers of the analyze_test_results / response_question flow served to near-identical questions with the
+# same numbers and polarity terms (never to requests with an attachment or a history)
+SEMANTIC_CACHE_ENABLED = os.getenv("SEMANTIC_CACHE_ENABLED", "1") == "1"
+semantic_cache = Lazy(lambda: SemanticCache(
+    os.getenv("SEMANTIC_CACHE_PATH", "data/semantic_cache.sqlite"),
+    threshold=float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.95")),
+    max_entries=int(os.getenv("SEMANTIC_CACHE_SIZE", "5000")),
+    ttl_seconds=float(os.getenv("SEMANTIC_CACHE_TTL", str(7 * 24 * 3600))),
+))
+
+# Attachments over ATTACHMENT_INLINE_TOKENS are chunked and embedded into an in-memory index,
+# every stage gets only its top chunks for the question instead of the whole file
+ATTACHMENT_INLINE_TOKENS = int(os.getenv("ATTACHMENT_INLINE_TOKENS", "1500"))
+ATTACHMENT_CHUNK_TOKENS = int(os.getenv("ATTACHMENT_CHUNK_TOKENS", "400"))
+ATTACHMENT_CHUNK_OVERLAP = int(os.getenv("ATTACHMENT_CHUNK_OVERLAP", "50"))
+ATTACHMENT_EMBED_BATCH = int(os.getenv("ATTACHMENT_EMBED_BATCH", "256"))
+ATTACHMENT_ROUTER_CHUNKS = int(os.getenv("ATTACHMENT_ROUTER_CHUNKS", "2"))
+ATTACHMENT_ANALYSIS_CHUNKS = int(os.getenv("ATTACHMENT_ANALYSIS_CHUNKS", "6"))
+ATTACHMENT_ACTION_CHUNKS = int(os.getenv("ATTACHMENT_ACTION_CHUNKS", "3"))
+attachment_indexes = AttachmentIndexCache(int(os.getenv("ATTACHMENT_INDEX_CACHE_SIZE", "32")))
+
+# Identical requests (and LLM sub-calls) running at the same time share one computation
+agent_flights = SingleFlight("agent_request")
+creative_flights = SingleFlight("creative_request")
+llm_call_flights = SingleFlight("llm_call")
+
 
 # %% [markdown]
 # ##### Tools schema load
 
 # %%
-# Load the tools structure from file
-with open(tools_schema, "r", encoding="utf-8") as f:
-    tools = json.load(f)
+@lru_cache(maxsize=None)
+def get_tools() -> List[Dict]:
+    """Load the tools structure from file (once, on the first tool call)"""
+    with open(tools_schema, "r", encoding="utf-8") as f:
+        return json.load(f)
 
 
 # %% [markdown]
 # #### Memory functions 
 
 
-def creative_reaction_process_request(
+async def async_creative_reaction_process_request(
     headline: str,
     personas_json: str,
     image_bytes: bytes,
-    image_mime: str = "image/png"
+    image_mime: str = "image/png",
+    fan_out: bool = False,
+    use_cache: bool = True,
+    on_event: Optional[Emit] = None
 ) -> str:
     """
     Entry point for Part-2 Creative Testing flow.
     """
     orchestrator = Orchestrator()
-    return orchestrator.process_creative_reaction(
+    return await orchestrator.process_creative_reaction(
         headline=headline,
         personas_json=personas_json,
         image_bytes=image_bytes,
-        image_mime=image_mime
+        image_mime=image_mime,
+        fan_out=fan_out,
+        use_cache=use_cache,
+        on_event=on_event
     )
 
+def creative_reaction_process_request(
+    headline: str,
+    personas_json: str,
+    image_bytes: bytes,
+    image_mime: str = "image/png",
+    fan_out: bool = False,
+    use_cache: bool = True
+) -> str:
+    """Sync wrapper of the creative flow for scripts and notebooks (runs on the shared background event loop)."""
+    return background_loop.run(async_creative_reaction_process_request(
+        headline=headline,
+        personas_json=personas_json,
+        image_bytes=image_bytes,
+        image_mime=image_mime,
+        fan_out=fan_out,
+        use_cache=use_cache
+    ))
+
 # %%
-def get_agent_memory():
-    """Load the agent memory from the file and return the recent messages."""
+def get_agent_memory(session_id: str):
+    """Recent messages of the session, oldest first."""
     try:    
-        memory = Agent_memory.load_memory_from_file(memory_file)  
-        return memory.get_recent_messages()
+        return memory_store.get_recent_messages(session_id, MEMORY_RECENT_MESSAGES)
     except Exception as e:
         logger.error(f"Error loading the memory: {e}")
         return None
 
-def clean_agent_memory():
-    """Clear the agent memory file."""
-    Agent_memory.clear_memory_file(memory_file)
+def clean_agent_memory(session_id: str):
+    """Clear the history of the session."""
+    memory_store.clear_session(session_id)
     return 
 
-# Create the memory file
-memory = Agent_memory.Memory()
-Agent_memory.save_memory_to_file(memory_file, memory)
+def add_agent_memory(session_id: str, content: str):
+    """Keep an assistant message in the history of the session."""
+    try:
+        memory_store.add_message(session_id, "assistant", content)
+    except Exception as e:
+        logger.error(f"Error saving the memory: {e}")
+
+# Conversation history by session
+memory_store = Lazy(lambda: Agent_memory.MemoryStore(
+    os.getenv("MEMORY_DB_PATH", "data/memory.sqlite"),
+    max_messages=int(os.getenv("MEMORY_MAX_MESSAGES", "20")),
+))
+MEMORY_RECENT_MESSAGES = int(os.getenv("MEMORY_RECENT_MESSAGES", "5"))
 
 # %% [markdown]
 # ##### Functions/Tools called by the Agent
 
 # %%
+def _emit_event(on_event: Optional[Emit], event: str, data: Dict):
+    """Send a progress event to the streaming endpoint when the request is streamed."""
+    if on_event is not None:
+        on_event(event, data)
+
 def _convert_dataframe_to_json(df, message_if_none):
     """Convert a DataFrame to JSON format."""
     if df is None or df.empty:
@@ -133,6 +289,9 @@ def _convert_dataframe_to_json(df, message_if_none):
 
 def send_email_notification(to: str, subject: str, body: str):
     """Send an email notification."""
+    import smtplib
+    from email.message import EmailMessage
+
     sender_email = os.getenv("SENDER_EMAIL")
     password = os.getenv("SENDER_PASSWORD")
     to = os.getenv("RECEIVER_EMAIL")
@@ -283,6 +442,15 @@ Return your response in this format:
 
 
 
+ROUTER_PROMPT = "Determine if this is a request to response a question or analyze information or apply an action like schedule an appointment."
+
+RAG_SYSTEM_PROMPT = """You are a helpful assistant that analyze medical test results from documents and give recommendations or next steps.
+        Use only the information from the context to answer questions. If you're unsure or the context
+        doesn't contain the relevant information, say so.     
+        """
+
+ATTACHMENT_PROMPT = " analyze also the below content attached "
+
 SUMMARY_PROMPT = """
 You are an agent who helps patients analyze the results of their medical tests and explain, in a friendly and positive way, the results, a possible action plan, next steps, and healthy recommendations. 
 You have to summary the information in short format, around 10 words to save the most important information for historical context.
@@ -297,11 +465,76 @@ Return your response in this format:
 4. Give the information about what action applied, only the action any other detail.
 """
 
+CREATIVE_SYSTEM_PROMPT = (
+    "You are a pharma creative testing assistant. "
+    "Your job is to predict how different personas react to educational creative (static image + headline). "
+    "You must be cautious: do not invent clinical claims not supported by the creative. "
+    "Focus on clarity, trust, emotional tone, skepticism triggers, and what questions the persona would ask next. "
+    "Output concise, structured results."
+)
+
+CREATIVE_PER_PERSONA_OUTPUT = {
+    "reaction_label": "one of: resonate, confuse, skepticism",
+    "why": "3-6 bullets tied to image/copy cues",
+    "questions_next": "2-4 bullets",
+    "suggested_edits": "2-4 bullets"
+}
+
+CREATIVE_MERGE_PROMPT = """
+You compare how different personas reacted to the same pharma educational creative.
+Using only the reactions provided, return a JSON object with the key "segment_differences": a list of 2-6 short bullets.
+Compare HCP personas with each other and patient personas with each other when present.
+"""
+
+# Default personas for the creative testing flow: (key in personas_json, label, fallback description)
+CREATIVE_DEFAULT_PERSONAS = [
+    ("hcp_early", "HCP (Early Adopter)",
+     "Dermatologist, 8 years experience, early adopter, comfortable with new therapies, values mechanism and emerging evidence."),
+    ("hcp_conservative", "HCP (Conservative)",
+     "Dermatologist, 15 years experience, conservative prescriber, skeptical of new drugs, guideline-driven, high safety/evidence threshold."),
+    ("patient_new", "Patient (Newly Diagnosed)",
+     "Patient newly diagnosed with microcystic lymphatic malformation, anxious, low-to-medium health literacy, wants reassurance and next steps."),
+    ("patient_long", "Patient (Long-Term)",
+     "Patient living with microcystic lymphatic malformation for 10+ years, has tried treatments, skeptical of generic education, wants specific actionable info."),
+]
+
+
+def build_persona_bundle(personas: Dict, include_extra: bool = False) -> List[tuple]:
+    """Build the (label, persona) list for the creative flow: the default personas (overridden by personas_json)
+    plus, when include_extra is set, any other key of personas_json labelled with its key."""
+    persona_bundle = [
+        (label, personas.get(key, default)) for (key, label, default) in CREATIVE_DEFAULT_PERSONAS
+    ]
+    if include_extra:
+        default_keys = {key for (key, _, _) in CREATIVE_DEFAULT_PERSONAS}
+        persona_bundle += [
+            (key, str(persona)) for key, persona in personas.items() if key not in default_keys
+        ]
+    return persona_bundle
+
 # %% [markdown]
 # #### Print functions for verification of each step
 
 # %%
   
+def format_attachment(chunks: List[str]) -> str:
+    """Attachment chunks appended to the user prompt"""
+    if not chunks:
+        return ""
+    return ATTACHMENT_PROMPT + "\n\n".join(chunks)
+
+def format_past_content(messages: List[str]) -> str:
+    """Historical context appended to the user prompt"""
+    # Concatenate only the content field
+    past_content = " ".join(messages)
+    past_content = past_content.replace("\n", " ")   
+    past_content = past_content.replace("\r", " ")  
+    past_content = past_content.replace("  ", " ")        
+
+    if past_content.strip() != "":
+        past_content = ". This is the context of the previous or historical request to analyze results:" + past_content
+    return past_content
+
 def print_investigation(investigation_result):    
     print("\nINVESTIGATION RESULT\n")
     print(f"Investigation Source: {investigation_result.source}")
@@ -325,68 +558,89 @@ class Orchestrator:
     def __init__(
         self,       
     ):        
+        configure_logging()
         self.sections_content = {}
         self.function_map = {       
         "send_email_notification": send_email_notification,
         "call_API": call_API
     }        
     
-    def process_creative_reaction(
+    @instrument_stage("creative", "request")
+    async def process_creative_reaction(
         self,
         headline: str,
         personas_json: str,
         image_bytes: bytes,
         image_mime: str = "image/png",
+        fan_out: bool = False,
+        max_concurrency: int = CREATIVE_FAN_OUT_CONCURRENCY,
+        use_cache: bool = True,
+        on_event: Optional[Emit] = None,
     ) -> str:
         """
         Generates reactions for:
           - 2 HCP personas (early adopter vs conservative)
           - 2 patient personas (newly diagnosed vs long-term)
         using the same creative (image + headline).
+
+        With fan_out=True every persona (including any extra keys in personas_json) gets its own
+        concurrent vision call, and segment_differences come from a small text-only merge call.
+
+        Results are cached by (image hash, headline, personas, model, temperature); use_cache=False bypasses the cache.
+        on_event receives progress events (stages, tokens or per-persona results) for streaming.
         """
 
-        # Parse personas
+        # Parse personas (large payloads are parsed in the CPU offload pool)
         try:
-            personas = json.loads(personas_json)
+            personas = await cpu_offload.run("json", json.loads, personas_json, size=len(personas_json))
         except Exception as e:
             return f"Invalid personas_json. Must be JSON. Error: {e}"
 
-        # Ensure required keys exist (fallback to defaults if missing)
-        hcp_early = personas.get(
-            "hcp_early",
-            "Dermatologist, 8 years experience, early adopter, comfortable with new therapies, values mechanism and emerging evidence."
-        )
-        hcp_conservative = personas.get(
-            "hcp_conservative",
-            "Dermatologist, 15 years experience, conservative prescriber, skeptical of new drugs, guideline-driven, high safety/evidence threshold."
-        )
-        patient_new = personas.get(
-            "patient_new",
-            "Patient newly diagnosed with microcystic lymphatic malformation, anxious, low-to-medium health literacy, wants reassurance and next steps."
-        )
-        patient_long = personas.get(
-            "patient_long",
-            "Patient living with microcystic lymphatic malformation for 10+ years, has tried treatments, skeptical of generic education, wants specific actionable info."
+        image_hash = image_preprocessor.content_hash(image_bytes)
+        cache_key = ResultCache.make_key(
+            image_hash=image_hash,
+            headline=headline,
+            personas=normalize_personas_json(personas_json),
+            model=model,
+            temperature=CREATIVE_TEMPERATURE,
+            fan_out=fan_out,
         )
+        if use_cache:
+            cached = await asyncio.to_thread(creative_cache.get, cache_key)
+            if cached is not None:
+                logger.info(f"Creative reaction served from cache {creative_cache.stats()}")
+                _emit_event(on_event, "stage", {"stage": "cache_hit"})
+                return cached
+
+        async def generate(emit: Optional[Emit]) -> str:
+            answer, cacheable = await self.generate_creative_reaction(
+                headline, personas, image_bytes, image_mime, image_hash, fan_out, max_concurrency, emit
+            )
+            if cacheable:
+                await asyncio.to_thread(creative_cache.set, cache_key, answer)
+            return answer
 
-        persona_bundle = [
-            ("HCP (Early Adopter)", hcp_early),
-            ("HCP (Conservative)", hcp_conservative),
-            ("Patient (Newly Diagnosed)", patient_new),
-            ("Patient (Long-Term)", patient_long),
-        ]
+        # Duplicates (double submit, several reviewers on the same creative) share the vision call(s) in flight
+        return await creative_flights.run(canonical_key(cache_key, on_event is not None), generate, on_event)
 
-        # Encode image for vision prompt
-        b64 = base64.b64encode(image_bytes).decode("utf-8")
-        data_url = f"data:{image_mime};base64,{b64}"
+    async def generate_creative_reaction(self, headline: str, personas: Dict, image_bytes: bytes, image_mime: str,
+                                         image_hash: str, fan_out: bool, max_concurrency: int, on_event: Optional[Emit] = None):
+        """Runs the vision call(s) of the creative flow. Returns the answer and whether it is complete enough to cache.
+        With on_event the single vision call is streamed and each token is emitted"""
 
-        system = (
-            "You are a pharma creative testing assistant. "
-            "Your job is to predict how different personas react to educational creative (static image + headline). "
-            "You must be cautious: do not invent clinical claims not supported by the creative. "
-            "Focus on clarity, trust, emotional tone, skepticism triggers, and what questions the persona would ask next. "
-            "Output concise, structured results."
+        # Ensure required keys exist (fallback to defaults if missing)
+        persona_bundle = build_persona_bundle(personas, include_extra=fan_out)
+
+        # Resize/re-encode the image for the vision prompt (cached by content hash)
+        data_url, image_stats = await image_preprocessor.prepare_data_url_offloaded(image_bytes, image_mime, image_hash)
+        logger.info(
+            f"Creative image preprocessed: {image_stats['original_bytes']} -> {image_stats['processed_bytes']} bytes "
+            f"(saved {image_stats['bytes_saved']} bytes, ~{image_stats['tokens_saved']} image tokens, cache hit {image_stats['cache_hit']})"
         )
+        _emit_event(on_event, "stage", {"stage": "preprocessed", **image_stats})
+
+        if fan_out:
+            return await self.process_creative_reaction_fan_out(headline, persona_bundle, data_url, max_concurrency, on_event)
 
         # We ask the model to return one JSON object for all 4 personas + segment diffs
         user_instructions = {
@@ -396,12 +650,7 @@ class Orchestrator:
                 {"label": lbl, "persona": p} for (lbl, p) in persona_bundle
             ],
             "required_output": {
-                "per_persona": {
-                    "reaction_label": "one of: resonate, confuse, skepticism",
-                    "why": "3-6 bullets tied to image/copy cues",
-                    "questions_next": "2-4 bullets",
-                    "suggested_edits": "2-4 bullets"
-                },
+                "per_persona": CREATIVE_PER_PERSONA_OUTPUT,
                 "segment_differences": [
                     "Compare HCP early adopter vs conservative for this creative",
                     "Compare newly diagnosed vs long-term patient for this creative"
@@ -411,7 +660,7 @@ class Orchestrator:
 
         # Vision + instruction prompt
         messages = [
-            {"role": "system", "content": system},
+            {"role": "system", "content": CREATIVE_SYSTEM_PROMPT},
             {
                 "role": "user",
                 "content": [
@@ -423,42 +672,155 @@ class Orchestrator:
         ]
 
         try:
-            resp = client.chat.completions.create(
-                model=model,  # gpt-4o-mini default in your file (vision-capable)
-                messages=messages,
-                temperature=0.4,
-            )
-            raw = resp.choices[0].message.content
+            with observe_stage("creative", "vision") as observation:
+                if on_event is None:
+                    resp = await client.chat.completions.create(
+                        model=model,  # gpt-4o-mini default in your file (vision-capable)
+                        messages=messages,
+                        temperature=CREATIVE_TEMPERATURE,
+                    )
+                    raw = resp.choices[0].message.content
+                    observation.add_tokens(resp.usage.total_tokens if resp.usage else 0)
+                else:
+                    raw, vision_tokens = await self.stream_completion(
+                        on_event,
+                        model=model,
+                        messages=messages,
+                        temperature=CREATIVE_TEMPERATURE,
+                    )
+                    observation.add_tokens(vision_tokens)
         except Exception as e:
-            return f"LLM call failed: {e}"
+            return f"LLM call failed: {e}", False
 
         # Best-effort: if model returns non-JSON, wrap it
-        try:
-            parsed = json.loads(raw)
-            return json.dumps(parsed, indent=2)
-        except Exception:
-            return raw
+        answer, _ = await cpu_offload.run("json", reformat_json, raw, size=len(raw or ""))
+        return answer, True
+
+    def creative_call_count(self, personas: Dict, fan_out: bool) -> int:
+        """Number of LLM calls one creative reaction request makes (one per persona plus the merge call in fan-out mode)"""
+        if fan_out:
+            return len(build_persona_bundle(personas, include_extra=True)) + 1
+        return 1
+
+    async def creative_persona_reaction(self, headline: str, label: str, persona: str, data_url: str) -> Dict:
+        """Vision LLM call for a single persona of the creative. Returns the parsed per-persona JSON"""
+        user_instructions = {
+            "task": "creative_reaction_testing",
+            "headline": headline,
+            "persona": {"label": label, "persona": persona},
+            "required_output": CREATIVE_PER_PERSONA_OUTPUT,
+        }
+        messages = [
+            {"role": "system", "content": CREATIVE_SYSTEM_PROMPT},
+            {
+                "role": "user",
+                "content": [
+                    {"type": "text", "text": "Analyze this pharma educational creative for the persona provided. Return JSON only."},
+                    {"type": "text", "text": json.dumps(user_instructions)},
+                    {"type": "image_url", "image_url": {"url": data_url}},
+                ],
+            },
+        ]
+        with observe_stage("creative", "vision") as observation:
+            resp = await client.chat.completions.create(
+                model=model,
+                messages=messages,
+                temperature=CREATIVE_TEMPERATURE,
+                max_tokens=CREATIVE_PERSONA_MAX_TOKENS,
+                response_format={"type": "json_object"},
+            )
+            observation.add_tokens(resp.usage.total_tokens if resp.usage else 0)
+            return json.loads(resp.choices[0].message.content)
+
+    async def creative_segment_differences(self, headline: str, per_persona: Dict[str, Dict]) -> List[str]:
+        """Text-only LLM call comparing the per-persona reactions already generated (no image is sent again)"""
+        compact = {
+            label: {
+                "reaction_label": result.get("reaction_label"),
+                "why": result.get("why"),
+            }
+            for label, result in per_persona.items()
+        }
+        with observe_stage("creative", "merge") as observation:
+            completion = await client.chat.completions.create(
+                model=model,
+                messages=[
+                    {"role": "system", "content": CREATIVE_MERGE_PROMPT},
+                    {"role": "user", "content": json.dumps({"headline": headline, "reactions": compact})},
+                ],
+                temperature=0.2,
+                max_tokens=CREATIVE_MERGE_MAX_TOKENS,
+                response_format={"type": "json_object"},
+            )
+            observation.add_tokens(completion.usage.total_tokens if completion.usage else 0)
+            return json.loads(completion.choices[0].message.content).get("segment_differences", [])
+
+    async def process_creative_reaction_fan_out(self, headline: str, persona_bundle, data_url: str, max_concurrency: int,
+                                                on_event: Optional[Emit] = None):
+        """One concurrent vision call per persona (bounded by max_concurrency), then a merge call for segment_differences.
+        Personas that fail are reported in "errors" and the rest of the result is still returned.
+        Returns the answer and whether every call succeeded."""
+        semaphore = asyncio.Semaphore(max(1, max_concurrency))
+
+        async def react(label, persona):
+            async with semaphore:
+                try:
+                    result = await self.creative_persona_reaction(headline, label, persona, data_url)
+                except Exception as e:
+                    _emit_event(on_event, "persona", {"label": label, "error": str(e)})
+                    raise
+            _emit_event(on_event, "persona", {"label": label, "result": result})
+            return result
+
+        results = await asyncio.gather(
+            *(react(label, persona) for (label, persona) in persona_bundle),
+            return_exceptions=True,
+        )
+
+        per_persona = {}
+        errors = {}
+        for (label, _), result in zip(persona_bundle, results):
+            if isinstance(result, Exception):
+                logger.error(f"Creative reaction failed for persona {label}: {result}")
+                errors[label] = str(result)
+            else:
+                per_persona[label] = result
+
+        segment_differences = []
+        if len(per_persona) > 1:
+            try:
+                segment_differences = await self.creative_segment_differences(headline, per_persona)
+            except Exception as e:
+                logger.error(f"Creative segment differences failed: {e}")
+                errors["segment_differences"] = str(e)
+
+        logger.info(f"Creative fan-out completed: {len(per_persona)} personas ok, {len(errors)} errors")
+
+        return json.dumps({
+            "per_persona": per_persona,
+            "segment_differences": segment_differences,
+            "errors": errors,
+        }, indent=2), not errors
 
     
 # Initialize LanceDB connection
-    def init_RAG_db(self):
-        """Initialize database connection. Returns: LanceDB table object"""
-        db = lancedb.connect("data/lancedb")
-        return db.open_table("docling")
+    async def init_RAG_db(self):
+        """Shared database connection (opened once per process, refreshed on new table versions). Returns: LanceDB async table object"""
+        return await rag_table.get_table()
 
-    def call_function(self, name, args):
-        """Calls the appropriate function based on the provided name."""
+    async def call_function(self, name, args):
+        """Calls the appropriate function based on the provided name. Tools are blocking (SMTP, HTTP) so they run in a worker thread."""
         func = self.function_map.get(name)
         if func:
-            return func(**args)
+            return await asyncio.to_thread(func, **args)
         raise ValueError(f"Invalid function name: {name}")
        
-    def call_tool(self, messages: List[Dict]) -> List[Dict]:  
+    async def call_tool(self, messages: List[Dict]) -> List[Dict]:  
         """Function to identify the function/tool to call based on the prompts, extract datails and parameters to add in the messages or prompt to execute and call it. Returns: The messages appending the tool call and the result of the tool call"""      
-        response = client.chat.completions.create(
+        response = await client.chat.completions.create(
             model=model_tools,
             messages=messages,
-            tools=tools,
+            tools=get_tools(),
         ) 
         tool_calls = response.choices[0].message.tool_calls
 
@@ -475,7 +837,7 @@ class Orchestrator:
                 messages.append(response.choices[0].message)
 
                 # Call the function directly
-                tool_result = self.call_function(tool_name, tool_args)          
+                tool_result = await self.call_function(tool_name, tool_args)          
 
                 # Append the result of the tool call
                 messages.append({
@@ -487,15 +849,17 @@ class Orchestrator:
             return messages
         return None
     
-    def route_orchestrator_request(self, user_input: str) -> GeneralFlowRequestType:
+    @coalesce(llm_call_flights)
+    @instrument_stage("agent", "router", tokens=lambda result: result[1])
+    async def route_orchestrator_request(self, user_input: str) -> GeneralFlowRequestType:
         """Router LLM call to determine the flow of the request"""
   
-        completion = client.beta.chat.completions.parse(
+        completion = await client.beta.chat.completions.parse(
             model=model,
             messages=[
                 {
                     "role": "system",
-                    "content": "Determine if this is a request to response a question or analyze information or apply an action like schedule an appointment.",
+                    "content": ROUTER_PROMPT,
                 },
                 {"role": "user", "content": user_input},
             ],
@@ -512,10 +876,31 @@ class Orchestrator:
         raise ValueError(f"Failes to route the request route_orchestrator_request")
     
        
-    def route_action(self, investigation_result: str) -> RequestAction:
+    async def route_request(self, user_input: str, query_text: str):
+        """Route with the local router when it is confident about query_text, with route_orchestrator_request otherwise.
+        Returns (route, tokens, tool): tool is LOCAL_ROUTE_TOOL for a local route, "" for the LLM router"""
+        if LOCAL_ROUTER_ENABLED and local_router.is_ready(embed_model):
+            try:
+                query_vector = await self.get_query_embedding(token_budget.truncate(query_text, EMBED_MAX_TOKENS))
+                request_type, score = local_router.predict(query_vector)
+                if score >= local_router.threshold:
+                    local_router.record(local=True)
+                    logger.info(f"Request routed locally as: {request_type} with confidence: {score}")
+                    return GeneralFlowRequestType(request_type=request_type, confidence_score=score), 0, LOCAL_ROUTE_TOOL
+                logger.info(f"Local router not confident ({request_type} {score}), routing with the LLM")
+            except Exception as e:
+                logger.error(f"Local router failed, routing with the LLM: {e}")
+            local_router.record(local=False)
+
+        route, tokens = await self.route_orchestrator_request(user_input)
+        return route, tokens, ""
+
+    @coalesce(llm_call_flights)
+    @instrument_stage("agent", "action_router", tokens=lambda result: result[1])
+    async def route_action(self, investigation_result: str) -> RequestAction:
         """Router LLM call to determine action to apply"""
 
-        completion = client.beta.chat.completions.parse(
+        completion = await client.beta.chat.completions.parse(
             model=model,
             messages=[
                 {
@@ -536,9 +921,71 @@ class Orchestrator:
         logging.error(f"Error routing request")
         raise ValueError(f"Failes to route the request route_orchestrator_request") 
     
-    def get_RAG_context(self, query: str, table, num_results: int = 3) -> str:
-        """Search the RAG database for context of the information to search in investigation"""
-        results = table.search(query).limit(num_results).to_pandas()
+    async def embed_texts(self, texts: List[str]) -> List[List[float]]:
+        """Embedding call for a batch of texts with the model of the RAG table"""
+        response = await client.embeddings.create(model=embed_model, input=texts)
+        return [item.embedding for item in response.data]
+
+    @coalesce(llm_call_flights)
+    async def get_query_embedding(self, query: str):
+        """Query vector from the embedding cache, computed only on a cache miss"""
+        vectors = await embedding_cache.embed(embed_model, [query], self.embed_texts)
+        return vectors[0]
+
+    async def search_RAG(self, query: str, table, num_results: int = 3, query_vector=None,
+                         nprobes: Optional[int] = RAG_NPROBES, refine_factor: Optional[int] = RAG_REFINE_FACTOR,
+                         mode: str = RAG_SEARCH_MODE, vector_candidates: int = RAG_VECTOR_CANDIDATES,
+                         fts_candidates: int = RAG_FTS_CANDIDATES) -> "pd.DataFrame":
+        """Search the RAG table. Returns the best num_results chunks, best first.
+
+        mode="vector": ANN search with the metric the index was built with; nprobes / refine_factor tune the
+        index search (see lancedb_index.py bench).
+        mode="hybrid": vector_candidates from the vector search and fts_candidates from the BM25 full-text index
+        of the text column (lancedb_index.py fts), fused with reciprocal rank fusion."""
+        if query_vector is None:
+            query_vector = await self.get_query_embedding(query)
+
+        start_time = time.perf_counter()
+        search = table.vector_search(query_vector).limit(vector_candidates if mode == "hybrid" else num_results)
+        if rag_table.distance_type:
+            search = search.distance_type(rag_table.distance_type)
+        if nprobes:
+            search = search.nprobes(nprobes)
+        if refine_factor:
+            search = search.refine_factor(refine_factor)
+
+        if mode != "hybrid":
+            results = await search.to_pandas()
+            rag_table.search_latency.observe(time.perf_counter() - start_time)
+            return results
+
+        fts_search = (await table.search(query, query_type="fts")).limit(fts_candidates).with_row_id()
+        vector_results, fts_results = await asyncio.gather(
+            search.with_row_id().to_pandas(),
+            fts_search.to_pandas(),
+            return_exceptions=True,
+        )
+        if isinstance(vector_results, Exception):
+            raise vector_results
+        if isinstance(fts_results, Exception):
+            logger.warning(f"Full-text search failed, using vector results only (is the FTS index built?): {fts_results}")
+            fts_results = vector_results.iloc[0:0]
+
+        rows = {}
+        for frame in (fts_results, vector_results):
+            for _, row in frame.iterrows():
+                rows[row["_rowid"]] = row
+        fused = reciprocal_rank_fusion(
+            [vector_results["_rowid"].tolist(), fts_results["_rowid"].tolist()], k=RAG_RRF_K
+        )[:num_results]
+        rag_table.search_latency.observe(time.perf_counter() - start_time)
+        logger.info(f"Hybrid search: {len(vector_results)} vector + {len(fts_results)} fts candidates fused to {len(fused)}")
+
+        import pandas as pd
+        return pd.DataFrame([rows[row_id] for row_id, _ in fused]).reset_index(drop=True)
+
+    def format_RAG_context(self, results: "pd.DataFrame") -> List[str]:
+        """One context string (text + source + title) per retrieved chunk"""
         contexts = []
 
         for _, row in results.iterrows():
@@ -564,25 +1011,27 @@ class Orchestrator:
 
             contexts.append(f"{row['text']}{source}")
 
-        return "\n\n".join(contexts)
+        return contexts
 
+    async def get_RAG_context(self, query: str, table, num_results: int = 3, query_vector=None, **search_options) -> str:
+        """Search the RAG database for context of the information to search in investigation. query_vector skips the query embedding"""
+        results = await self.search_RAG(query, table, num_results, query_vector, **search_options)
+        return "\n\n".join(self.format_RAG_context(results))
 
-    def get_RAG_response(self, context, results) -> InvestigationResponse:
+
+    @instrument_stage("agent", "rag_llm", tokens=lambda result: result.tokens)
+    async def get_RAG_response(self, context, results) -> InvestigationResponse:
         """Get streaming response with the documenation found in RAG. """
         next_step = ""
         message_response = ""
         sucess = False
 
-        system_prompt = f"""You are a helpful assistant that analyze medical test results from documents and give recommendations or next steps.
-        Use only the information from the context to answer questions. If you're unsure or the context
-        doesn't contain the relevant information, say so.     
-        """
-        completion = client.beta.chat.completions.parse(
+        completion = await client.beta.chat.completions.parse(
             model=model,
             messages=[
                 {
                     "role": "system",
-                    "content": system_prompt,
+                    "content": RAG_SYSTEM_PROMPT,
                 },
                 {"role": "user", "content": "Find information related with " + results + " in the context" +  context },
             ],
@@ -612,13 +1061,32 @@ class Orchestrator:
             confidence_score=details.confidence_score,
         )       
             
-    def handle_analyze_test_results(self, results: str) -> InvestigationResponse:
-        """LLM call to get the investigation, search and analysis of the medical test results"""
+    @instrument_stage("agent", "retrieval")
+    async def retrieve_RAG_chunks(self, results: str) -> List[str]:
+        """Retrieval step of handle_analyze_test_results: RAG chunks for the request, best first"""
 
         # Initialize database connection
-        table = self.init_RAG_db()
+        table = await self.init_RAG_db()
 
-        context = self.get_RAG_context("Check all the information about medical questions " + results, table)
+        # The embedding model accepts at most EMBED_MAX_TOKENS
+        query = token_budget.truncate("Check all the information about medical questions " + results, EMBED_MAX_TOKENS)
+        return self.format_RAG_context(await self.search_RAG(query, table))
+
+    async def handle_analyze_test_results(self, results: str, chunks: Optional[List[str]] = None) -> InvestigationResponse:
+        """LLM call to get the investigation, search and analysis of the medical test results.
+        chunks are the already retrieved RAG chunks for results (retrieved here if None)"""
+
+        if chunks is None:
+            chunks = await self.retrieve_RAG_chunks(results)
+
+        # Drop the lowest ranked chunks that do not fit in the call budget
+        fitted = token_budget.allocate(
+            "rag_response",
+            TOKEN_BUDGET_ANALYSIS,
+            required=[RAG_SYSTEM_PROMPT, "Find information related with " + results + " in the context"],
+            optional=[("chunks", chunks)],
+        )
+        context = "\n\n".join(fitted["chunks"])
 
         for chunk in context.split("\n\n"): 
             # Split into text and metadata parts
@@ -630,13 +1098,14 @@ class Orchestrator:
                 if ": " in line
             }
 
-        response = self.get_RAG_response(context, results)   
+        response = await self.get_RAG_response(context, results)   
         logger.info(f"Search completed")      
         return response
             
         
     
-    def handle_send_email_notification(self, description: str) -> ActionResponse:
+    @instrument_stage("agent", "tool_call", tokens=lambda result: result.tokens)
+    async def handle_send_email_notification(self, description: str) -> ActionResponse:
         """LLM call the function/tool to apply the action to send an email notification, extracing the information from the user message or prompt"""
         next_step = ""
         response_message = ""
@@ -650,9 +1119,9 @@ class Orchestrator:
                 {"role": "user", "content": "Please send an email to email@notificacion.com explaing to the patient the analysis about the tests results, describe in a positive way the results and the plan to apply" + description}
             ]
                 
-        messages = self.call_tool(messages)
+        messages = await self.call_tool(messages)
         
-        completion = client.beta.chat.completions.parse(
+        completion = await client.beta.chat.completions.parse(
             model=model,
             messages=messages,
             response_format=EmailRequestType,
@@ -679,7 +1148,8 @@ class Orchestrator:
             confidence_score=details.confidence_score,       
         )       
     
-    def handle_call_API(self, description: str) -> ActionResponse:
+    @instrument_stage("agent", "tool_call", tokens=lambda result: result.tokens)
+    async def handle_call_API(self, description: str) -> ActionResponse:
         """LLM call the function/tool to apply the action to call an API, extracing the information from the user message or prompt"""
         next_step = ""
         response_message = ""
@@ -693,9 +1163,9 @@ class Orchestrator:
                 {"role": "user", "content": "Call the API https://jsonplaceholder.typicode.com/posts, method POST and payload parameters in the description " + description}
             ]
                 
-        messages = self.call_tool(messages)
+        messages = await self.call_tool(messages)
         
-        completion = client.beta.chat.completions.parse(
+        completion = await client.beta.chat.completions.parse(
             model=model,
             messages=messages,
             response_format=APIRequestType,
@@ -722,42 +1192,66 @@ class Orchestrator:
             confidence_score=details.confidence_score,            
         )      
 
-    def handle_synthesized_response(self, investigation_result: str, action_result: str) -> str:
-        """LLM call the function/tool to consolidate the information for user response"""
-
-        
-        completion = client.beta.chat.completions.parse(
-            model=model,
-            messages=[
-                {
-                    "role": "system",
-                    "content": SYNTHESIZED_PROMPT.format(
-                        investigation_result=investigation_result.text,
-                        action_result = action_result,
-                       
-                    ),
-                }
-            ],            
+    async def stream_completion(self, on_event: Emit, **kwargs):
+        """Streaming chat completion: emits every token as a "token" event. Returns the full content and the total tokens"""
+        stream = await client.chat.completions.create(
+            stream=True,
+            stream_options={"include_usage": True},
+            **kwargs,
         )
-           
-        details= completion.choices[0].message.content
+        parts = []
+        total_tokens = 0
+        async for chunk in stream:
+            if chunk.usage:
+                total_tokens = chunk.usage.total_tokens
+            if chunk.choices and chunk.choices[0].delta.content:
+                parts.append(chunk.choices[0].delta.content)
+                _emit_event(on_event, "token", {"text": chunk.choices[0].delta.content})
+        return "".join(parts), total_tokens
+
+    async def handle_synthesized_response(self, investigation_result: str, action_result: str, on_event: Optional[Emit] = None,
+                                          session_id: Optional[str] = None):
+        """LLM call the function/tool to consolidate the information for user response. With on_event the answer is streamed.
+        The summary of the answer is kept in the history of the session. Returns (answer, tokens, summary)"""
 
-        history_response, history_tokens = self.handle_summary_history_response(investigation_result, action_result)
+        messages=[
+            {
+                "role": "system",
+                "content": SYNTHESIZED_PROMPT.format(
+                    investigation_result=investigation_result.text,
+                    action_result = action_result,
+                   
+                ),
+            }
+        ]
+        @instrument_stage("agent", "synthesis", tokens=lambda result: result[1])
+        async def synthesize():
+            if on_event is None:
+                completion = await client.beta.chat.completions.parse(
+                    model=model,
+                    messages=messages,            
+                )
+                return completion.choices[0].message.content, completion.usage.total_tokens
+            return await self.stream_completion(on_event, model=model, messages=messages)
+
+        # The history summary does not depend on the answer: both calls run concurrently
+        (details, synthesized_tokens), (history_response, history_tokens) = await asyncio.gather(
+            synthesize(), self.handle_summary_history_response(investigation_result, action_result)
+        )
 
-        memory = Agent_memory.load_memory_from_file(memory_file)  
-        memory.add_message("assistant", history_response)
-        Agent_memory.save_memory_to_file(memory_file, memory)
+        add_agent_memory(session_id, history_response)
 
         logger.info(f"Executed synthesized response")
 
         print("Answer ", details)
 
-        return details, completion.usage.total_tokens + history_tokens
+        return details, synthesized_tokens + history_tokens, history_response
     
-    def handle_summary_history_response(self, investigation_result: str, action_result: str) -> str:
+    @instrument_stage("agent", "history_summary", tokens=lambda result: result[1])
+    async def handle_summary_history_response(self, investigation_result: str, action_result: str) -> str:
         """LLM call the function/tool to summary the information for historical context"""
 
-        completion = client.beta.chat.completions.parse(
+        completion = await client.beta.chat.completions.parse(
             model=model,
             messages=[
                 {
@@ -775,12 +1269,12 @@ class Orchestrator:
 
         return details, completion.usage.total_tokens
     
-    def apply_action(self, investigation_result: str) -> Optional[ActionResponse]:
+    async def apply_action(self, investigation_result: str) -> Optional[ActionResponse]:
         """Function implementing the process workflow for the type of action to apply according to user input or prompt"""
         logger.info("Processing validating type of action")
 
         # Route the request
-        route_result, tokens = self.route_action(investigation_result)
+        route_result, tokens = await self.route_action(investigation_result)
 
 
         # Check confidence threshold
@@ -790,15 +1284,113 @@ class Orchestrator:
         
         # Route to appropriate handler
         if route_result.request_type == "send_email_notification":
-            return self.handle_send_email_notification(investigation_result), tokens
+            return await self.handle_send_email_notification(investigation_result), tokens
         elif route_result.request_type == "call_API":
-            return self.handle_call_API(investigation_result), tokens
+            return await self.handle_call_API(investigation_result), tokens
         else:
-            return self.handle_send_email_notification(investigation_result), tokens
+            return await self.handle_send_email_notification(investigation_result), tokens
         
 
-    def process_agent(self, input: str) -> Dict:
-        """Main function implementing the entire process routing workflow following flexible flow depend of the user message or prompt"""
+    @instrument_stage("agent", "semantic_cache")
+    async def lookup_semantic_cache(self, query: str):
+        """Closest cached answer of the question on the current table version.
+        Returns (entry or None, similarity, query vector, table version); the vector and version are None if the lookup failed"""
+        try:
+            query_vector = await self.get_query_embedding(token_budget.truncate(query, EMBED_MAX_TOKENS))
+            table = await self.init_RAG_db()
+            table_version = await table.version()
+        except Exception as e:
+            logger.error(f"Semantic cache lookup failed: {e}")
+            return None, 0.0, None, None
+
+        cached, similarity = await asyncio.to_thread(semantic_cache.lookup, embed_model, query_vector, table_version, query)
+        logger.info(f"Semantic cache {'hit' if cached else 'miss'} with similarity {similarity:.3f} {semantic_cache.stats()}")
+        return cached, similarity, query_vector, table_version
+
+    async def serve_semantic_cache_hit(self, cached: Dict, similarity: float, on_event: Optional[Emit], session_id: str,
+                                       report_metrics, metrics_rows, datetime_request: float) -> str:
+        """Answer from the semantic cache: emits it as the streamed answer, keeps its history summary in memory
+        (the same one a computed answer leaves) and saves the metrics"""
+        investigation_result = InvestigationResponse.model_validate_json(cached["investigation"])
+        answer = cached["answer"]
+        _emit_event(on_event, "stage", {"stage": "cache_hit", "similarity": similarity, "source": investigation_result.source})
+        _emit_event(on_event, "token", {"text": answer})
+
+        summary = cached.get("summary")
+        if summary is None:
+            # Entry cached before the summary was kept
+            summary, _ = await self.handle_summary_history_response(investigation_result, None)
+        add_agent_memory(session_id, summary)
+
+        total_time_request = time.time() - datetime_request
+        report_metrics.update_total_time(metrics_rows, total_time_request)
+        report_metrics.save_file_df(metrics_rows)
+        logger.info(f"Executed agent from the semantic cache (question: {cached['query']}) in {total_time_request} seconds")
+        return answer
+
+    @instrument_stage("agent", "attachment_index")
+    async def index_attachment(self, attachment: str) -> AttachmentIndex:
+        """Chunks of the attachment embedded in batch into an in-memory index (one chunk, not embedded, if it is small).
+        The index of the same file is reused by the follow-up requests"""
+        key = AttachmentIndexCache.make_key(embed_model, attachment)
+        index = attachment_indexes.get(key)
+        if index is not None:
+            return index
+
+        chunks, tokens = await cpu_offload.run(
+            "attachment_chunk", split_attachment, attachment, embed_model, ATTACHMENT_INLINE_TOKENS,
+            ATTACHMENT_CHUNK_TOKENS, ATTACHMENT_CHUNK_OVERLAP, size=len(attachment),
+        )
+        index = await AttachmentIndex.build(chunks, tokens, self.embed_texts, ATTACHMENT_EMBED_BATCH)
+        attachment_indexes.set(key, index)
+        logger.info(f"Attachment of {tokens} tokens indexed in {len(chunks)} chunks")
+        return index
+
+    async def attachment_is_chunked(self, attachment: str) -> bool:
+        """Whether index_attachment chunks and embeds the attachment (same token count as split_attachment)"""
+        index = attachment_indexes.get(AttachmentIndexCache.make_key(embed_model, attachment))
+        if index is not None:
+            return index.embedded
+        tokens = await cpu_offload.run("attachment_chunk", count_tokens, attachment, embed_model, size=len(attachment))
+        return tokens > ATTACHMENT_INLINE_TOKENS
+
+    def attachment_chunks(self, attachment_index: Optional[AttachmentIndex], query_vector, top_k: int) -> List[str]:
+        """The top_k chunks of the attachment for the question, best first (the whole attachment if it was not chunked)"""
+        if attachment_index is None:
+            return []
+        return attachment_index.search(query_vector, top_k)
+
+    def build_stage_input(self, input: str, request_type: str, history: List[str],
+                          attachment_index: Optional[AttachmentIndex], query_vector) -> str:
+        """Input of the stage of request_type: the history (oldest first) and then the attachment chunks of the stage
+        fitted in its budget (the least relevant chunks are dropped first)"""
+        if request_type == "apply_action":
+            stage_budget, stage_token_budget = TOKEN_BUDGET_ACTION, action_token_budget
+            top_k = ATTACHMENT_ACTION_CHUNKS
+        else:
+            stage_budget, stage_token_budget = TOKEN_BUDGET_ANALYSIS - TOKEN_BUDGET_RAG_CONTEXT, token_budget
+            top_k = ATTACHMENT_ANALYSIS_CHUNKS
+        chunks = self.attachment_chunks(attachment_index, query_vector, top_k)
+        fitted = stage_token_budget.allocate(
+            request_type,
+            stage_budget,
+            required=[input + " " + request_type],
+            optional=[("history", history), ("attachment", chunks)],
+        )
+        past_content = format_past_content(list(reversed(fitted["history"])))
+        attachment = attachment_index.in_document_order(fitted["attachment"]) if attachment_index else []
+        return input + format_attachment(attachment) + " " + request_type + past_content
+
+    @instrument_stage("agent", "request")
+    async def process_agent(self, input: str, on_event: Optional[Emit] = None, attachment: Optional[str] = None,
+                            session_id: Optional[str] = None) -> Dict:
+        """Main function implementing the entire process routing workflow following flexible flow depend of the user message or prompt.
+        on_event receives the stage events (routed, retrieved, acted) and the synthesized answer tokens for streaming.
+        The attachment is indexed in chunks: each stage gets its most relevant chunks, fitted with the history
+        in the token budget of the call.
+        The history is the one of session_id (a new session without history if None)"""
+
+        session_id = session_id or uuid.uuid4().hex
        
         investigation_result = None
         action_result = None        
@@ -813,28 +1405,67 @@ class Orchestrator:
         confidence = 0
         calls_api = 0
         response = ""
-        report_metrics = rf.ReportFiles()
-        df_metrics = report_metrics.create_report_metrics()
-
-        past_context = get_agent_memory()  
-        # Extract and concatenate only the content field
-        past_content = " ".join([msg["content"] for msg in past_context])
-        past_content = past_content.replace("\n", " ")   
-        past_content = past_content.replace("\r", " ")  
-        past_content = past_content.replace("  ", " ")        
-
-        if past_content.strip() != "":
-            past_content = ". This is the context of the previous or historical request to analyze results:" + past_content
+        report_metrics = rf.ReportFiles(report_metrics_file, reports_dir, header, sink=metrics_sink)
+        metrics_rows = report_metrics.create_report_metrics()
+
+        past_context = get_agent_memory(session_id) or []
+        # Extract only the content field, most recent first (the budget drops the oldest messages first)
+        history = [msg["content"] for msg in reversed(past_context)]
+        attachment = attachment or ""
+
+        # Standalone questions (no attachment, no history) can be answered from the semantic cache
+        cache_vector = None
+        table_version = None
+        if SEMANTIC_CACHE_ENABLED and not attachment and not history:
+            start_time = time.time()
+            cached, similarity, cache_vector, table_version = await self.lookup_semantic_cache(input)
+            report_metrics.add_report_metrics(metrics_rows, datetime_request, input_prompt, "semantic_cache", tool, cached is not None, time.time() - start_time, similarity, 0, calls_api, "hit" if cached else "miss")
+            if cached is not None:
+                return await self.serve_semantic_cache_hit(cached, similarity, on_event, session_id, report_metrics, metrics_rows, datetime_request)
         
        
+        # Stages of the request: routing, and the retrieval of analyze_test_results (most of the traffic)
+        # started speculatively at the same time, discarded if the request is routed elsewhere
+        stages = StageGraph()
         try:       
             logger.info("Processing general flow")
             start_time = time.time()                        
         
+            attachment_index = None
+            query_vector = None
+            if attachment:
+                # The question is embedded while the attachment is chunked and embedded (attachments of at most
+                # ATTACHMENT_INLINE_TOKENS tokens, as counted by split_attachment, are never chunked and need no query vector)
+                query_task = None
+                if await self.attachment_is_chunked(attachment):
+                    query_task = asyncio.create_task(self.get_query_embedding(input))
+                try:
+                    attachment_index = await self.index_attachment(attachment)
+                    if attachment_index.embedded:
+                        query_vector = await (query_task or self.get_query_embedding(input))
+                finally:
+                    if query_task is not None and not query_task.done():
+                        query_task.cancel()
+                report_metrics.add_report_metrics(metrics_rows, datetime_request, input_prompt, "attachment_index", tool, True, time.time() - start_time, 1, 0, calls_api, f"{len(attachment_index.chunks)} chunks, {attachment_index.tokens} tokens")
+                _emit_event(on_event, "stage", {"stage": "attachment_indexed", "chunks": len(attachment_index.chunks), "tokens": attachment_index.tokens})
+
             # Route the request
-            route_result, tokens = self.route_orchestrator_request(input)
+            fitted = token_budget.allocate(
+                "router", TOKEN_BUDGET_ROUTER, required=[ROUTER_PROMPT, input],
+                optional=[("attachment", self.attachment_chunks(attachment_index, query_vector, ATTACHMENT_ROUTER_CHUNKS))]
+            )
+            router_input = input + format_attachment(attachment_index.in_document_order(fitted["attachment"]) if attachment_index else [])
+            # The metrics keep what the router saw, the local router is trained on it
+            input_prompt = router_input
+            stages.add("route", lambda: self.route_request(router_input, router_input))
+            if SPECULATIVE_RETRIEVAL:
+                speculative_input = self.build_stage_input(input, "analyze_test_results", history, attachment_index, query_vector)
+                stages.add("retrieve", lambda: self.retrieve_RAG_chunks(speculative_input))
+            # The metrics rows of a locally routed request are marked so the local router is never retrained on them
+            route_result, tokens, tool = await stages.result("route")
 
             print(f"Routed to: {route_result.request_type} with confidence {route_result.confidence_score}")
+            _emit_event(on_event, "stage", {"stage": "routed", "request_type": route_result.request_type, "confidence": route_result.confidence_score})
 
             if route_result == None or route_result.request_type == "other":
                 logger.warning("Request classified as other")
@@ -846,12 +1477,21 @@ class Orchestrator:
                 print("Low confidence score")
                 return None
             
-            input = input + " " + route_result.request_type + past_content
+            input = self.build_stage_input(input, route_result.request_type, history, attachment_index, query_vector)
             step = route_result.request_type
             print(f"Input for processing: {input}")
 
+            chunks = None
+            if SPECULATIVE_RETRIEVAL:
+                if route_result.request_type == "analyze_test_results":
+                    # Same stage input as the speculative retrieval
+                    chunks = await stages.result("retrieve")
+                else:
+                    stages.discard("retrieve")
+
             if route_result.request_type == "analyze_test_results" or route_result.request_type == "response_question":     
-                investigation_result = self.handle_analyze_test_results(input)
+                investigation_result = await self.handle_analyze_test_results(input, chunks)
+                _emit_event(on_event, "stage", {"stage": "retrieved", "success": investigation_result.success, "source": investigation_result.source})
                 print_investigation("Investigation " , investigation_result)
                 if investigation_result:                     
                     logger.info(f"Test results {investigation_result.message}")
@@ -863,7 +1503,8 @@ class Orchestrator:
                     response = investigation_result.message
 
             if route_result.request_type == "apply_action":  
-                action_result, tokens_router = self.apply_action(input)                    
+                action_result, tokens_router = await self.apply_action(input)                    
+                _emit_event(on_event, "stage", {"stage": "acted", "success": action_result.success if action_result else False})
                 if action_result:                        
                     logger.info(f"Apply action {action_result.message}")
                     print_action(action_result)
@@ -873,32 +1514,41 @@ class Orchestrator:
                     tokens += action_result.tokens + tokens_router
                     response = action_result.message
 
-        except (ValueError, TypeError, BadRequestError) as e:
+        except (ValueError, TypeError, *openai_request_errors()) as e:
             logger.info("Error in processing the request in agent " + str(e))
             success = False
             confidence = 0
             tokens += 0
             response = "Error in processing the request " + str(e)
+        finally:
+            stages.close()
+            logger.info(f"Stage latencies {stages.timings}")
             
         # Check and save metrics in the report file
         end_time = time.time()             
         latency = end_time - start_time   
-        report_metrics.add_report_metrics(df_metrics, datetime_request, input_prompt, step, tool, "", success, latency, confidence, tokens, calls_api, response) 
+        report_metrics.add_report_metrics(metrics_rows, datetime_request, input_prompt, step, tool, success, latency, confidence, tokens, calls_api, response) 
 
         start_time = time.time()  
         # Call the synthesizer to consolidate the information for user response            
-        synthesized_result, tokens_synthesized = self.handle_synthesized_response(investigation_result, action_result)
+        synthesized_result, tokens_synthesized, history_summary = await self.handle_synthesized_response(investigation_result, action_result, on_event, session_id)
         
         end_time = time.time()
         latency = end_time - start_time       
         # Add the metrics for the synthesized result
-        report_metrics.add_report_metrics(df_metrics, datetime_request, input_prompt, "synthesized_result", tool, "", True, latency, 1, tokens_synthesized, calls_api, synthesized_result) 
+        report_metrics.add_report_metrics(metrics_rows, datetime_request, input_prompt, "synthesized_result", tool, True, latency, 1, tokens_synthesized, calls_api, synthesized_result) 
+
+        if cache_vector is not None and step in ("analyze_test_results", "response_question") and investigation_result and investigation_result.success:
+            await asyncio.to_thread(
+                semantic_cache.store, embed_model, input_prompt, cache_vector, table_version,
+                investigation_result.model_dump_json(), synthesized_result, history_summary,
+            )
 
         total_time_request = time.time() - datetime_request
 
-        report_metrics.update_total_time(df_metrics,total_time_request)
+        report_metrics.update_total_time(metrics_rows,total_time_request)
         # Save the report file with the metrics
-        report_metrics.save_file_df(df_metrics) 
+        report_metrics.save_file_df(metrics_rows) 
 
         logger.info(f"Executed agent with total time {total_time_request} seconds and {tokens} tokens")            
 
@@ -910,18 +1560,50 @@ class Orchestrator:
 # ##### Test 
 
 # %%
-def agent_process_request(prompt_text: str,
-    file_content: str = None) -> str:
+async def async_agent_process_session(prompt_text: str,
+    file_content: str = None,
+    on_event: Optional[Emit] = None,
+    session_id: Optional[str] = None) -> Tuple[str, str]:
+    """(answer, session_id) of the agent flow. A new session is started if session_id is None, its id is
+    sent first as a "session" event to streaming callers."""
 
-    clean_agent_memory()
-    input = prompt_text 
-    
-    if file_content:        
-        input += " analyze also the below content attached " + file_content
     orchestrator = Orchestrator()
-    return orchestrator.process_agent(
-        input=input
 
-    )
+    async def run(emit: Optional[Emit], flow_session_id: str) -> Tuple[str, str]:
+        _emit_event(emit, "session", {"session_id": flow_session_id})
+        # The attachment is passed apart so every stage can fit it in its token budget
+        answer = await orchestrator.process_agent(
+            input=prompt_text,
+            on_event=emit,
+            attachment=file_content,
+            session_id=flow_session_id
+        )
+        return answer, flow_session_id
+
+    if session_id is None:
+        # Every caller without a session gets its own: two users sending the same first message must never
+        # share a memory. Only the stateless LLM sub-calls (routing, embeddings) are coalesced for them
+        return await run(on_event, uuid.uuid4().hex)
+
+    # Identical requests of the same session in flight (double submit) share one run of the flow
+    key = canonical_key(prompt_text, file_content, session_id, on_event is not None)
+    return await agent_flights.run(key, lambda emit: run(emit, session_id), on_event)
+
+async def async_agent_process_request(prompt_text: str,
+    file_content: str = None,
+    on_event: Optional[Emit] = None,
+    session_id: Optional[str] = None) -> str:
+    answer, _ = await async_agent_process_session(prompt_text, file_content, on_event, session_id)
+    return answer
+
+def agent_process_request(prompt_text: str,
+    file_content: str = None,
+    session_id: Optional[str] = None) -> str:
+    """Sync wrapper of the agent flow for scripts and notebooks (runs on the shared background event loop)."""
+    return background_loop.run(async_agent_process_request(
+        prompt_text=prompt_text,
+        file_content=file_content,
+        session_id=session_id
+    ))
 
 
@@ -1,54 +1,117 @@
-from typing import Optional
-import chardet
+from typing import Optional, Tuple, Union
 import Agent_orchestrator
+from utils.cpu_offload import cpu_offload, decode_text
+from utils.sse import Emit
 
 
 def bytes_to_string(file_content: Optional[bytes]) -> Optional[str]:
     if file_content is None:
         return None
-    detected = chardet.detect(file_content)
-    encoding = detected.get("encoding", "utf-8")
-    return file_content.decode(encoding, errors="replace")
+    return cpu_offload.run_sync("decode_upload", decode_text, file_content, size=len(file_content))
+
+
+async def async_bytes_to_string(file_content: Optional[Union[bytes, str]]) -> Optional[str]:
+    """bytes_to_string without blocking the event loop: large uploads are decoded in the CPU offload pool.
+    Text already decoded while the upload was streamed (utils/uploads.py) is returned as is."""
+    if file_content is None or isinstance(file_content, str):
+        return file_content
+    return await cpu_offload.run("decode_upload", decode_text, file_content, size=len(file_content))
+
+
+def _answer_to_str(answer, message_if_none: str) -> str:
+    if answer is None:
+        return message_if_none
+    if not isinstance(answer, str):
+        return str(answer)
+    return answer
+
+
+async def async_agent_request_process_session(
+    prompt_text: str,
+    file_content: Optional[Union[bytes, str]] = None,
+    on_event: Optional[Emit] = None,
+    session_id: Optional[str] = None
+) -> Tuple[str, str]:
+    """(answer, session_id): the session is the one started by the flow when session_id is None."""
+    file_str = await async_bytes_to_string(file_content) if file_content else None
+    answer, session_id = await Agent_orchestrator.async_agent_process_session(
+        prompt_text=prompt_text,
+        file_content=file_str,
+        on_event=on_event,
+        session_id=session_id
+    )
+
+    return _answer_to_str(answer, "The agent returned no answer."), session_id
+
+
+async def async_agent_request_process(
+    prompt_text: str,
+    file_content: Optional[Union[bytes, str]] = None,
+    on_event: Optional[Emit] = None,
+    session_id: Optional[str] = None
+) -> str:
+    answer, _ = await async_agent_request_process_session(prompt_text, file_content, on_event, session_id)
+    return answer
 
 
 def agent_request_process(
     prompt_text: str,
-    file_content: Optional[bytes] = None
+    file_content: Optional[bytes] = None,
+    session_id: Optional[str] = None
 ) -> str:
     if file_content:
         file_str = bytes_to_string(file_content)
         answer = Agent_orchestrator.agent_process_request(
             prompt_text=prompt_text,
-            file_content=file_str
+            file_content=file_str,
+            session_id=session_id
         )
     else:
         answer = Agent_orchestrator.agent_process_request(
             prompt_text=prompt_text,
-            file_content=None
+            file_content=None,
+            session_id=session_id
         )
 
-    if answer is None:
-        return "The agent returned no answer."
-    if not isinstance(answer, str):
-        return str(answer)
-    return answer
+    return _answer_to_str(answer, "The agent returned no answer.")
 
 
 # NEW: Creative reaction request (image + headline + personas)
+async def async_creative_reaction_request_process(
+    headline: str,
+    personas_json: str,
+    image_bytes: bytes,
+    image_mime: str = "image/png",
+    fan_out: bool = False,
+    use_cache: bool = True,
+    on_event: Optional[Emit] = None
+) -> str:
+    answer = await Agent_orchestrator.async_creative_reaction_process_request(
+        headline=headline,
+        personas_json=personas_json,
+        image_bytes=image_bytes,
+        image_mime=image_mime,
+        fan_out=fan_out,
+        use_cache=use_cache,
+        on_event=on_event
+    )
+    return _answer_to_str(answer, "The creative reaction agent returned no answer.")
+
+
 def creative_reaction_request_process(
     headline: str,
     personas_json: str,
     image_bytes: bytes,
-    image_mime: str = "image/png"
+    image_mime: str = "image/png",
+    fan_out: bool = False,
+    use_cache: bool = True
 ) -> str:
     answer = Agent_orchestrator.creative_reaction_process_request(
         headline=headline,
         personas_json=personas_json,
         image_bytes=image_bytes,
-        image_mime=image_mime
+        image_mime=image_mime,
+        fan_out=fan_out,
+        use_cache=use_cache
     )
-    if answer is None:
-        return "The creative reaction agent returned no answer."
-    if not isinstance(answer, str):
-        return str(answer)
-    return answer
\ No newline at end of file
+    return _answer_to_str(answer, "The creative reaction agent returned no answer.")
\ No newline at end of file
@@ -17,6 +17,7 @@ const Index = () => {
   const [isLoading, setIsLoading] = useState(false);
   const [attachedFile, setAttachedFile] = useState<File | null>(null);
   const [showUploadArea, setShowUploadArea] = useState(false);
+  const sessionIdRef = useRef<string | null>(null);
   const messagesEndRef = useRef<HTMLDivElement>(null);
 
   const scrollToBottom = () => {
@@ -43,6 +44,9 @@ const Index = () => {
   try {
     const formData = new FormData();
     formData.append("prompt_text", message);
+    if (sessionIdRef.current) {
+      formData.append("session_id", sessionIdRef.current);
+    }
 
     if (file) {
       formData.append("file", file);
@@ -58,8 +62,11 @@ const Index = () => {
       throw new Error(`API error: ${response.status}`);
 
     }
-    type AgentResponse = { answer: string };
+    type AgentResponse = { answer: string; session_id?: string };
     const data = (await response.json()) as AgentResponse;
+    if (data.session_id) {
+      sessionIdRef.current = data.session_id;
+    }
 
     const assistantMessage: Message = {
       id: (Date.now() + 1).toString(),
@@ -1,52 +1,210 @@
+"""
+Ingest the docling LanceDB table into the Azure AI Search index (see azure_search_setup.py).
+
+    python azure_search_ingest_from_lancedb.py
+    python azure_search_ingest_from_lancedb.py --batch-size 256 --embed-batch 64 --concurrency 4
+    python azure_search_ingest_from_lancedb.py --restart
+
+The table is streamed as Arrow record batches of --batch-size rows (text and metadata columns only, never
+the whole table in memory). Each batch is embedded with one request per --embed-batch texts and upserted
+with merge_or_upload_documents; up to --concurrency batches are embedded and uploaded at the same time
+while the next ones are read.
+
+Document ids are the sha256 of source and text: re-running the ingest updates the same documents instead
+of creating duplicates. The rows done are checkpointed after every batch (all batches before it included),
+an interrupted run resumes from there. The checkpoint is discarded when the table version changes.
+"""
+import argparse
+import hashlib
+import json
 import os
-import uuid
-from dotenv import load_dotenv
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Dict, List
+
+import lancedb
 from azure.core.credentials import AzureKeyCredential
 from azure.search.documents import SearchClient
-from openai import OpenAI
-import lancedb
+from dotenv import load_dotenv
+
+from utils.llm_client import create_sync_client
 
 load_dotenv()
 
-oai = OpenAI(
-    api_key=os.getenv("AZURE_FDRY_KEY"),
-    base_url=os.getenv("AZURE_FDRY_ENDPOINT").rstrip("/") + "/openai/v1/"
-)
-embed_deployment = os.getenv("AZURE_OPENAI_EMBED_DEPLOYMENT")
-
-search_client = SearchClient(
-    endpoint=os.getenv("AZURE_SEARCH_ENDPOINT"),
-    index_name=os.getenv("AZURE_SEARCH_INDEX"),
-    credential=AzureKeyCredential(os.getenv("AZURE_SEARCH_ADMIN_KEY"))
-)
-
-# Load LanceDB table
-db = lancedb.connect("data/lancedb")
-table = db.open_table("docling")
-df = table.to_pandas()   # contains 'text' and 'metadata' (your current structure)
-
-batch = []
-for i, row in df.iterrows():
-    text = row["text"]
-    md = row.get("metadata", {}) or {}
-    source = md.get("url") or md.get("filename") or "unknown"
-    title = md.get("title") or ""
-
-    emb = oai.embeddings.create(model=embed_deployment, input=text).data[0].embedding
-
-    batch.append({
-        "id": str(uuid.uuid4()),
-        "text": text,
-        "source": source,
-        "title": title,
-        "embedding": emb
-    })
-
-    if len(batch) >= 100:
-        search_client.upload_documents(batch)
-        batch = []
-
-if batch:
-    search_client.upload_documents(batch)
-
-print("Done uploading.")
\ No newline at end of file
+DB_PATH = "data/lancedb"
+TABLE_NAME = "docling"
+CHECKPOINT_PATH = "reports/azure_ingest_checkpoint.json"
+# Azure AI Search accepts at most 1000 documents per indexing request
+MAX_UPLOAD_DOCUMENTS = 1000
+
+
+def document_id(source: str, text: str) -> str:
+    """Content-derived id (hex only, a valid Azure Search key)."""
+    return hashlib.sha256(f"{source}\0{text}".encode("utf-8")).hexdigest()
+
+
+def to_documents(rows: List[Dict]) -> List[Dict]:
+    documents = []
+    for row in rows:
+        text = row.get("text") or ""
+        if not text.strip():
+            continue
+        md = row.get("metadata") or {}
+        source = md.get("url") or md.get("filename") or "unknown"
+        documents.append({
+            "id": document_id(source, text),
+            "text": text,
+            "source": source,
+            "title": md.get("title") or "",
+        })
+    return documents
+
+
+def new_checkpoint(table) -> Dict:
+    return {"table": table.name, "table_version": table.version, "rows_done": 0, "documents": 0}
+
+
+def load_checkpoint(path: str, table) -> Dict:
+    if os.path.exists(path):
+        with open(path, "r", encoding="utf-8") as f:
+            checkpoint = json.load(f)
+        if checkpoint.get("table") == table.name and checkpoint.get("table_version") == table.version:
+            return checkpoint
+        print(f"Checkpoint {path} is for another table or table version, starting over")
+    return new_checkpoint(table)
+
+
+def save_checkpoint(path: str, checkpoint: Dict):
+    """Written to a temporary file and renamed: an interrupted write never leaves a broken checkpoint."""
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(checkpoint, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+class Ingest:
+    def __init__(self, oai, search_client, embed_deployment: str, embed_batch: int):
+        self.oai = oai
+        self.search_client = search_client
+        self.embed_deployment = embed_deployment
+        self.embed_batch = embed_batch
+
+    def embed(self, texts: List[str]) -> List[List[float]]:
+        vectors = []
+        for start in range(0, len(texts), self.embed_batch):
+            response = self.oai.embeddings.create(model=self.embed_deployment, input=texts[start:start + self.embed_batch])
+            vectors.extend(item.embedding for item in sorted(response.data, key=lambda item: item.index))
+        return vectors
+
+    def upload(self, documents: List[Dict]):
+        for start in range(0, len(documents), MAX_UPLOAD_DOCUMENTS):
+            results = self.search_client.merge_or_upload_documents(documents[start:start + MAX_UPLOAD_DOCUMENTS])
+            failed = [result.key for result in results if not result.succeeded]
+            if failed:
+                raise RuntimeError(f"{len(failed)} documents were not indexed (first: {failed[0]})")
+
+    def process(self, rows: List[Dict]) -> Dict:
+        """Embed and upsert one batch of rows. Returns its document count and the time of each step."""
+        documents = to_documents(rows)
+        start_time = time.perf_counter()
+        vectors = self.embed([document["text"] for document in documents]) if documents else []
+        embed_seconds = time.perf_counter() - start_time
+        for document, vector in zip(documents, vectors):
+            document["embedding"] = vector
+        start_time = time.perf_counter()
+        if documents:
+            self.upload(documents)
+        upload_seconds = time.perf_counter() - start_time
+        return {"rows": len(rows), "documents": len(documents), "embed_seconds": embed_seconds, "upload_seconds": upload_seconds}
+
+
+def run(ingest: Ingest, table, checkpoint_path: str, batch_size: int, concurrency: int, restart: bool = False) -> Dict:
+    total_rows = table.count_rows()
+    checkpoint = new_checkpoint(table) if restart else load_checkpoint(checkpoint_path, table)
+    if checkpoint["rows_done"]:
+        print(f"Resuming after {checkpoint['rows_done']}/{total_rows} rows ({checkpoint['documents']} documents already indexed)")
+
+    batches = table.search().select(["text", "metadata"]).offset(checkpoint["rows_done"]).limit(None).to_batches(batch_size)
+    # Batches finish out of order: the checkpoint only moves past a batch once all the batches before it are done
+    pending, finished = {}, {}
+    next_batch = 0
+    documents = embed_seconds = upload_seconds = 0
+    start_time = time.perf_counter()
+
+    def collect(done):
+        nonlocal next_batch, documents, embed_seconds, upload_seconds
+        error = None
+        for future in done:
+            number = pending.pop(future)
+            if future.exception() is not None:
+                error = error or future.exception()
+            else:
+                finished[number] = future.result()
+        # The batches done are checkpointed before a failure is raised
+        while next_batch in finished:
+            result = finished.pop(next_batch)
+            next_batch += 1
+            checkpoint["rows_done"] += result["rows"]
+            checkpoint["documents"] += result["documents"]
+            documents += result["documents"]
+            embed_seconds += result["embed_seconds"]
+            upload_seconds += result["upload_seconds"]
+            save_checkpoint(checkpoint_path, checkpoint)
+            elapsed = time.perf_counter() - start_time
+            print(f"{checkpoint['rows_done']}/{total_rows} rows, {documents} documents in {elapsed:.1f}s "
+                  f"({documents / elapsed if elapsed else 0:.1f} docs/sec)")
+        if error is not None:
+            raise error
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        try:
+            for number, batch in enumerate(batches):
+                # At most one batch read ahead per worker
+                while len(pending) >= concurrency * 2:
+                    collect(wait(pending, return_when=FIRST_COMPLETED).done)
+                pending[pool.submit(ingest.process, batch.to_pylist())] = number
+            while pending:
+                collect(wait(pending, return_when=FIRST_COMPLETED).done)
+        except BaseException:
+            for future in pending:
+                future.cancel()
+            raise
+
+    elapsed = time.perf_counter() - start_time
+    return {
+        "rows": checkpoint["rows_done"],
+        "documents": documents,
+        "seconds": round(elapsed, 2),
+        "docs_per_sec": round(documents / elapsed, 1) if elapsed else 0.0,
+        "embed_seconds": round(embed_seconds, 2),
+        "upload_seconds": round(upload_seconds, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--db-path", default=DB_PATH)
+    parser.add_argument("--table", default=TABLE_NAME)
+    parser.add_argument("--batch-size", type=int, default=256, help="rows read, embedded and uploaded together")
+    parser.add_argument("--embed-batch", type=int, default=64, help="texts per embedding request")
+    parser.add_argument("--concurrency", type=int, default=4, help="batches embedded and uploaded at the same time")
+    parser.add_argument("--checkpoint", default=CHECKPOINT_PATH)
+    parser.add_argument("--restart", action="store_true", help="ignore the checkpoint and ingest the whole table")
+    args = parser.parse_args()
+
+    search_client = SearchClient(
+        endpoint=os.getenv("AZURE_SEARCH_ENDPOINT"),
+        index_name=os.getenv("AZURE_SEARCH_INDEX"),
+        credential=AzureKeyCredential(os.getenv("AZURE_SEARCH_ADMIN_KEY"))
+    )
+    ingest = Ingest(create_sync_client(azure=True), search_client, os.getenv("AZURE_OPENAI_EMBED_DEPLOYMENT"), args.embed_batch)
+    table = lancedb.connect(args.db_path).open_table(args.table)
+
+    report = run(ingest, table, args.checkpoint, args.batch_size, max(1, args.concurrency), args.restart)
+    print(f"Done uploading: {report['documents']} documents in {report['seconds']}s ({report['docs_per_sec']} docs/sec, "
+          f"embedding {report['embed_seconds']}s, upload {report['upload_seconds']}s summed over the workers)")
+
+
+if __name__ == "__main__":
+    main()
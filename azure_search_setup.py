@@ -6,15 +6,12 @@ from azure.search.documents.indexes.models import (
     SearchIndex, SimpleField, SearchableField, VectorSearch, VectorSearchProfile,
     HnswAlgorithmConfiguration, VectorSearchAlgorithmKind, SearchField, SearchFieldDataType
 )
-from openai import OpenAI
+from utils.llm_client import create_sync_client
 
 load_dotenv()
 
-# Azure OpenAI client (same as in your orchestrator)
-oai = OpenAI(
-    api_key=os.getenv("AZURE_FDRY_KEY"),
-    base_url=os.getenv("AZURE_FDRY_ENDPOINT").rstrip("/") + "/openai/v1/"
-)
+# Azure OpenAI client (same pool, timeouts and retries as the orchestrator)
+oai = create_sync_client(azure=True)
 embed_deployment = os.getenv("AZURE_OPENAI_EMBED_DEPLOYMENT")
 
 # Determine embedding dimension programmatically
@@ -0,0 +1,167 @@
+"""
+Vector index management and recall/latency benchmark for the docling LanceDB table.
+
+    python lancedb_index.py build --index-type IVF_PQ --num-partitions 64 --num-sub-vectors 96
+    python lancedb_index.py bench --k 3 --nprobes 10 20 50 --refine-factor 0 5 10
+    python lancedb_index.py fts
+
+The benchmark uses vectors of the table itself as queries, so it does not call the embedding API:
+recall@k is measured against a brute force search (bypass_vector_index) and the p50/p99 latencies
+of both are reported for every (nprobes, refine_factor) setting. The chosen settings are passed
+to get_RAG_context with the RAG_NPROBES / RAG_REFINE_FACTOR environment variables.
+
+The metric given to build is stored in the index by LanceDB: get_RAG_context and the benchmark read it
+back and search with the same distance type.
+
+The full-text (BM25) index on the text column is required by RAG_SEARCH_MODE=hybrid.
+"""
+import argparse
+import math
+import time
+
+import numpy as np
+import lancedb
+
+DB_PATH = "data/lancedb"
+TABLE_NAME = "docling"
+VECTOR_COLUMN = "vector"
+TEXT_COLUMN = "text"
+# PQ trains 256 centroids per sub-vector: smaller tables are better served by the flat scan
+MIN_ROWS_FOR_INDEX = 256
+
+
+def open_table(db_path: str = DB_PATH, table_name: str = TABLE_NAME):
+    return lancedb.connect(db_path).open_table(table_name)
+
+
+def build_index(table, index_type: str = "IVF_PQ", metric: str = "l2", num_partitions: int = None,
+                num_sub_vectors: int = None, force: bool = False):
+    """Build (or rebuild, replacing the current one) the vector index of the table."""
+    num_rows = table.count_rows()
+    if num_rows < MIN_ROWS_FOR_INDEX and not force:
+        print(f"Table has {num_rows} rows (< {MIN_ROWS_FOR_INDEX}): a flat scan is exact and fast enough, index not built. Use --force to build it anyway.")
+        return None
+
+    dim = table.schema.field(VECTOR_COLUMN).type.list_size
+    # Defaults: ~sqrt(rows) partitions and 16 dimensions per PQ sub-vector
+    num_partitions = num_partitions or max(1, int(math.sqrt(num_rows)))
+    num_sub_vectors = num_sub_vectors or max(1, dim // 16)
+
+    start_time = time.perf_counter()
+    table.create_index(
+        metric=metric,
+        vector_column_name=VECTOR_COLUMN,
+        index_type=index_type,
+        num_partitions=num_partitions,
+        num_sub_vectors=num_sub_vectors,
+        replace=True,
+    )
+    elapsed = time.perf_counter() - start_time
+    print(f"Built {index_type} index ({metric}, partitions={num_partitions}, sub_vectors={num_sub_vectors}) on {num_rows} rows in {elapsed:.1f}s")
+    return table.list_indices()
+
+
+def index_metric(table) -> str:
+    """Metric the vector index was built with (stored by LanceDB in the index), l2 when there is no index."""
+    for index in table.list_indices():
+        if VECTOR_COLUMN in index.columns:
+            return table.index_stats(index.name).distance_type
+    return "l2"
+
+
+def build_fts_index(table):
+    """Build (or rebuild) the native BM25 full-text index of the text column used by the hybrid search."""
+    start_time = time.perf_counter()
+    table.create_fts_index(TEXT_COLUMN, replace=True, use_tantivy=False)
+    print(f"Built full-text index on '{TEXT_COLUMN}' in {time.perf_counter() - start_time:.1f}s")
+    return table.list_indices()
+
+
+def sample_query_vectors(table, num_queries: int, seed: int = 42) -> np.ndarray:
+    vectors = np.stack(table.to_arrow().column(VECTOR_COLUMN).to_numpy(zero_copy_only=False))
+    rng = np.random.default_rng(seed)
+    idx = rng.choice(len(vectors), size=min(num_queries, len(vectors)), replace=False)
+    return vectors[idx]
+
+
+def _search_ids(query, k: int):
+    start_time = time.perf_counter()
+    ids = query.limit(k).with_row_id(True).to_arrow().column("_rowid").to_pylist()
+    return ids, time.perf_counter() - start_time
+
+
+def benchmark(table, k: int = 3, num_queries: int = 100, nprobes_values=(20,), refine_values=(0,)):
+    """recall@k of the indexed search against brute force, with p50/p99 latency in ms for each setting.
+    Both use the metric of the index, like get_RAG_context."""
+    queries = sample_query_vectors(table, num_queries)
+    metric = index_metric(table)
+    print(f"Searching with the {metric} metric of the index")
+
+    exact_ids = []
+    exact_latency = []
+    for vector in queries:
+        ids, latency = _search_ids(table.search(vector, vector_column_name=VECTOR_COLUMN).distance_type(metric).bypass_vector_index(), k)
+        exact_ids.append(set(ids))
+        exact_latency.append(latency)
+
+    rows = [{
+        "setting": "brute_force",
+        f"recall@{k}": 1.0,
+        "p50_ms": float(np.percentile(exact_latency, 50) * 1000),
+        "p99_ms": float(np.percentile(exact_latency, 99) * 1000),
+    }]
+
+    for nprobes in nprobes_values:
+        for refine_factor in refine_values:
+            recalls = []
+            latencies = []
+            for vector, expected in zip(queries, exact_ids):
+                query = table.search(vector, vector_column_name=VECTOR_COLUMN).distance_type(metric).nprobes(nprobes)
+                if refine_factor:
+                    query = query.refine_factor(refine_factor)
+                ids, latency = _search_ids(query, k)
+                recalls.append(len(expected.intersection(ids)) / max(1, len(expected)))
+                latencies.append(latency)
+            rows.append({
+                "setting": f"nprobes={nprobes} refine_factor={refine_factor}",
+                f"recall@{k}": float(np.mean(recalls)),
+                "p50_ms": float(np.percentile(latencies, 50) * 1000),
+                "p99_ms": float(np.percentile(latencies, 99) * 1000),
+            })
+
+    print(f"{'setting':<32} {'recall@' + str(k):>10} {'p50_ms':>10} {'p99_ms':>10}")
+    for row in rows:
+        print(f"{row['setting']:<32} {row[f'recall@{k}']:>10.3f} {row['p50_ms']:>10.2f} {row['p99_ms']:>10.2f}")
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Vector index tooling for the docling LanceDB table")
+    parser.add_argument("--db-path", default=DB_PATH)
+    parser.add_argument("--table", default=TABLE_NAME)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    build_parser = subparsers.add_parser("build", help="Build or rebuild the vector index")
+    build_parser.add_argument("--index-type", default="IVF_PQ", choices=["IVF_PQ", "IVF_HNSW_SQ", "IVF_HNSW_PQ", "IVF_FLAT"])
+    build_parser.add_argument("--metric", default="l2", choices=["l2", "cosine", "dot"])
+    build_parser.add_argument("--num-partitions", type=int, default=None)
+    build_parser.add_argument("--num-sub-vectors", type=int, default=None)
+    build_parser.add_argument("--force", action="store_true", help="Build even on small tables")
+
+    bench_parser = subparsers.add_parser("bench", help="recall@k and latency against brute force")
+    bench_parser.add_argument("--k", type=int, default=3)
+    bench_parser.add_argument("--num-queries", type=int, default=100)
+    bench_parser.add_argument("--nprobes", type=int, nargs="+", default=[10, 20, 50])
+    bench_parser.add_argument("--refine-factor", type=int, nargs="+", default=[0, 5])
+
+    subparsers.add_parser("fts", help="Build or rebuild the full-text index of the text column (hybrid search)")
+
+    args = parser.parse_args()
+    table = open_table(args.db_path, args.table)
+
+    if args.command == "build":
+        build_index(table, args.index_type, args.metric, args.num_partitions, args.num_sub_vectors, args.force)
+    elif args.command == "fts":
+        build_fts_index(table)
+    else:
+        benchmark(table, args.k, args.num_queries, args.nprobes, args.refine_factor)
@@ -0,0 +1,64 @@
+"""
+Latency, token and success rate summary of the request metrics history.
+
+    python metrics_report.py summary --since 24h
+    python metrics_report.py summary --since 2026-01-01 --until 2026-02-01 --group-by Step --engine duckdb
+    python metrics_report.py import-csv
+
+summary reads the Parquet segments written by the metrics sink (reports/metrics) with a pyarrow
+dataset: only the summary columns are loaded and the time window is pushed down to the row group
+statistics. import-csv converts the legacy reports/report_metrics.csv into one segment, so the
+history written before the sink is part of the summaries. The sink also exports its rows to that CSV
+(METRICS_CSV_EXPORT=1, the default, the local router is trained from it): the rows already in a segment,
+matched on (Datetime_request, Step), are skipped so they are never counted twice.
+"""
+import argparse
+import json
+import os
+import time
+
+from utils.metrics_query import GROUP_COLUMNS, import_csv_report, parse_time, summarize_metrics
+
+METRICS_DIR = os.getenv("METRICS_DIR", os.path.join("reports", "metrics"))
+CSV_REPORT = os.path.join("reports", "report_metrics.csv")
+
+
+def print_summary(rows, group_by):
+    columns = list(group_by) + ["requests", "success_rate", "latency_p50", "latency_p95", "latency_p99", "tokens_total", "tokens_avg"]
+    widths = [max(len(column), 24 if column in GROUP_COLUMNS else 12) for column in columns]
+    print(" ".join(f"{column:>{width}}" for column, width in zip(columns, widths)))
+    for row in rows:
+        values = []
+        for column, width in zip(columns, widths):
+            value = row[column]
+            values.append(f"{value:>{width}.3f}" if isinstance(value, float) else f"{str(value):>{width}}")
+        print(" ".join(values))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Summary of the request metrics history")
+    parser.add_argument("--metrics-dir", default=METRICS_DIR)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    summary_parser = subparsers.add_parser("summary", help="p50/p95/p99 latency, tokens and success rate per Step/Tool")
+    summary_parser.add_argument("--since", help="Start of the window: 15m, 24h, 7d or an ISO date")
+    summary_parser.add_argument("--until", help="End of the window (excluded): same formats as --since")
+    summary_parser.add_argument("--group-by", nargs="+", default=list(GROUP_COLUMNS), choices=list(GROUP_COLUMNS))
+    summary_parser.add_argument("--engine", default="arrow", choices=["arrow", "duckdb"])
+    summary_parser.add_argument("--json", action="store_true", help="Print the rows as JSON")
+
+    import_parser = subparsers.add_parser("import-csv", help="Convert the CSV report into a metrics segment")
+    import_parser.add_argument("--csv", default=CSV_REPORT)
+
+    args = parser.parse_args()
+    if args.command == "import-csv":
+        path = import_csv_report(args.csv, args.metrics_dir)
+        print(f"Imported {args.csv} into {path}" if path else f"No rows of {args.csv} to import (all already in the metrics segments)")
+    else:
+        start_time = time.perf_counter()
+        rows = summarize_metrics(args.metrics_dir, parse_time(args.since), parse_time(args.until), args.group_by, args.engine)
+        if args.json:
+            print(json.dumps(rows, indent=2))
+        else:
+            print_summary(rows, args.group_by)
+            print(f"{len(rows)} groups in {(time.perf_counter() - start_time) * 1000:.1f} ms")
@@ -0,0 +1,98 @@
+"""
+Startup benchmark: import time of the agent modules and latency of the first API request.
+
+    python startup_benchmark.py --runs 5
+    python startup_benchmark.py --runs 3 --prompt "What does a high white blood cell count mean?"
+
+Every run is a fresh Python process (like a uvicorn reload or a new worker) that measures:
+    import_orchestrator  import Agent_orchestrator
+    import_api           import Agent_API (with the orchestrator already imported)
+    startup              FastAPI startup events (LanceDB table open, batch job resume)
+    first_request        first request: GET /rag/stats, or POST /agent/process with --prompt (calls the LLM)
+The medians are printed and appended to reports/startup_benchmark.csv with the current git commit, so
+regressions can be tracked over time.
+"""
+import argparse
+import csv
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+RESULTS_FILE = os.path.join("reports", "startup_benchmark.csv")
+STAGES = ["import_orchestrator", "import_api", "startup", "first_request"]
+
+
+def measure(prompt: str = None):
+    """One run, in the current process (must be a fresh interpreter)."""
+    timings = {}
+    start_time = time.perf_counter()
+    import Agent_orchestrator  # noqa: F401
+    timings["import_orchestrator"] = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    import Agent_API
+    timings["import_api"] = time.perf_counter() - start_time
+
+    from fastapi.testclient import TestClient
+
+    start_time = time.perf_counter()
+    with TestClient(Agent_API.app) as test_client:
+        timings["startup"] = time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+        if prompt:
+            response = test_client.post("/agent/process", data={"prompt_text": prompt})
+        else:
+            response = test_client.get("/rag/stats")
+        timings["first_request"] = time.perf_counter() - start_time
+        timings["status_code"] = response.status_code
+    return timings
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+def run_benchmark(runs: int, prompt: str = None):
+    results = []
+    for _ in range(runs):
+        command = [sys.executable, __file__, "--measure"] + (["--prompt", prompt] if prompt else [])
+        output = subprocess.run(command, capture_output=True, text=True, check=True).stdout
+        results.append(json.loads(output.strip().splitlines()[-1]))
+
+    medians = {stage: statistics.median(result[stage] for result in results) for stage in STAGES}
+    print(f"{'stage':<22} {'median_ms':>10} {'min_ms':>10} {'max_ms':>10}")
+    for stage in STAGES:
+        values = [result[stage] * 1000 for result in results]
+        print(f"{stage:<22} {medians[stage] * 1000:>10.1f} {min(values):>10.1f} {max(values):>10.1f}")
+    print(f"First request: {'POST /agent/process' if prompt else 'GET /rag/stats'}, status {results[-1]['status_code']}")
+
+    os.makedirs(os.path.dirname(RESULTS_FILE), exist_ok=True)
+    new_file = not os.path.exists(RESULTS_FILE)
+    with open(RESULTS_FILE, "a", newline="") as f:
+        writer = csv.writer(f)
+        if new_file:
+            writer.writerow(["datetime", "commit", "runs", "request"] + STAGES)
+        writer.writerow(
+            [time.strftime("%Y-%m-%d %H:%M:%S"), git_commit(), runs, "agent_process" if prompt else "rag_stats"]
+            + [round(medians[stage], 4) for stage in STAGES]
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Import time and first-request latency of the agent API")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--prompt", help="Measure a real /agent/process request (calls the LLM) instead of /rag/stats")
+    parser.add_argument("--measure", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure:
+        print(json.dumps(measure(args.prompt)))
+    else:
+        run_benchmark(args.runs, args.prompt)
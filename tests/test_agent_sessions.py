@@ -0,0 +1,44 @@
+import asyncio
+
+import Agent_orchestrator
+
+
+def test_concurrent_sessionless_requests_get_their_own_session(monkeypatch):
+    runs = []
+
+    async def process_agent(self, input, on_event=None, attachment=None, session_id=None):
+        runs.append(session_id)
+        await asyncio.sleep(0.05)
+        return "answer"
+
+    monkeypatch.setattr(Agent_orchestrator.Orchestrator, "process_agent", process_agent)
+
+    async def main():
+        return await asyncio.gather(
+            Agent_orchestrator.async_agent_process_session("What does high WBC mean?"),
+            Agent_orchestrator.async_agent_process_session("What does high WBC mean?"),
+        )
+
+    (_, first_session), (_, second_session) = asyncio.run(main())
+    assert first_session != second_session
+    assert sorted(runs) == sorted([first_session, second_session])
+
+
+def test_concurrent_requests_of_one_session_share_one_run(monkeypatch):
+    runs = []
+
+    async def process_agent(self, input, on_event=None, attachment=None, session_id=None):
+        runs.append(session_id)
+        await asyncio.sleep(0.05)
+        return "answer"
+
+    monkeypatch.setattr(Agent_orchestrator.Orchestrator, "process_agent", process_agent)
+
+    async def main():
+        return await asyncio.gather(
+            Agent_orchestrator.async_agent_process_session("What does high WBC mean?", session_id="s1"),
+            Agent_orchestrator.async_agent_process_session("What does high WBC mean?", session_id="s1"),
+        )
+
+    assert asyncio.run(main()) == [("answer", "s1"), ("answer", "s1")]
+    assert runs == ["s1"]
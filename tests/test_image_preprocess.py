@@ -0,0 +1,30 @@
+import io
+
+from PIL import Image
+
+from utils.image_preprocess import preprocess_image
+
+
+def png_bytes(width: int, height: int) -> bytes:
+    buffer = io.BytesIO()
+    Image.new("RGB", (width, height)).save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def test_decompression_bomb_is_sent_as_is(monkeypatch):
+    image_bytes = png_bytes(200, 200)
+    # Over twice the pixel limit Pillow raises DecompressionBombError instead of warning
+    monkeypatch.setattr(Image, "MAX_IMAGE_PIXELS", 10_000)
+
+    data_url, stats = preprocess_image(image_bytes, "image/png", 768, "JPEG", 85)
+
+    assert data_url.startswith("data:image/png;base64,")
+    assert stats["processed_bytes"] == len(image_bytes)
+    assert "error" in stats
+
+
+def test_large_image_is_resized_for_the_vision_model():
+    _, stats = preprocess_image(png_bytes(4000, 3000), "image/png", 768, "JPEG", 85)
+
+    assert stats["processed_size"] == [1024, 768]
+    assert stats["original_tokens"] == stats["processed_tokens"]
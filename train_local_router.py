@@ -0,0 +1,101 @@
+"""
+Train and evaluate the local request router (utils/local_router.py) from the metrics report.
+
+    python train_local_router.py train
+    python train_local_router.py eval --folds 5 --thresholds 0.6 0.8 0.9 0.95
+
+The labels are the Step chosen by the LLM router (route_orchestrator_request) for every request in
+reports/report_metrics.csv; the requests routed by the local router itself (Tool "local_router") are
+skipped. eval measures the agreement of the local router with those labels by cross-validation (each
+fold is scored by centroids trained on the other folds): for each threshold, the share of requests
+answered locally (coverage), the agreement on them and the latency of a prediction.
+The query embeddings come from the shared embedding cache, so only new prompts call the embedding API.
+"""
+import argparse
+import time
+from typing import get_args
+
+import numpy as np
+
+import Agent_orchestrator as ao
+from utils.background_loop import background_loop
+from utils.local_router import NearestCentroidRouter, load_route_examples
+
+REPORT_PATH = "reports/report_metrics.csv"
+ROUTE_LABELS = [label for label in get_args(ao.GeneralFlowRequestType.model_fields["request_type"].annotation) if label != "other"]
+EMBED_BATCH_SIZE = 64
+
+
+async def embed_prompts(prompts):
+    orchestrator = ao.Orchestrator()
+    texts = [ao.token_budget.truncate(prompt, ao.EMBED_MAX_TOKENS) for prompt in prompts]
+    vectors = []
+    for i in range(0, len(texts), EMBED_BATCH_SIZE):
+        vectors.extend(await ao.embedding_cache.embed(ao.embed_model, texts[i:i + EMBED_BATCH_SIZE], orchestrator.embed_texts))
+    return np.stack(vectors)
+
+
+def load_dataset(report_path: str):
+    prompts, labels = load_route_examples(report_path, ROUTE_LABELS)
+    if not prompts:
+        raise SystemExit(f"No routed requests in {report_path}")
+    vectors = background_loop.run(embed_prompts(prompts))
+    print(f"{len(prompts)} requests: " + ", ".join(f"{label}={labels.count(label)}" for label in sorted(set(labels))))
+    return vectors, labels
+
+
+def train(report_path: str, model_path: str):
+    vectors, labels = load_dataset(report_path)
+    router = NearestCentroidRouter(model_path).fit(vectors, labels, ao.embed_model)
+    router.save()
+    print(f"Saved local router with labels {router.labels} to {model_path}")
+
+
+def evaluate(report_path: str, folds: int, thresholds, seed: int = 42):
+    vectors, labels = load_dataset(report_path)
+    labels = np.asarray(labels)
+    order = np.random.default_rng(seed).permutation(len(labels))
+    predictions = np.empty(len(labels), dtype=object)
+    scores = np.zeros(len(labels))
+    evaluated = np.zeros(len(labels), dtype=bool)
+    latencies = []
+
+    for fold in np.array_split(order, min(folds, len(labels))):
+        train_idx = np.setdiff1d(order, fold)
+        if len(set(labels[train_idx])) < 2:
+            continue
+        router = NearestCentroidRouter("").fit(vectors[train_idx], labels[train_idx].tolist(), ao.embed_model)
+        for i in fold:
+            start_time = time.perf_counter()
+            predictions[i], scores[i] = router.predict(vectors[i])
+            evaluated[i] = True
+            latencies.append(time.perf_counter() - start_time)
+
+    agree = (predictions == labels) & evaluated
+    print(f"Overall agreement with the LLM router: {agree.sum() / max(1, evaluated.sum()):.3f} "
+          f"({evaluated.sum()} requests, prediction p50 {np.percentile(latencies, 50) * 1e6:.0f}us)")
+    print(f"{'threshold':>10} {'coverage':>10} {'agreement':>10} {'local':>8}")
+    for threshold in thresholds:
+        local = evaluated & (scores >= threshold)
+        coverage = local.sum() / max(1, evaluated.sum())
+        agreement = agree[local].sum() / local.sum() if local.sum() else float("nan")
+        print(f"{threshold:>10.2f} {coverage:>10.3f} {agreement:>10.3f} {local.sum():>8}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local request router trained from the metrics report")
+    parser.add_argument("--report", default=REPORT_PATH)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    train_parser = subparsers.add_parser("train", help="Build the centroids from all the routed requests")
+    train_parser.add_argument("--output", default=ao.local_router.path)
+
+    eval_parser = subparsers.add_parser("eval", help="Cross-validated agreement with the LLM router")
+    eval_parser.add_argument("--folds", type=int, default=5)
+    eval_parser.add_argument("--thresholds", type=float, nargs="+", default=[0.6, 0.8, 0.9, 0.95, 0.99])
+
+    args = parser.parse_args()
+    if args.command == "train":
+        train(args.report, args.output)
+    else:
+        evaluate(args.report, args.folds, args.thresholds)
@@ -0,0 +1,138 @@
+import asyncio
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Awaitable, Callable, List, Optional, Tuple
+
+import numpy as np
+
+from utils.token_budget import get_model_encoding
+
+
+def chunk_text(text: str, model: str, chunk_tokens: int = 400, overlap_tokens: int = 50) -> List[str]:
+    """Chunks of about chunk_tokens tokens (tiktoken encoding of model), cut at line ends so a lab value stays
+    with its test name. Each chunk repeats the last lines of the previous one, up to overlap_tokens.
+    Module-level so it can run in the CPU offload process pool."""
+    encoding = get_model_encoding(model)
+    chunks, current, current_tokens = [], [], 0
+
+    def pieces(line: str):
+        tokens = encoding.encode(line, disallowed_special=())
+        if len(tokens) <= chunk_tokens:
+            yield line, len(tokens)
+            return
+        # A line longer than a chunk (no line breaks in the file) is cut in token windows
+        for start in range(0, len(tokens), chunk_tokens):
+            window = tokens[start:start + chunk_tokens]
+            yield encoding.decode(window), len(window)
+
+    for line in text.splitlines(keepends=True):
+        if not line.strip():
+            if current:
+                current.append((line, 0))
+            continue
+        for piece, tokens in pieces(line):
+            if current and current_tokens + tokens > chunk_tokens:
+                chunks.append("".join(part for part, _ in current).strip())
+                carried, carried_tokens = [], 0
+                for part, part_tokens in reversed(current):
+                    if carried_tokens + part_tokens > overlap_tokens:
+                        break
+                    carried.insert(0, (part, part_tokens))
+                    carried_tokens += part_tokens
+                current, current_tokens = carried, carried_tokens
+            current.append((piece, tokens))
+            current_tokens += tokens
+    if current:
+        chunks.append("".join(part for part, _ in current).strip())
+    return [chunk for chunk in chunks if chunk]
+
+
+def count_tokens(text: str, model: str) -> int:
+    return len(get_model_encoding(model).encode(text, disallowed_special=()))
+
+
+def split_attachment(text: str, model: str, inline_tokens: int, chunk_tokens: int = 400,
+                     overlap_tokens: int = 50) -> Tuple[List[str], int]:
+    """(chunks, tokens) of an attachment: the whole text as one chunk when it has at most inline_tokens tokens."""
+    tokens = count_tokens(text, model)
+    if tokens <= inline_tokens:
+        return [text], tokens
+    return chunk_text(text, model, chunk_tokens, overlap_tokens), tokens
+
+
+class AttachmentIndex:
+    """In-memory vector index of the chunks of one attachment.
+
+    Attachments up to inline_tokens are kept whole as a single chunk and never embedded: every stage gets
+    all of it. Larger ones are chunked and embedded in batches, and each stage gets the chunks closest
+    to its query instead of the whole file."""
+
+    def __init__(self, chunks: List[str], vectors: Optional[np.ndarray] = None, tokens: int = 0):
+        self.chunks = chunks
+        self.tokens = tokens
+        self._positions = {chunk: position for position, chunk in enumerate(chunks)}
+        self._matrix = None
+        if vectors is not None and len(vectors):
+            norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+            self._matrix = vectors / np.where(norms == 0, 1, norms)
+
+    @property
+    def embedded(self) -> bool:
+        return self._matrix is not None
+
+    @classmethod
+    async def build(cls, chunks: List[str], tokens: int,
+                    embed: Callable[[List[str]], Awaitable[List[List[float]]]], batch_size: int = 256) -> "AttachmentIndex":
+        """Index of chunks embedded with embed(texts), batch_size chunks per call (the calls run concurrently)."""
+        if len(chunks) <= 1:
+            return cls(chunks, tokens=tokens)
+        batches = [chunks[start:start + batch_size] for start in range(0, len(chunks), batch_size)]
+        results = await asyncio.gather(*(embed(batch) for batch in batches))
+        vectors = np.asarray([vector for result in results for vector in result], dtype=np.float32)
+        return cls(chunks, vectors, tokens)
+
+    def search(self, query_vector, top_k: int) -> List[str]:
+        """The top_k chunks closest to the query, best first (all chunks of an index that is not embedded)."""
+        if self._matrix is None:
+            return list(self.chunks)
+        top_k = max(1, min(top_k, len(self.chunks)))
+        if query_vector is None:
+            return self.chunks[:top_k]
+        query = np.asarray(query_vector, dtype=np.float32)
+        norm = np.linalg.norm(query)
+        similarities = self._matrix @ (query / norm if norm else query)
+        best = np.argpartition(-similarities, top_k - 1)[:top_k]
+        return [self.chunks[position] for position in best[np.argsort(-similarities[best])]]
+
+    def in_document_order(self, chunks: List[str]) -> List[str]:
+        """Chunks sorted as they appear in the attachment, to be read by the LLM."""
+        return sorted(chunks, key=lambda chunk: self._positions.get(chunk, 0))
+
+
+class AttachmentIndexCache:
+    """Indexes of the last attachments by content hash: follow-up requests with the same file reuse the
+    chunks and vectors. Kept in memory only, uploaded reports are never written to disk."""
+
+    def __init__(self, max_entries: int = 32):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, AttachmentIndex]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(model: str, text: str) -> str:
+        return hashlib.sha256(f"{model}\0{text}".encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[AttachmentIndex]:
+        with self._lock:
+            index = self._entries.get(key)
+            if index is not None:
+                self._entries.move_to_end(key)
+            return index
+
+    def set(self, key: str, index: AttachmentIndex):
+        with self._lock:
+            self._entries[key] = index
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
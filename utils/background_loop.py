@@ -0,0 +1,39 @@
+import asyncio
+import threading
+from typing import Any, Awaitable, Optional
+
+
+class BackgroundLoop:
+    """One event loop per process, running in a daemon thread, for the sync entry points.
+
+    asyncio.run() would start a new loop on every call while the module-level AsyncOpenAI/httpx client,
+    the rate limiters and the single-flight tasks stay bound to the loop that first used them. Running
+    every sync call on the same long-lived loop keeps them valid across calls."""
+
+    def __init__(self, name: str = "orchestrator-loop"):
+        self.name = name
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._lock = threading.Lock()
+
+    def _get_loop(self) -> asyncio.AbstractEventLoop:
+        with self._lock:
+            if self._loop is None:
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, name=self.name, daemon=True).start()
+                self._loop = loop
+            return self._loop
+
+    def run(self, coro: Awaitable) -> Any:
+        """Run coro on the background loop and wait for its result (from any thread but the loop's own)."""
+        loop = self._get_loop()
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is loop:
+            coro.close()
+            raise RuntimeError("BackgroundLoop.run() called from its own loop, await the coroutine instead")
+        return asyncio.run_coroutine_threadsafe(coro, loop).result()
+
+
+background_loop = BackgroundLoop()
@@ -0,0 +1,173 @@
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from utils.prometheus_metrics import observe_stage
+
+logger = logging.getLogger(__name__)
+
+# "process": payloads above the task threshold run in a process pool, "thread": in the default thread pool,
+# "inline": everything runs in the caller (the behaviour before the offload)
+CPU_OFFLOAD_MODE = os.getenv("CPU_OFFLOAD_MODE", "process")
+CPU_POOL_WORKERS = int(os.getenv("CPU_POOL_WORKERS", str(min(4, os.cpu_count() or 1))))
+# spawn: the workers import only utils modules, never the state of the API process
+CPU_POOL_START_METHOD = os.getenv("CPU_POOL_START_METHOD", "spawn")
+
+# Payload size (bytes) from which a task leaves the request thread. Below it the IPC costs more than the work
+TASK_THRESHOLDS = {
+    "decode_upload": int(os.getenv("CPU_OFFLOAD_DECODE_MIN_BYTES", str(256 * 1024))),
+    "image_preprocess": int(os.getenv("CPU_OFFLOAD_IMAGE_MIN_BYTES", str(64 * 1024))),
+    "json": int(os.getenv("CPU_OFFLOAD_JSON_MIN_BYTES", str(512 * 1024))),
+    "attachment_chunk": int(os.getenv("CPU_OFFLOAD_CHUNK_MIN_BYTES", str(256 * 1024))),
+}
+
+
+def decode_text(content: bytes) -> str:
+    """Text of an upload. UTF-8 (and ASCII) is decoded directly, chardet only runs on the other encodings."""
+    try:
+        return content.decode("utf-8")
+    except UnicodeDecodeError:
+        pass
+    import chardet
+    encoding = chardet.detect(content).get("encoding") or "utf-8"
+    return content.decode(encoding, errors="replace")
+
+
+def reformat_json(raw: str) -> Tuple[str, bool]:
+    """Pretty-printed JSON of raw, or raw itself when it is not JSON."""
+    try:
+        return json.dumps(json.loads(raw), indent=2), True
+    except (TypeError, ValueError):
+        return raw, False
+
+
+def _timed_call(fn: Callable, args: tuple) -> Tuple[Any, float]:
+    """Runs in the worker: result of fn and its run time, the rest of the round trip is queueing and IPC."""
+    start_time = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - start_time
+
+
+class CpuOffload:
+    """Runs CPU-bound preprocessing (encoding detection, image work, large JSON, attachment chunking) off the event loop.
+
+    Each task has a size threshold: smaller payloads run inline, larger ones in a process pool so they do not
+    hold the GIL of the API worker. Functions and arguments sent to the pool must be picklable (module-level).
+    The pool is created on the first offloaded task."""
+
+    def __init__(self, mode: str = CPU_OFFLOAD_MODE, max_workers: int = CPU_POOL_WORKERS,
+                 thresholds: Optional[Dict[str, int]] = None, start_method: str = CPU_POOL_START_METHOD):
+        self.mode = mode
+        self.max_workers = max_workers
+        self.thresholds = dict(TASK_THRESHOLDS if thresholds is None else thresholds)
+        self.start_method = start_method
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._lock = threading.Lock()
+        self._stats: Dict[str, Dict] = {}
+
+    def _get_pool(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(
+                    max_workers=self.max_workers, mp_context=multiprocessing.get_context(self.start_method)
+                )
+                logger.info(f"CPU offload pool started: {self.max_workers} {self.start_method} workers")
+            return self._pool
+
+    def _reset_pool(self, pool: ProcessPoolExecutor):
+        with self._lock:
+            if self._pool is pool:
+                self._pool = None
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    def placement(self, task: str, size: int) -> str:
+        if self.mode == "inline" or size < self.thresholds.get(task, 0):
+            return "inline"
+        return self.mode
+
+    def _record(self, task: str, placement: str, size: int, total_seconds: float, run_seconds: float):
+        with self._lock:
+            stats = self._stats.setdefault(task, {
+                "calls": 0, "inline": 0, "offloaded": 0, "bytes": 0,
+                "total_seconds": 0.0, "run_seconds": 0.0, "max_seconds": 0.0,
+            })
+            stats["calls"] += 1
+            stats["inline" if placement == "inline" else "offloaded"] += 1
+            stats["bytes"] += size
+            stats["total_seconds"] += total_seconds
+            stats["run_seconds"] += run_seconds
+            stats["max_seconds"] = max(stats["max_seconds"], total_seconds)
+        logger.debug(f"CPU task {task} ({placement}, {size} bytes): {total_seconds * 1000:.1f} ms, run {run_seconds * 1000:.1f} ms")
+
+    async def run(self, task: str, fn: Callable, *args, size: int = 0) -> Any:
+        """Result of fn(*args), run inline, in a thread or in the process pool depending on the mode and size."""
+        placement = self.placement(task, size)
+        start_time = time.perf_counter()
+        with observe_stage("cpu", task):
+            if placement == "inline":
+                result = fn(*args)
+                run_seconds = time.perf_counter() - start_time
+            elif placement == "thread":
+                result, run_seconds = await asyncio.to_thread(_timed_call, fn, args)
+            else:
+                pool = self._get_pool()
+                try:
+                    result, run_seconds = await asyncio.get_running_loop().run_in_executor(pool, _timed_call, fn, args)
+                except BrokenProcessPool:
+                    # A worker died (OOM kill): start a new pool on the next task and run this one inline
+                    logger.error(f"CPU offload pool broken during {task}, running it inline")
+                    self._reset_pool(pool)
+                    placement = "inline"
+                    result, run_seconds = _timed_call(fn, args)
+        self._record(task, placement, size, time.perf_counter() - start_time, run_seconds)
+        return result
+
+    def run_sync(self, task: str, fn: Callable, *args, size: int = 0) -> Any:
+        """Blocking variant of run for the synchronous entry points."""
+        placement = self.placement(task, size)
+        start_time = time.perf_counter()
+        with observe_stage("cpu", task):
+            if placement == "process":
+                pool = self._get_pool()
+                try:
+                    result, run_seconds = pool.submit(_timed_call, fn, args).result()
+                except BrokenProcessPool:
+                    logger.error(f"CPU offload pool broken during {task}, running it inline")
+                    self._reset_pool(pool)
+                    placement = "inline"
+                    result, run_seconds = _timed_call(fn, args)
+            else:
+                result, run_seconds = _timed_call(fn, args)
+        self._record(task, placement, size, time.perf_counter() - start_time, run_seconds)
+        return result
+
+    def stats(self) -> Dict:
+        with self._lock:
+            tasks = {
+                task: {
+                    **stats,
+                    "avg_ms": round(stats["total_seconds"] / stats["calls"] * 1000, 3),
+                    # Time spent waiting for a worker and moving the payload, summed over the offloaded calls
+                    "overhead_seconds": round(stats["total_seconds"] - stats["run_seconds"], 6),
+                }
+                for task, stats in self._stats.items()
+            }
+            pool_started = self._pool is not None
+        return {"mode": self.mode, "workers": self.max_workers, "pool_started": pool_started,
+                "thresholds": self.thresholds, "tasks": tasks}
+
+    def shutdown(self):
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=True, cancel_futures=True)
+
+
+cpu_offload = CpuOffload()
@@ -0,0 +1,379 @@
+import asyncio
+import json
+import logging
+import mimetypes
+import os
+import random
+import socket
+import time
+import uuid
+from typing import Dict, List, Optional
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from utils.image_preprocess import ImagePreprocessor
+from utils.uploads import CREATIVE_IMAGE_MAX_BYTES, copy_upload
+
+logger = logging.getLogger(__name__)
+
+JOBS_DIR = os.path.join("reports", "creative_jobs")
+BATCH_MAX_CONCURRENCY = int(os.getenv("CREATIVE_BATCH_CONCURRENCY", "4"))
+BATCH_REQUESTS_PER_MINUTE = float(os.getenv("CREATIVE_BATCH_RPM", "60"))
+BATCH_MAX_ATTEMPTS = 3
+# A job runs in the worker holding its lease (lock file): the holder renews it every LEASE_SECONDS / 4,
+# other workers take it over once it is older than LEASE_SECONDS or its process is gone
+BATCH_LEASE_SECONDS = float(os.getenv("CREATIVE_BATCH_LEASE_SECONDS", "120"))
+# Tells a lease left by a previous process with the same PID (container restart) from one of this process
+_PROCESS_TOKEN = uuid.uuid4().hex
+# Lock files of the jobs run by this process
+_held_leases = set()
+
+RESULTS_SCHEMA = pa.schema([
+    ("creative_id", pa.string()),
+    ("headline", pa.string()),
+    ("persona_set_id", pa.string()),
+    ("personas_json", pa.string()),
+    ("success", pa.bool_()),
+    ("answer", pa.string()),
+    ("error", pa.string()),
+    ("attempts", pa.int32()),
+    ("latency", pa.float64()),
+    ("completed_at", pa.float64()),
+])
+
+
+class RequestRateLimiter:
+    """Async token bucket on LLM requests per minute, shared by all the cells of a job."""
+
+    def __init__(self, requests_per_minute: float):
+        self.capacity = max(1.0, requests_per_minute)
+        self.rate = self.capacity / 60.0
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self, cost: float = 1.0):
+        cost = min(cost, self.capacity)
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= cost:
+                    self.tokens -= cost
+                    return
+                await asyncio.sleep((cost - self.tokens) / self.rate)
+
+
+class CreativeBatchJob:
+    """Creatives x persona sets job persisted in reports/creative_jobs/<job_id>.
+
+    job.json holds the definition, checkpoint.jsonl gets one line per finished cell (so a crashed
+    job resumes with the missing cells only) and results.parquet is the columnar output."""
+
+    def __init__(self, job_id: str, jobs_dir: str = JOBS_DIR):
+        self.job_id = job_id
+        self.job_dir = os.path.join(jobs_dir, job_id)
+        self.job_file = os.path.join(self.job_dir, "job.json")
+        self.checkpoint_file = os.path.join(self.job_dir, "checkpoint.jsonl")
+        self.results_file = os.path.join(self.job_dir, "results.parquet")
+        self.lock_file = os.path.join(self.job_dir, "lock")
+
+    @classmethod
+    def create(cls, creatives: List[Dict], persona_sets: Dict[str, str], fan_out: bool = False,
+               jobs_dir: str = JOBS_DIR) -> "CreativeBatchJob":
+        """creatives: [{"headline", "image_bytes" or "image_stream" (file object), "image_mime"}],
+        persona_sets: {persona_set_id: personas_json}"""
+        job = cls(uuid.uuid4().hex[:12], jobs_dir)
+        os.makedirs(os.path.join(job.job_dir, "images"), exist_ok=True)
+
+        creatives_def = []
+        for i, creative in enumerate(creatives):
+            creative_id = f"creative_{i}"
+            extension = mimetypes.guess_extension(creative["image_mime"]) or ".bin"
+            image_file = os.path.join("images", creative_id + extension)
+            if "image_stream" in creative:
+                copy_upload(creative["image_stream"], os.path.join(job.job_dir, image_file), CREATIVE_IMAGE_MAX_BYTES)
+            else:
+                with open(os.path.join(job.job_dir, image_file), "wb") as f:
+                    f.write(creative["image_bytes"])
+            creatives_def.append({
+                "creative_id": creative_id,
+                "headline": creative["headline"],
+                "image_file": image_file,
+                "image_mime": creative["image_mime"],
+            })
+
+        job.save_definition({
+            "job_id": job.job_id,
+            "created": time.time(),
+            "status": "pending",
+            "fan_out": fan_out,
+            "creatives": creatives_def,
+            "persona_sets": persona_sets,
+        })
+        return job
+
+    def load_definition(self) -> Dict:
+        with open(self.job_file, "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def save_definition(self, definition: Dict):
+        tmp_file = self.job_file + ".tmp"
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            json.dump(definition, f, indent=2)
+        os.replace(tmp_file, self.job_file)
+
+    def set_status(self, status: str):
+        definition = self.load_definition()
+        definition["status"] = status
+        self.save_definition(definition)
+
+    @staticmethod
+    def _lease_owner() -> Dict:
+        return {"host": socket.gethostname(), "pid": os.getpid(), "token": _PROCESS_TOKEN, "heartbeat": time.time()}
+
+    def _read_lease(self) -> Optional[Dict]:
+        try:
+            with open(self.lock_file, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except ValueError:
+            # Written but not filled yet, or by a crashed process: stale once old enough
+            return {"heartbeat": os.path.getmtime(self.lock_file)}
+
+    def _lease_is_stale(self, lease: Dict, lease_seconds: float) -> bool:
+        if time.time() - lease.get("heartbeat", 0) > lease_seconds:
+            return True
+        if lease.get("host") != socket.gethostname():
+            return False
+        if lease.get("pid") == os.getpid():
+            return lease.get("token") != _PROCESS_TOKEN
+        import psutil
+        return not psutil.pid_exists(lease.get("pid", -1))
+
+    def _owns(self, lease: Optional[Dict]) -> bool:
+        return lease is not None and lease.get("token") == _PROCESS_TOKEN and lease.get("pid") == os.getpid()
+
+    def acquire_lease(self, lease_seconds: float = BATCH_LEASE_SECONDS) -> bool:
+        """Take the lease of the job (O_EXCL lock file), breaking a stale one. False if another worker holds it."""
+        for _ in range(2):
+            try:
+                fd = os.open(self.lock_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                lease = self._read_lease()
+                if lease is None:
+                    continue
+                if self._owns(lease) and self.lock_file not in _held_leases:
+                    _held_leases.add(self.lock_file)
+                    return True
+                if not self._lease_is_stale(lease, lease_seconds):
+                    return False
+                # Rename before retrying: of several workers breaking the same stale lease only one succeeds
+                try:
+                    os.replace(self.lock_file, f"{self.lock_file}.stale.{_PROCESS_TOKEN}")
+                    os.remove(f"{self.lock_file}.stale.{_PROCESS_TOKEN}")
+                except FileNotFoundError:
+                    pass
+                logger.warning(f"Creative batch job {self.job_id}: took over the stale lease of {lease}")
+                continue
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(self._lease_owner(), f)
+            _held_leases.add(self.lock_file)
+            return True
+        return False
+
+    def renew_lease(self) -> bool:
+        """Refresh the heartbeat of the lease held by this process. False if it was lost."""
+        if not self._owns(self._read_lease()):
+            return False
+        tmp_file = f"{self.lock_file}.{_PROCESS_TOKEN}.tmp"
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            json.dump(self._lease_owner(), f)
+        os.replace(tmp_file, self.lock_file)
+        return True
+
+    def release_lease(self):
+        _held_leases.discard(self.lock_file)
+        if self._owns(self._read_lease()):
+            try:
+                os.remove(self.lock_file)
+            except FileNotFoundError:
+                pass
+
+    def load_checkpoint(self) -> List[Dict]:
+        if not os.path.exists(self.checkpoint_file):
+            return []
+        records = []
+        with open(self.checkpoint_file, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    # Partial last line of a crashed run
+                    continue
+        return records
+
+    def append_checkpoint(self, record: Dict):
+        with open(self.checkpoint_file, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def pending_cells(self) -> List[tuple]:
+        definition = self.load_definition()
+        done = {(r["creative_id"], r["persona_set_id"]) for r in self.load_checkpoint() if r["success"]}
+        return [
+            (creative, persona_set_id)
+            for creative in definition["creatives"]
+            for persona_set_id in definition["persona_sets"]
+            if (creative["creative_id"], persona_set_id) not in done
+        ]
+
+    def write_results(self):
+        """Write the latest record of every cell to results.parquet."""
+        latest = {}
+        for record in self.load_checkpoint():
+            latest[(record["creative_id"], record["persona_set_id"])] = record
+        columns = {field.name: [r.get(field.name) for r in latest.values()] for field in RESULTS_SCHEMA}
+        pq.write_table(pa.table(columns, schema=RESULTS_SCHEMA), self.results_file)
+
+    def status(self) -> Dict:
+        definition = self.load_definition()
+        latest = {}
+        for record in self.load_checkpoint():
+            latest[(record["creative_id"], record["persona_set_id"])] = record
+        return {
+            "job_id": self.job_id,
+            "status": definition["status"],
+            "total": len(definition["creatives"]) * len(definition["persona_sets"]),
+            "completed": sum(1 for r in latest.values() if r["success"]),
+            "failed": sum(1 for r in latest.values() if not r["success"]),
+            "results_file": self.results_file if os.path.exists(self.results_file) else None,
+        }
+
+
+async def run_creative_batch_job(orchestrator, job: CreativeBatchJob,
+                                 max_concurrency: int = BATCH_MAX_CONCURRENCY,
+                                 requests_per_minute: float = BATCH_REQUESTS_PER_MINUTE,
+                                 lease_seconds: float = BATCH_LEASE_SECONDS) -> Dict:
+    """Run (or resume) the pending cells of a job with bounded concurrency and a requests-per-minute budget.
+    Every cell goes through Orchestrator.generate_creative_reaction, the same prompt as /creative/react.
+    Nothing is run if another worker holds the lease of the job."""
+    if not await asyncio.to_thread(job.acquire_lease, lease_seconds):
+        logger.info(f"Creative batch job {job.job_id} is run by another worker, skipped")
+        return job.status()
+
+    definition = job.load_definition()
+    fan_out = definition["fan_out"]
+    persona_sets = definition["persona_sets"]
+    cells = job.pending_cells()
+    job.set_status("running")
+    logger.info(f"Creative batch job {job.job_id}: {len(cells)} pending cells")
+
+    semaphore = asyncio.Semaphore(max(1, max_concurrency))
+    limiter = RequestRateLimiter(requests_per_minute)
+
+    def read_image(creative) -> bytes:
+        # Read per attempt (not kept for the whole job): at most max_concurrency images are in memory
+        with open(os.path.join(job.job_dir, creative["image_file"]), "rb") as f:
+            return f.read()
+
+    async def run_cell(creative, persona_set_id):
+        personas_json = persona_sets[persona_set_id]
+        personas = json.loads(personas_json)
+        cost = orchestrator.creative_call_count(personas, fan_out)
+
+        answer, success, error, attempts = None, False, None, 0
+        start_time = time.time()
+        while attempts < BATCH_MAX_ATTEMPTS and not success:
+            attempts += 1
+            async with semaphore:
+                await limiter.acquire(cost)
+                try:
+                    image_bytes = await asyncio.to_thread(read_image, creative)
+                    answer, success = await orchestrator.generate_creative_reaction(
+                        creative["headline"], personas, image_bytes, creative["image_mime"],
+                        ImagePreprocessor.content_hash(image_bytes), fan_out, max_concurrency,
+                    )
+                    error = None if success else answer
+                except Exception as e:
+                    error = str(e)
+                finally:
+                    image_bytes = None
+            if not success and attempts < BATCH_MAX_ATTEMPTS:
+                # Failed calls are mostly rate limits or transient errors: back off with jitter, without
+                # holding a concurrency slot
+                await asyncio.sleep(2 ** attempts + random.random())
+
+        job.append_checkpoint({
+            "creative_id": creative["creative_id"],
+            "headline": creative["headline"],
+            "persona_set_id": persona_set_id,
+            "personas_json": personas_json,
+            "success": success,
+            "answer": answer if success else None,
+            "error": error,
+            "attempts": attempts,
+            "latency": time.time() - start_time,
+            "completed_at": time.time(),
+        })
+
+    lease_lost = False
+
+    async def keep_lease(work: asyncio.Future):
+        nonlocal lease_lost
+        while not work.done():
+            await asyncio.sleep(lease_seconds / 4)
+            if not await asyncio.to_thread(job.renew_lease):
+                lease_lost = True
+                _held_leases.discard(job.lock_file)
+                logger.warning(f"Creative batch job {job.job_id}: lease lost to another worker, stopping")
+                work.cancel()
+
+    work = asyncio.ensure_future(asyncio.gather(*(run_cell(creative, persona_set_id) for creative, persona_set_id in cells)))
+    heartbeat = asyncio.create_task(keep_lease(work))
+    try:
+        await work
+        job.write_results()
+        job.set_status("completed")
+    except asyncio.CancelledError:
+        if not lease_lost:
+            job.set_status("interrupted")
+            raise
+    except BaseException:
+        job.set_status("interrupted")
+        raise
+    finally:
+        heartbeat.cancel()
+        work.cancel()
+        if not lease_lost:
+            job.release_lease()
+
+    status = job.status()
+    logger.info(f"Creative batch job {job.job_id} finished: {status}")
+    return status
+
+
+def list_resumable_jobs(jobs_dir: str = JOBS_DIR) -> List[CreativeBatchJob]:
+    """Jobs left running or interrupted by a crash/restart."""
+    if not os.path.isdir(jobs_dir):
+        return []
+    jobs = []
+    for job_id in sorted(os.listdir(jobs_dir)):
+        job = CreativeBatchJob(job_id, jobs_dir)
+        if os.path.exists(job.job_file) and job.load_definition()["status"] in ("pending", "running", "interrupted"):
+            jobs.append(job)
+    return jobs
+
+
+def parse_persona_sets(persona_sets_json: str) -> Dict[str, str]:
+    """Accept a JSON list of persona dicts or a JSON object {persona_set_id: persona dict}."""
+    persona_sets = json.loads(persona_sets_json)
+    if isinstance(persona_sets, list):
+        persona_sets = {f"persona_set_{i}": p for i, p in enumerate(persona_sets)}
+    if not isinstance(persona_sets, dict) or not all(isinstance(p, dict) for p in persona_sets.values()):
+        raise ValueError("persona_sets_json must be a list or an object of persona dicts")
+    return {str(k): json.dumps(p) for k, p in persona_sets.items()}
@@ -0,0 +1,131 @@
+import asyncio
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import time
+from typing import Awaitable, Callable, Dict, List
+
+import numpy as np
+
+
+def normalize_text(text: str) -> str:
+    """Normalization applied before hashing: case and whitespace differences share one embedding."""
+    return re.sub(r"\s+", " ", text).strip().casefold()
+
+
+class EmbeddingCache:
+    """Content-addressed cache of embedding vectors keyed by (embedding model, normalized text).
+
+    Stored in a SQLite file in WAL mode so every uvicorn worker shares it. The number of rows is
+    bounded by max_entries, evicting the least recently used vectors."""
+
+    def __init__(self, path: str, max_entries: int = 100_000, evict_every: int = 100):
+        self.path = path
+        self.max_entries = max_entries
+        self.evict_every = evict_every
+        self.hits = 0
+        self.misses = 0
+        self._inserts = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        conn = self._connection()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "key TEXT PRIMARY KEY, model TEXT NOT NULL, dim INTEGER NOT NULL, vector BLOB NOT NULL, last_access REAL NOT NULL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS embeddings_last_access ON embeddings (last_access)")
+        conn.commit()
+
+    def _connection(self) -> sqlite3.Connection:
+        """One connection per thread (sqlite3 connections are not shared across threads)."""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def make_key(model: str, text: str) -> str:
+        return hashlib.sha256(f"{model}\0{normalize_text(text)}".encode("utf-8")).hexdigest()
+
+    def get_many(self, model: str, texts: List[str]) -> Dict[str, np.ndarray]:
+        """Cached vectors by key for the texts found in the cache."""
+        if not texts:
+            return {}
+        keys = [self.make_key(model, text) for text in texts]
+        conn = self._connection()
+        placeholders = ",".join("?" * len(keys))
+        rows = conn.execute(
+            f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", keys
+        ).fetchall()
+        if rows:
+            conn.executemany(
+                "UPDATE embeddings SET last_access = ? WHERE key = ?", [(time.time(), key) for key, _ in rows]
+            )
+            conn.commit()
+        return {key: np.frombuffer(vector, dtype=np.float32) for key, vector in rows}
+
+    def put_many(self, model: str, texts: List[str], vectors: List[List[float]]):
+        now = time.time()
+        rows = []
+        for text, vector in zip(texts, vectors):
+            array = np.asarray(vector, dtype=np.float32)
+            rows.append((self.make_key(model, text), model, array.shape[0], array.tobytes(), now))
+        conn = self._connection()
+        conn.executemany("INSERT OR REPLACE INTO embeddings (key, model, dim, vector, last_access) VALUES (?, ?, ?, ?, ?)", rows)
+        conn.commit()
+
+        with self._lock:
+            self._inserts += len(rows)
+            evict = self._inserts >= self.evict_every
+            if evict:
+                self._inserts = 0
+        if evict:
+            self.evict()
+
+    def evict(self):
+        """Keep only the max_entries most recently used vectors."""
+        conn = self._connection()
+        conn.execute(
+            "DELETE FROM embeddings WHERE key IN ("
+            "SELECT key FROM embeddings ORDER BY last_access DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,),
+        )
+        conn.commit()
+
+    async def embed(self, model: str, texts: List[str],
+                    compute: Callable[[List[str]], Awaitable[List[List[float]]]]) -> List[np.ndarray]:
+        """Vectors for texts, computing only the cache misses with compute(texts) in one batch."""
+        if not texts:
+            return []
+        cached = await asyncio.to_thread(self.get_many, model, texts)
+        keys = [self.make_key(model, text) for text in texts]
+        # One text per missing key: texts that normalize the same are embedded once
+        missing = list({key: text for text, key in zip(texts, keys) if key not in cached}.values())
+
+        with self._lock:
+            self.hits += len(texts) - len(missing)
+            self.misses += len(missing)
+
+        if missing:
+            vectors = await compute(missing)
+            await asyncio.to_thread(self.put_many, model, missing, vectors)
+            for text, vector in zip(missing, vectors):
+                cached[self.make_key(model, text)] = np.asarray(vector, dtype=np.float32)
+
+        return [cached[key] for key in keys]
+
+    def stats(self) -> Dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
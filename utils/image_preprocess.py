@@ -0,0 +1,167 @@
+import base64
+import hashlib
+import io
+import math
+import os
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+from PIL import Image
+
+# OpenAI vision (detail="high", what "auto" uses for these images) scales the image to fit 2048x2048,
+# then the shortest side to 768, and bills 85 base tokens + 170 tokens per 512px tile.
+VISION_MAX_SIDE = 2048
+VISION_BILLED_SHORT_SIDE = 768
+# Shortest side the creatives are sent at. At 768 the billed tokens do not change (the API scales the same
+# way), only the bytes uploaded do; below 768 fewer tiles are billed.
+VISION_SHORT_SIDE = int(os.getenv("CREATIVE_IMAGE_SHORT_SIDE", "768"))
+VISION_TILE_SIZE = 512
+VISION_BASE_TOKENS = 85
+VISION_TILE_TOKENS = 170
+
+OUTPUT_FORMAT = os.getenv("CREATIVE_IMAGE_FORMAT", "JPEG").upper()
+OUTPUT_QUALITY = int(os.getenv("CREATIVE_IMAGE_QUALITY", "85"))
+CACHE_MAX_ENTRIES = int(os.getenv("CREATIVE_IMAGE_CACHE_SIZE", "128"))
+
+FORMAT_MIME = {"JPEG": "image/jpeg", "WEBP": "image/webp", "PNG": "image/png"}
+
+
+def scaled_size(width: int, height: int, short_side: int) -> Tuple[int, int]:
+    """Fit in VISION_MAX_SIDE, then shortest side down to short_side. Never upscales."""
+    scale = min(1.0, VISION_MAX_SIDE / max(width, height))
+    if min(width, height) * scale > short_side:
+        scale *= short_side / (min(width, height) * scale)
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def estimate_tokens(width: int, height: int) -> int:
+    """Image tokens billed for a detail="high" request of an image uploaded at this size
+    (after the scaling the API applies itself)."""
+    w, h = scaled_size(width, height, VISION_BILLED_SHORT_SIDE)
+    tiles = math.ceil(w / VISION_TILE_SIZE) * math.ceil(h / VISION_TILE_SIZE)
+    return VISION_BASE_TOKENS + VISION_TILE_TOKENS * tiles
+
+
+class ImagePreprocessor:
+    """Decode, resize and re-encode creative images once, caching the resulting data URL by content hash."""
+
+    def __init__(self, short_side: int = VISION_SHORT_SIDE, output_format: str = OUTPUT_FORMAT,
+                 quality: int = OUTPUT_QUALITY, max_entries: int = CACHE_MAX_ENTRIES):
+        self.short_side = short_side
+        self.output_format = output_format
+        self.quality = quality
+        self.max_entries = max_entries
+        self._cache: "OrderedDict[str, Tuple[str, Dict]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def content_hash(image_bytes: bytes) -> str:
+        return hashlib.sha256(image_bytes).hexdigest()
+
+    def target_size(self, width: int, height: int) -> Tuple[int, int]:
+        """Size the image is sent at: fit in VISION_MAX_SIDE, then shortest side to short_side. Never upscales."""
+        return scaled_size(width, height, self.short_side)
+
+    def _encode(self, image: Image.Image) -> Tuple[bytes, str]:
+        output_format = self.output_format
+        has_alpha = image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info)
+        if output_format == "JPEG" and has_alpha:
+            # JPEG has no alpha channel, keep transparency with WEBP
+            output_format = "WEBP"
+        if output_format == "JPEG" and image.mode != "RGB":
+            image = image.convert("RGB")
+
+        buffer = io.BytesIO()
+        if output_format == "PNG":
+            image.save(buffer, format="PNG", optimize=True)
+        else:
+            image.save(buffer, format=output_format, quality=self.quality)
+        return buffer.getvalue(), FORMAT_MIME[output_format]
+
+    def _process(self, image_bytes: bytes, image_mime: str) -> Tuple[str, Dict]:
+        with Image.open(io.BytesIO(image_bytes)) as image:
+            image.load()
+            original_size = image.size
+            size = self.target_size(*original_size)
+            if size != original_size:
+                image = image.resize(size, Image.LANCZOS)
+            encoded, mime = self._encode(image)
+
+        # Re-encoding can grow small or already compressed images, keep the original then
+        if len(encoded) >= len(image_bytes) and size == original_size:
+            encoded, mime = image_bytes, image_mime
+
+        stats = {
+            "original_bytes": len(image_bytes),
+            "processed_bytes": len(encoded),
+            "bytes_saved": len(image_bytes) - len(encoded),
+            "original_size": list(original_size),
+            "processed_size": list(size),
+            "original_tokens": estimate_tokens(*original_size),
+            "processed_tokens": estimate_tokens(*size),
+        }
+        stats["tokens_saved"] = stats["original_tokens"] - stats["processed_tokens"]
+
+        data_url = f"data:{mime};base64,{base64.b64encode(encoded).decode('utf-8')}"
+        return data_url, stats
+
+    def _cached(self, key: str) -> Optional[Tuple[str, Dict]]:
+        with self._lock:
+            cached = self._cache.get(key)
+            if cached is not None:
+                self._cache.move_to_end(key)
+                return cached[0], {**cached[1], "cache_hit": True}
+        return None
+
+    def _remember(self, key: str, data_url: str, stats: Dict):
+        with self._lock:
+            self._cache[key] = (data_url, stats)
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.max_entries:
+                self._cache.popitem(last=False)
+
+    def prepare_data_url(self, image_bytes: bytes, image_mime: str = "image/png",
+                         image_hash: Optional[str] = None) -> Tuple[str, Dict]:
+        """Return the data URL to send to the vision model and the stats of the preprocessing (bytes/tokens saved, cache hit)."""
+        key = image_hash or self.content_hash(image_bytes)
+        cached = self._cached(key)
+        if cached is not None:
+            return cached
+
+        data_url, stats = preprocess_image(image_bytes, image_mime, self.short_side, self.output_format, self.quality)
+        self._remember(key, data_url, stats)
+        return data_url, {**stats, "cache_hit": False}
+
+    async def prepare_data_url_offloaded(self, image_bytes: bytes, image_mime: str = "image/png",
+                                         image_hash: Optional[str] = None) -> Tuple[str, Dict]:
+        """prepare_data_url with the decode/resize/base64 work in the CPU offload pool for large images."""
+        from utils.cpu_offload import cpu_offload
+
+        key = image_hash or self.content_hash(image_bytes)
+        cached = self._cached(key)
+        if cached is not None:
+            return cached
+
+        data_url, stats = await cpu_offload.run(
+            "image_preprocess", preprocess_image, image_bytes, image_mime, self.short_side, self.output_format,
+            self.quality, size=len(image_bytes),
+        )
+        self._remember(key, data_url, stats)
+        return data_url, {**stats, "cache_hit": False}
+
+
+def preprocess_image(image_bytes: bytes, image_mime: str, short_side: int, output_format: str,
+                     quality: int) -> Tuple[str, Dict]:
+    """Data URL and stats of one image. Module-level so it can run in the CPU offload process pool."""
+    try:
+        return ImagePreprocessor(short_side, output_format, quality, max_entries=0)._process(image_bytes, image_mime)
+    except (OSError, ValueError, Image.DecompressionBombError) as e:
+        # Not decodable by Pillow (or over its pixel limit): send the upload as-is
+        data_url = f"data:{image_mime};base64,{base64.b64encode(image_bytes).decode('utf-8')}"
+        stats = {"original_bytes": len(image_bytes), "processed_bytes": len(image_bytes),
+                 "bytes_saved": 0, "tokens_saved": 0, "error": str(e)}
+        return data_url, stats
+
+
+image_preprocessor = ImagePreprocessor()
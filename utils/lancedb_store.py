@@ -0,0 +1,121 @@
+import logging
+import os
+import threading
+import time
+from typing import Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class LatencyStats:
+    """Count / total / max of a latency, safe to update from several threads."""
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, seconds: float):
+        with self._lock:
+            self.count += 1
+            self.total += seconds
+            self.max = max(self.max, seconds)
+
+    def to_dict(self) -> Dict:
+        with self._lock:
+            return {
+                "count": self.count,
+                "avg": self.total / self.count if self.count else 0.0,
+                "max": self.max,
+            }
+
+
+async def index_distance_type(table, column: str = "vector") -> Optional[str]:
+    """Metric ("l2", "cosine", "dot") the vector index of column was built with, None if it has no index."""
+    for index in await table.list_indices():
+        if column in index.columns:
+            stats = await table.index_stats(index.name)
+            if stats is not None and stats.distance_type:
+                return stats.distance_type
+    return None
+
+
+class LanceTableHandle:
+    """Process-wide handle of a LanceDB table, opened once and swapped when a new table version is written.
+
+    Readers only read the current handle reference, so a refresh never blocks them: the new table is
+    opened aside and swapped in under a short lock. New versions are detected from the table _versions
+    directory, checked at most every check_interval seconds. distance_type is the metric of the vector
+    index of the open version: queries must use it (a cosine index searched with l2 returns wrong neighbours)."""
+
+    def __init__(self, uri: str, table_name: str, check_interval: float = 5.0):
+        self.uri = uri
+        self.table_name = table_name
+        self.check_interval = check_interval
+        self.versions_dir = os.path.join(uri, f"{table_name}.lance", "_versions")
+        self.open_latency = LatencyStats()
+        self.search_latency = LatencyStats()
+        self.refreshes = 0
+        self.distance_type: Optional[str] = None
+        self._table = None
+        self._version_token = None
+        self._last_check = 0.0
+        self._swap_lock = threading.Lock()
+
+    def _read_version_token(self) -> Optional[int]:
+        """Changes whenever a manifest is added to _versions (None for remote URIs)."""
+        try:
+            return os.stat(self.versions_dir).st_mtime_ns
+        except OSError:
+            return None
+
+    async def _open(self, version_token: Optional[int]):
+        # Imported with the first table open: lancedb takes about a second to import
+        import lancedb
+
+        start_time = time.perf_counter()
+        db = await lancedb.connect_async(self.uri)
+        table = await db.open_table(self.table_name)
+        try:
+            distance_type = await index_distance_type(table)
+        except Exception as e:
+            logger.warning(f"LanceDB index metric of {self.table_name} unknown, searching with the default: {e}")
+            distance_type = None
+        self.open_latency.observe(time.perf_counter() - start_time)
+
+        with self._swap_lock:
+            refreshed = self._table is not None
+            self._table = table
+            self.distance_type = distance_type
+            self._version_token = version_token
+            if refreshed:
+                self.refreshes += 1
+        logger.info(f"LanceDB table {self.table_name} opened (version {await table.version()}, index metric {distance_type}, refresh {refreshed})")
+        return table
+
+    async def get_table(self):
+        """Current table handle, opening it on first use and reopening it when the table has a new version."""
+        table = self._table
+        if table is None:
+            return await self._open(self._read_version_token())
+
+        now = time.monotonic()
+        if now - self._last_check >= self.check_interval:
+            self._last_check = now
+            version_token = self._read_version_token()
+            if version_token is not None and version_token != self._version_token:
+                try:
+                    return await self._open(version_token)
+                except Exception as e:
+                    logger.error(f"LanceDB table refresh failed, keeping the current handle: {e}")
+        return table
+
+    def stats(self) -> Dict:
+        return {
+            "table": self.table_name,
+            "open_latency": self.open_latency.to_dict(),
+            "search_latency": self.search_latency.to_dict(),
+            "refreshes": self.refreshes,
+            "distance_type": self.distance_type,
+        }
@@ -0,0 +1,31 @@
+import threading
+from typing import Any, Callable
+
+
+class Lazy:
+    """Module-level object built by factory on first use.
+
+    Attribute access is forwarded to the built object, so a module can declare its clients, caches and
+    writers at import time without opening files, starting threads or importing heavy libraries until
+    a request needs them. Lazy's own members are underscored so they never hide the ones of the object."""
+
+    def __init__(self, factory: Callable[[], Any]):
+        self._factory = factory
+        self._instance = None
+        self._lock = threading.Lock()
+
+    def _resolve(self) -> Any:
+        instance = self._instance
+        if instance is None:
+            with self._lock:
+                if self._instance is None:
+                    self._instance = self._factory()
+                instance = self._instance
+        return instance
+
+    @property
+    def _initialized(self) -> bool:
+        return self._instance is not None
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._resolve(), name)
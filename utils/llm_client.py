@@ -0,0 +1,338 @@
+import asyncio
+import email.utils
+import json
+import logging
+import os
+import random
+import threading
+import time
+from types import SimpleNamespace
+from typing import Any, Callable, Dict, Optional
+
+from utils.prometheus_metrics import LLM_QUEUE_DELAY, LLM_RETRIES
+
+logger = logging.getLogger(__name__)
+
+# Connection pool and timeouts of the OpenAI HTTP client (one per process, connections kept alive)
+LLM_MAX_CONNECTIONS = int(os.getenv("LLM_MAX_CONNECTIONS", "100"))
+LLM_MAX_KEEPALIVE = int(os.getenv("LLM_MAX_KEEPALIVE", "20"))
+LLM_KEEPALIVE_EXPIRY = float(os.getenv("LLM_KEEPALIVE_EXPIRY", "30"))
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "60"))
+LLM_CONNECT_TIMEOUT = float(os.getenv("LLM_CONNECT_TIMEOUT", "5"))
+
+# Retries of 429, 5xx, timeouts and connection errors: jittered exponential backoff, Retry-After when given
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "4"))
+LLM_BACKOFF_BASE = float(os.getenv("LLM_BACKOFF_BASE", "0.5"))
+LLM_BACKOFF_MAX = float(os.getenv("LLM_BACKOFF_MAX", "20"))
+
+# Per-model limits of this worker, e.g. {"gpt-4o-mini": {"rpm": 500, "tpm": 200000}} (0 = no limit).
+# With several workers give each one its share of the account limits
+LLM_RATE_LIMITS = json.loads(os.getenv("LLM_RATE_LIMITS", "{}"))
+LLM_DEFAULT_RPM = float(os.getenv("LLM_DEFAULT_RPM", "0"))
+LLM_DEFAULT_TPM = float(os.getenv("LLM_DEFAULT_TPM", "0"))
+# Tokens reserved for a chat call before its usage is known, then the average usage of the model
+LLM_DEFAULT_TOKEN_ESTIMATE = int(os.getenv("LLM_DEFAULT_TOKEN_ESTIMATE", "1000"))
+
+
+class TokenBucket:
+    """Token bucket refilled at per_minute / 60 per second, holding at most one minute of budget.
+
+    reserve() takes the amount at once (the level can go negative) and returns how long the caller has to
+    wait for the bucket to cover it, so concurrent callers queue in arrival order without polling."""
+
+    def __init__(self, per_minute: float):
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self.level = per_minute
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, amount: float, now: float) -> float:
+        self._refill(now)
+        self.level -= amount
+        return max(0.0, -self.level / self.rate)
+
+    def adjust(self, amount: float, now: float):
+        """Take (or give back, when negative) the difference between the reserved and the real amount."""
+        self._refill(now)
+        self.level -= amount
+
+
+class ModelLimiter:
+    """RPM and TPM buckets of one model, paused for everybody when the API answers 429 with Retry-After."""
+
+    def __init__(self, rpm: float, tpm: float):
+        self.requests = TokenBucket(rpm) if rpm else None
+        self.tokens = TokenBucket(tpm) if tpm else None
+        self.paused_until = 0.0
+        self.average_tokens = float(LLM_DEFAULT_TOKEN_ESTIMATE)
+        self.calls = 0
+        self.retries = 0
+        self.queued_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def reserve(self, tokens: float) -> float:
+        """Seconds to wait before sending a call that is expected to use tokens."""
+        now = time.monotonic()
+        with self._lock:
+            wait = max(0.0, self.paused_until - now)
+            if self.requests is not None:
+                wait = max(wait, self.requests.reserve(1, now))
+            if self.tokens is not None:
+                wait = max(wait, self.tokens.reserve(tokens, now))
+            return wait
+
+    def settle(self, reserved: float, used: Optional[int]):
+        """Charge the real usage.total_tokens of the call and update the estimate of the next ones."""
+        if used is None:
+            return
+        with self._lock:
+            if self.tokens is not None:
+                self.tokens.adjust(used - reserved, time.monotonic())
+            self.average_tokens = 0.9 * self.average_tokens + 0.1 * used
+
+    def refund(self, reserved: float):
+        """Give back the tokens reserved for a call that failed. The estimate is left alone: a failed call
+        says nothing about the usage of the next ones (settling it with 0 would shrink the reservations
+        during a 429 storm)."""
+        with self._lock:
+            if self.tokens is not None:
+                self.tokens.adjust(-reserved, time.monotonic())
+
+    def record_call(self, queued_seconds: float):
+        with self._lock:
+            self.calls += 1
+            self.queued_seconds += queued_seconds
+
+    def record_retry(self):
+        with self._lock:
+            self.retries += 1
+
+    def pause(self, seconds: float):
+        with self._lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "rpm": self.requests.capacity if self.requests else None,
+                "tpm": self.tokens.capacity if self.tokens else None,
+                "calls": self.calls,
+                "retries": self.retries,
+                "avg_queue_ms": round(self.queued_seconds / self.calls * 1000, 3) if self.calls else 0.0,
+                "avg_tokens": round(self.average_tokens, 1),
+            }
+
+
+def retry_after_seconds(error) -> Optional[float]:
+    """Retry-After (or retry-after-ms) of an API error response, in seconds."""
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    headers = response.headers
+    if headers.get("retry-after-ms"):
+        try:
+            return float(headers["retry-after-ms"]) / 1000
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError, IndexError, OverflowError):
+        # Malformed HTTP date: fall back to the exponential backoff
+        return None
+    return max(0.0, date.timestamp() - time.time()) if date else None
+
+
+def retry_reason(error) -> Optional[str]:
+    """Reason label of a retryable error, None if the error must not be retried."""
+    import openai
+
+    if isinstance(error, openai.RateLimitError):
+        return "rate_limit"
+    if isinstance(error, openai.APITimeoutError):
+        return "timeout"
+    if isinstance(error, openai.APIConnectionError):
+        return "connection"
+    if isinstance(error, openai.APIStatusError) and error.status_code >= 500:
+        return "server_error"
+    return None
+
+
+def estimate_tokens(kind: str, kwargs: Dict, limiter: ModelLimiter) -> float:
+    if kind == "embeddings":
+        texts = kwargs.get("input")
+        texts = [texts] if isinstance(texts, str) else texts or []
+        # ~4 characters per token
+        return sum(len(text) for text in texts if isinstance(text, str)) / 4 + 1
+    return limiter.average_tokens
+
+
+class UsageStream:
+    """Async iterator over a streamed completion that settles its tokens when the usage chunk arrives."""
+
+    def __init__(self, stream, on_usage: Callable[[Optional[int]], None]):
+        self._stream = stream
+        self._on_usage = on_usage
+        self._settled = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            chunk = await self._stream.__anext__()
+        except StopAsyncIteration:
+            if not self._settled:
+                self._settled = True
+                self._on_usage(None)
+            raise
+        if getattr(chunk, "usage", None) is not None and not self._settled:
+            self._settled = True
+            self._on_usage(chunk.usage.total_tokens)
+        return chunk
+
+
+class LLMClient:
+    """Shared OpenAI client of the process: pooled keep-alive connections, timeouts, per-model RPM/TPM token
+    buckets and retries with jittered exponential backoff honoring Retry-After.
+
+    Exposes the calls the agent uses with the OpenAI SDK paths (chat.completions.create,
+    beta.chat.completions.parse, embeddings.create), so callers do not change. The time a call waits
+    for its model's buckets is exported as agent_llm_queue_delay_seconds."""
+
+    def __init__(self, client, rate_limits: Optional[Dict[str, Dict]] = None, max_retries: int = LLM_MAX_RETRIES,
+                 backoff_base: float = LLM_BACKOFF_BASE, backoff_max: float = LLM_BACKOFF_MAX):
+        self.raw = client
+        self.rate_limits = LLM_RATE_LIMITS if rate_limits is None else rate_limits
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._limiters: Dict[str, ModelLimiter] = {}
+        self._lock = threading.Lock()
+
+        self.chat = SimpleNamespace(completions=SimpleNamespace(
+            create=self._wrap("chat", lambda: client.chat.completions.create)))
+        self.beta = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(
+            parse=self._wrap("chat", lambda: client.beta.chat.completions.parse))))
+        self.embeddings = SimpleNamespace(create=self._wrap("embeddings", lambda: client.embeddings.create))
+
+    def limiter(self, model: str) -> ModelLimiter:
+        with self._lock:
+            limiter = self._limiters.get(model)
+            if limiter is None:
+                limits = self.rate_limits.get(model, {})
+                limiter = ModelLimiter(limits.get("rpm", LLM_DEFAULT_RPM), limits.get("tpm", LLM_DEFAULT_TPM))
+                self._limiters[model] = limiter
+            return limiter
+
+    def backoff(self, attempt: int, retry_after: Optional[float]) -> float:
+        """Full-jitter exponential backoff, never shorter than Retry-After."""
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+        if retry_after is not None:
+            delay = max(delay, retry_after + random.uniform(0, self.backoff_base))
+        return delay
+
+    def _wrap(self, kind: str, method: Callable[[], Callable]) -> Callable:
+        async def call(**kwargs) -> Any:
+            return await self.request(kind, method(), **kwargs)
+        return call
+
+    async def request(self, kind: str, method: Callable, **kwargs) -> Any:
+        model = kwargs.get("model") or "default"
+        limiter = self.limiter(model)
+        attempt = 0
+        while True:
+            reserved = estimate_tokens(kind, kwargs, limiter)
+            wait = limiter.reserve(reserved)
+            if wait > 0:
+                await asyncio.sleep(wait)
+            LLM_QUEUE_DELAY.labels(model).observe(wait)
+            limiter.record_call(wait)
+
+            try:
+                response = await method(**kwargs)
+            except Exception as e:
+                # The failed call did not use the tokens reserved for it
+                limiter.refund(reserved)
+                reason = retry_reason(e)
+                if reason is None or attempt >= self.max_retries:
+                    raise
+                retry_after = retry_after_seconds(e)
+                if reason == "rate_limit" and retry_after:
+                    # Every request of this model waits, not only this one
+                    limiter.pause(retry_after)
+                delay = self.backoff(attempt, retry_after)
+                LLM_RETRIES.labels(model, reason).inc()
+                limiter.record_retry()
+                logger.warning(f"LLM call to {model} failed ({reason}: {e}), retry {attempt + 1}/{self.max_retries} in {delay:.2f}s")
+                attempt += 1
+                await asyncio.sleep(delay)
+                continue
+
+            if kwargs.get("stream"):
+                return UsageStream(response, lambda used: limiter.settle(reserved, used))
+            usage = getattr(response, "usage", None)
+            limiter.settle(reserved, getattr(usage, "total_tokens", None))
+            return response
+
+    def stats(self) -> Dict:
+        with self._lock:
+            limiters = dict(self._limiters)
+        return {model: limiter.stats() for model, limiter in limiters.items()}
+
+
+def openai_client_options(azure: bool) -> Dict:
+    """api_key/base_url of the OpenAI or Azure AI Foundry (OpenAI v1 API) endpoint."""
+    if azure:
+        return {
+            "api_key": os.getenv("AZURE_FDRY_KEY"),
+            "base_url": os.getenv("AZURE_FDRY_ENDPOINT").rstrip("/") + "/openai/v1/",
+        }
+    return {}
+
+
+def http_options() -> Dict:
+    import httpx
+
+    return {
+        "limits": httpx.Limits(
+            max_connections=LLM_MAX_CONNECTIONS,
+            max_keepalive_connections=LLM_MAX_KEEPALIVE,
+            keepalive_expiry=LLM_KEEPALIVE_EXPIRY,
+        ),
+        "timeout": httpx.Timeout(LLM_TIMEOUT, connect=LLM_CONNECT_TIMEOUT),
+    }
+
+
+def create_llm_client(azure: bool = False) -> LLMClient:
+    """Async client of the agent. The SDK retries are off: LLMClient retries with the rate limiter."""
+    from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+
+    client = AsyncOpenAI(
+        **openai_client_options(azure),
+        http_client=DefaultAsyncHttpxClient(**http_options()),
+        max_retries=0,
+    )
+    return LLMClient(client)
+
+
+def create_sync_client(azure: bool = False):
+    """Blocking OpenAI client for scripts, with the same pool and timeouts and the SDK retries
+    (jittered exponential backoff honoring Retry-After) up to LLM_MAX_RETRIES."""
+    from openai import DefaultHttpxClient, OpenAI
+
+    return OpenAI(
+        **openai_client_options(azure),
+        http_client=DefaultHttpxClient(**http_options()),
+        max_retries=LLM_MAX_RETRIES,
+    )
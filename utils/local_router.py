@@ -0,0 +1,125 @@
+import csv
+import logging
+import os
+import threading
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Field positions in reports/report_metrics.csv, the same with or without the Anomaly_detected column
+REPORT_INPUT_FIELD = 1
+REPORT_STEP_FIELD = 3
+REPORT_TOOL_FIELD = 4
+# Tool of the metrics rows of a request routed by the local router (empty when the LLM routed it)
+LOCAL_ROUTE_TOOL = "local_router"
+
+
+def load_route_examples(report_path: str, labels: Sequence[str]) -> Tuple[List[str], List[str]]:
+    """(prompts, labels) of the requests routed by the LLM in the metrics report, one per distinct (prompt, step).
+
+    The Step of the first row of a request is the label chosen by the router. The requests routed by the
+    local router (Tool LOCAL_ROUTE_TOOL) are left out: retraining on them would learn its own predictions."""
+    examples = {}
+    with open(report_path, newline="", encoding="utf-8") as f:
+        reader = csv.reader(f)
+        next(reader, None)
+        for row in reader:
+            if len(row) <= REPORT_TOOL_FIELD or row[REPORT_TOOL_FIELD] == LOCAL_ROUTE_TOOL:
+                continue
+            prompt, step = row[REPORT_INPUT_FIELD].strip(), row[REPORT_STEP_FIELD]
+            if prompt and step in labels:
+                examples[(prompt, step)] = None
+    return [prompt for prompt, _ in examples], [step for _, step in examples]
+
+
+class NearestCentroidRouter:
+    """Local request router: one centroid of normalized embeddings per label.
+
+    predict() scores the labels with a softmax over the cosine similarities to the centroids
+    (scaled by 1 / temperature); the caller only trusts the label when its score reaches threshold
+    and falls back to the LLM router otherwise. The centroids are stored in a .npz file together
+    with the embedding model that produced them, and loaded on first use."""
+
+    def __init__(self, path: str, threshold: float = 0.9, temperature: float = 0.02):
+        self.path = path
+        self.threshold = threshold
+        self.temperature = temperature
+        self.labels: List[str] = []
+        self.centroids: Optional[np.ndarray] = None
+        self.counts: List[int] = []
+        self.embed_model: Optional[str] = None
+        self.local_routes = 0
+        self.fallbacks = 0
+        self._loaded = False
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _normalize(vectors: np.ndarray) -> np.ndarray:
+        norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+        return vectors / np.where(norms == 0, 1, norms)
+
+    def fit(self, vectors, labels: Sequence[str], embed_model: str) -> "NearestCentroidRouter":
+        vectors = self._normalize(np.asarray(vectors, dtype=np.float32))
+        self.labels = sorted(set(labels))
+        label_array = np.asarray(labels)
+        self.counts = [int((label_array == label).sum()) for label in self.labels]
+        self.centroids = self._normalize(np.stack([vectors[label_array == label].mean(axis=0) for label in self.labels]))
+        self.embed_model = embed_model
+        self._loaded = True
+        return self
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with open(self.path, "wb") as f:
+            np.savez(f, labels=np.asarray(self.labels), centroids=self.centroids,
+                     counts=np.asarray(self.counts), embed_model=np.asarray(self.embed_model))
+
+    def load(self) -> bool:
+        """Load the centroids once; False when the router was never trained."""
+        with self._lock:
+            if not self._loaded:
+                self._loaded = True
+                if os.path.exists(self.path):
+                    data = np.load(self.path)
+                    self.labels = data["labels"].tolist()
+                    self.centroids = data["centroids"]
+                    self.counts = data["counts"].tolist()
+                    self.embed_model = str(data["embed_model"])
+                    logger.info(f"Local router loaded from {self.path}: {dict(zip(self.labels, self.counts))}")
+        return self.centroids is not None
+
+    def is_ready(self, embed_model: str) -> bool:
+        return self.load() and len(self.labels) > 1 and self.embed_model == embed_model
+
+    def scores(self, vector) -> np.ndarray:
+        similarities = self.centroids @ self._normalize(np.asarray(vector, dtype=np.float32))
+        logits = (similarities - similarities.max()) / self.temperature
+        weights = np.exp(logits)
+        return weights / weights.sum()
+
+    def predict(self, vector) -> Tuple[str, float]:
+        """(best label, score) of one query vector."""
+        scores = self.scores(vector)
+        best = int(np.argmax(scores))
+        return self.labels[best], float(scores[best])
+
+    def record(self, local: bool):
+        with self._lock:
+            if local:
+                self.local_routes += 1
+            else:
+                self.fallbacks += 1
+
+    def stats(self) -> Dict:
+        with self._lock:
+            routed = self.local_routes + self.fallbacks
+            return {
+                "trained": self.centroids is not None,
+                "examples": dict(zip(self.labels, self.counts)),
+                "threshold": self.threshold,
+                "local_routes": self.local_routes,
+                "llm_fallbacks": self.fallbacks,
+                "local_rate": self.local_routes / routed if routed else 0.0,
+            }
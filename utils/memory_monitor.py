@@ -0,0 +1,81 @@
+import os
+import threading
+import time
+from typing import Dict, Optional
+
+# RSS sampling period of the worker while requests are tracked
+MEMORY_SAMPLE_INTERVAL = float(os.getenv("MEMORY_SAMPLE_INTERVAL", "0.05"))
+
+
+class MemoryWatch:
+    """RSS of the worker at the start and end of a request and the peak sampled in between.
+
+    The RSS is per process: with concurrent requests the peak of each request includes the others,
+    it is the memory the worker needed while that request was running."""
+
+    def __init__(self, start_rss: int):
+        self.start_rss = start_rss
+        self.peak_rss = start_rss
+        self.end_rss: Optional[int] = None
+
+    @property
+    def peak_growth(self) -> int:
+        return max(0, self.peak_rss - self.start_rss)
+
+    def as_dict(self) -> Dict:
+        return {
+            "start_rss_mb": round(self.start_rss / 2**20, 1),
+            "peak_rss_mb": round(self.peak_rss / 2**20, 1),
+            "end_rss_mb": round((self.end_rss or self.peak_rss) / 2**20, 1),
+            "peak_growth_mb": round(self.peak_growth / 2**20, 1),
+        }
+
+
+class MemoryMonitor:
+    """One sampler thread per worker, running only while at least one request is tracked."""
+
+    def __init__(self, interval: float = MEMORY_SAMPLE_INTERVAL):
+        self.interval = interval
+        self._watches = set()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._process = None
+
+    def rss(self) -> int:
+        if self._process is None:
+            import psutil
+            self._process = psutil.Process()
+        return self._process.memory_info().rss
+
+    def _sample(self):
+        while True:
+            self._wakeup.wait()
+            rss = self.rss()
+            with self._lock:
+                for watch in self._watches:
+                    watch.peak_rss = max(watch.peak_rss, rss)
+                if not self._watches:
+                    self._wakeup.clear()
+            time.sleep(self.interval)
+
+    def start(self) -> MemoryWatch:
+        watch = MemoryWatch(self.rss())
+        with self._lock:
+            self._watches.add(watch)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._sample, name="memory-monitor", daemon=True)
+                self._thread.start()
+        self._wakeup.set()
+        return watch
+
+    def stop(self, watch: MemoryWatch) -> MemoryWatch:
+        rss = self.rss()
+        with self._lock:
+            self._watches.discard(watch)
+            watch.peak_rss = max(watch.peak_rss, rss)
+            watch.end_rss = rss
+        return watch
+
+
+memory_monitor = MemoryMonitor()
@@ -0,0 +1,185 @@
+import csv
+import glob
+import os
+import re
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Sequence
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from utils.metrics_sink import METRICS_SCHEMA, SEGMENT_SUFFIX, coerce_record
+
+try:
+    import duckdb
+except ImportError:  # optional engine
+    duckdb = None
+
+GROUP_COLUMNS = ("Step", "Tool")
+QUANTILES = (0.5, 0.95, 0.99)
+# Columns read by the summary: the prompt and response texts are never loaded
+SUMMARY_COLUMNS = ["Datetime_request", "Step", "Tool", "Success", "Latency", "Tokens"]
+# Field positions of the legacy CSV rows written with the Anomaly_detected column
+LEGACY_CSV_COLUMNS = ["Datetime_request", "Input_prompt", "Total_time_request", "Step", "Anomaly_detected",
+                      "Tool", "Success", "Latency", "Confidence", "Tokens", "Calls_API", "Response"]
+
+
+def parse_time(value: Optional[str], now: Optional[datetime] = None) -> Optional[datetime]:
+    """Relative ("15m", "24h", "7d": that long before now) or ISO 8601 time."""
+    if not value:
+        return None
+    match = re.fullmatch(r"(\d+)([smhd])", value.strip())
+    if match:
+        unit = {"s": "seconds", "m": "minutes", "h": "hours", "d": "days"}[match.group(2)]
+        return (now or datetime.now()) - timedelta(**{unit: int(match.group(1))})
+    return datetime.fromisoformat(value)
+
+
+def segment_files(directory: str) -> List[str]:
+    """Closed segments of the metrics sink (the .tmp segment being written is skipped)."""
+    return sorted(glob.glob(os.path.join(directory, f"*{SEGMENT_SUFFIX}")))
+
+
+def _summary_row(keys: Dict, count: int, successes: int, latency_quantiles, latency_mean, tokens_total) -> Dict:
+    row = dict(keys)
+    row.update({
+        "requests": int(count),
+        "success_rate": float(successes) / count if count else 0.0,
+        "latency_avg": float(latency_mean or 0.0),
+    })
+    for q, value in zip(QUANTILES, latency_quantiles or [None] * len(QUANTILES)):
+        row[f"latency_p{int(q * 100)}"] = float(value) if value is not None else None
+    row.update({
+        "tokens_total": int(tokens_total or 0),
+        "tokens_avg": float(tokens_total or 0) / count if count else 0.0,
+    })
+    return row
+
+
+def _summary_arrow(files: List[str], since, until, group_by: Sequence[str]) -> List[Dict]:
+    # pyarrow.dataset loads pandas: imported by the first summary, not with the API
+    import pyarrow.compute as pc
+    import pyarrow.dataset as ds
+
+    dataset = ds.dataset(files, schema=METRICS_SCHEMA, format="parquet")
+    # Pushed down to the row group statistics of the segments
+    condition = None
+    if since is not None:
+        condition = ds.field("Datetime_request") >= pa.scalar(since, pa.timestamp("us"))
+    if until is not None:
+        before = ds.field("Datetime_request") < pa.scalar(until, pa.timestamp("us"))
+        condition = before if condition is None else condition & before
+    table = dataset.to_table(columns=SUMMARY_COLUMNS, filter=condition)
+    if table.num_rows == 0:
+        return []
+
+    table = table.set_column(
+        table.schema.get_field_index("Success"), "Success", pc.cast(pc.fill_null(table["Success"], False), pa.int64())
+    )
+    for column in group_by:
+        table = table.set_column(table.schema.get_field_index(column), column, pc.fill_null(table[column], ""))
+    aggregated = table.group_by(list(group_by)).aggregate([
+        ("Latency", "count"),
+        ("Success", "sum"),
+        ("Latency", "tdigest", pc.TDigestOptions(q=list(QUANTILES))),
+        ("Latency", "mean"),
+        ("Tokens", "sum"),
+    ])
+    rows = []
+    for item in aggregated.to_pylist():
+        rows.append(_summary_row(
+            {column: item[column] for column in group_by},
+            item["Latency_count"], item["Success_sum"], item["Latency_tdigest"], item["Latency_mean"], item["Tokens_sum"],
+        ))
+    return rows
+
+
+def _summary_duckdb(files: List[str], since, until, group_by: Sequence[str]) -> List[Dict]:
+    keys = ", ".join(f'coalesce("{column}", \'\') AS "{column}"' for column in group_by)
+    quantiles = ", ".join(str(q) for q in QUANTILES)
+    where = []
+    params = [files]
+    if since is not None:
+        where.append("Datetime_request >= ?")
+        params.append(since)
+    if until is not None:
+        where.append("Datetime_request < ?")
+        params.append(until)
+    sql = (
+        f"SELECT {keys}, count(Latency), sum(CASE WHEN Success THEN 1 ELSE 0 END), "
+        f"quantile_cont(Latency, [{quantiles}]), avg(Latency), sum(Tokens) "
+        f"FROM read_parquet(?) {'WHERE ' + ' AND '.join(where) if where else ''} "
+        f"GROUP BY ALL"
+    )
+    with duckdb.connect() as conn:
+        result = conn.execute(sql, params).fetchall()
+    rows = []
+    for item in result:
+        keys_values = dict(zip(group_by, item[:len(group_by)]))
+        count, successes, latency_quantiles, latency_mean, tokens_total = item[len(group_by):]
+        rows.append(_summary_row(keys_values, count, successes, latency_quantiles, latency_mean, tokens_total))
+    return rows
+
+
+def summarize_metrics(directory: str, since: Optional[datetime] = None, until: Optional[datetime] = None,
+                      group_by: Sequence[str] = GROUP_COLUMNS, engine: str = "arrow") -> List[Dict]:
+    """Requests, success rate, latency p50/p95/p99 and tokens by group_by over [since, until), most requests first.
+
+    engine="arrow" scans the segments with a pyarrow dataset, engine="duckdb" (optional dependency)
+    runs the same aggregation in DuckDB."""
+    unknown = [column for column in group_by if column not in GROUP_COLUMNS]
+    if unknown:
+        raise ValueError(f"Unknown group by columns {unknown}, expected some of {list(GROUP_COLUMNS)}")
+    files = segment_files(directory)
+    if not files:
+        return []
+    if engine == "duckdb":
+        if duckdb is None:
+            raise ValueError("The duckdb engine requires the duckdb package")
+        rows = _summary_duckdb(files, since, until, group_by)
+    elif engine == "arrow":
+        rows = _summary_arrow(files, since, until, group_by)
+    else:
+        raise ValueError(f"Unknown engine {engine}")
+    return sorted(rows, key=lambda row: (-row["requests"], [row[column] for column in group_by]))
+
+
+def _segment_keys(files: List[str]) -> set:
+    """(Datetime_request, Step) of every row of the segments (only those two columns are read)."""
+    keys = set()
+    for path in files:
+        table = pq.read_table(path, columns=["Datetime_request", "Step"])
+        keys.update(zip(table.column("Datetime_request").to_pylist(), table.column("Step").to_pylist()))
+    return keys
+
+
+def import_csv_report(csv_path: str, directory: str) -> Optional[str]:
+    """Convert the CSV report into one segment of directory (rows with and without the Anomaly_detected column).
+
+    The sink exports every row it writes to the CSV report too (METRICS_CSV_EXPORT), so the rows whose
+    (Datetime_request, Step) is already in a segment of directory are skipped: only the history written
+    before the sink is imported, and running the import again replaces its segment without counting
+    a row twice."""
+    path = os.path.join(directory, f"metrics-imported-{os.path.splitext(os.path.basename(csv_path))[0]}{SEGMENT_SUFFIX}")
+    existing = _segment_keys([file for file in segment_files(directory) if os.path.abspath(file) != os.path.abspath(path)])
+
+    rows = []
+    with open(csv_path, newline="", encoding="utf-8") as f:
+        reader = csv.reader(f)
+        header = next(reader, None)
+        for fields in reader:
+            columns = LEGACY_CSV_COLUMNS if len(fields) == len(LEGACY_CSV_COLUMNS) else header
+            record = dict(zip(columns, fields))
+            record["Datetime_request"] = datetime.fromisoformat(record["Datetime_request"][:26]) if record.get("Datetime_request") else None
+            if (record["Datetime_request"], record.get("Step")) in existing:
+                continue
+            record["Success"] = record.get("Success") == "True"
+            for column in ("Total_time_request", "Latency", "Confidence", "Tokens", "Calls_API"):
+                record[column] = float(record[column]) if record.get(column) else None
+            rows.append(coerce_record(record))
+    if not rows:
+        return None
+
+    os.makedirs(directory, exist_ok=True)
+    pq.write_table(pa.Table.from_pylist(rows, schema=METRICS_SCHEMA), path, compression="zstd")
+    return path
@@ -0,0 +1,180 @@
+import atexit
+import csv
+import logging
+import os
+import queue
+import threading
+import time
+from datetime import datetime
+from typing import Dict, List, Optional
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+logger = logging.getLogger(__name__)
+
+# Columns of the metrics report, in the order of the CSV export
+METRICS_SCHEMA = pa.schema([
+    ("Datetime_request", pa.timestamp("us")),
+    ("Input_prompt", pa.string()),
+    ("Total_time_request", pa.float64()),
+    ("Step", pa.string()),
+    ("Tool", pa.string()),
+    ("Success", pa.bool_()),
+    ("Latency", pa.float64()),
+    ("Confidence", pa.float64()),
+    ("Tokens", pa.int64()),
+    ("Calls_API", pa.int64()),
+    ("Response", pa.string()),
+])
+METRICS_COLUMNS = METRICS_SCHEMA.names
+SEGMENT_SUFFIX = ".parquet"
+
+
+def coerce_record(record: Dict) -> Dict:
+    """Values of a record with the types of METRICS_SCHEMA (Datetime_request may be an epoch in seconds)."""
+    row = {}
+    for field in METRICS_SCHEMA:
+        value = record.get(field.name)
+        if value is None:
+            row[field.name] = None
+        elif pa.types.is_timestamp(field.type):
+            row[field.name] = datetime.fromtimestamp(value) if isinstance(value, (int, float)) else value
+        elif pa.types.is_string(field.type):
+            row[field.name] = str(value)
+        elif pa.types.is_boolean(field.type):
+            row[field.name] = bool(value)
+        elif pa.types.is_integer(field.type):
+            row[field.name] = int(value)
+        else:
+            row[field.name] = float(value)
+    return row
+
+
+class MetricsSink:
+    """Append-only writer of the metrics records, off the request path.
+
+    record() only puts the rows in a bounded queue (dropped and counted if it is full); a background
+    thread writes them in batches to Parquet segments of directory with METRICS_SCHEMA. A segment is
+    written as <name>.parquet.tmp and renamed to <name>.parquet when it is closed, after
+    segment_max_bytes or segment_max_seconds, so readers only ever see complete files. Segment names
+    carry the process id, every uvicorn worker writes its own. With csv_path the rows are also appended
+    to the CSV report."""
+
+    def __init__(self, directory: str, csv_path: Optional[str] = None, flush_interval: float = 1.0,
+                 max_batch: int = 1000, max_queue: int = 100_000,
+                 segment_max_bytes: int = 64 * 1024 * 1024, segment_max_seconds: float = 300.0):
+        self.directory = directory
+        self.csv_path = csv_path
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self.segment_max_bytes = segment_max_bytes
+        self.segment_max_seconds = segment_max_seconds
+        self.written = 0
+        self.dropped = 0
+        self.segments = 0
+        self._queue: "queue.Queue[Dict]" = queue.Queue(maxsize=max_queue)
+        self._writer: Optional[pq.ParquetWriter] = None
+        self._segment_path: Optional[str] = None
+        self._segment_opened = 0.0
+        self._write_lock = threading.Lock()
+        self._stop = threading.Event()
+
+        os.makedirs(self.directory, exist_ok=True)
+        self._thread = threading.Thread(target=self._run, name="metrics-sink", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def record(self, rows: List[Dict]):
+        """Queue the rows of a request; never blocks."""
+        for row in rows:
+            try:
+                self._queue.put_nowait(row)
+            except queue.Full:
+                self.dropped += 1
+
+    def _drain(self) -> List[Dict]:
+        rows = []
+        while len(rows) < self.max_batch:
+            try:
+                rows.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return rows
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                rows = [self._queue.get(timeout=self.flush_interval)]
+            except queue.Empty:
+                rows = []
+            # Give the batch a chance to fill before writing it
+            if rows and len(rows) < self.max_batch:
+                time.sleep(min(0.05, self.flush_interval))
+            rows += self._drain()
+            try:
+                self._write(rows)
+            except Exception as e:
+                logger.error(f"Metrics sink failed to write {len(rows)} rows: {e}")
+
+    def _open_segment(self):
+        stamp = datetime.now().strftime("%Y%m%d-%H%M%S-%f")
+        self._segment_path = os.path.join(self.directory, f"metrics-{stamp}-{os.getpid()}{SEGMENT_SUFFIX}")
+        self._writer = pq.ParquetWriter(self._segment_path + ".tmp", METRICS_SCHEMA, compression="zstd")
+        self._segment_opened = time.monotonic()
+
+    def _close_segment(self):
+        if self._writer is None:
+            return
+        self._writer.close()
+        os.replace(self._segment_path + ".tmp", self._segment_path)
+        self._writer = None
+        self.segments += 1
+
+    def _write(self, rows: List[Dict]):
+        with self._write_lock:
+            if rows:
+                rows = [coerce_record(row) for row in rows]
+                if self._writer is None:
+                    self._open_segment()
+                self._writer.write_table(pa.Table.from_pylist(rows, schema=METRICS_SCHEMA))
+                if self.csv_path:
+                    self._append_csv(rows)
+                self.written += len(rows)
+
+            if self._writer is not None and (
+                os.path.getsize(self._segment_path + ".tmp") >= self.segment_max_bytes
+                or time.monotonic() - self._segment_opened >= self.segment_max_seconds
+            ):
+                self._close_segment()
+
+    def _append_csv(self, rows: List[Dict]):
+        new_file = not os.path.exists(self.csv_path)
+        with open(self.csv_path, "a", newline="", encoding="utf-8") as f:
+            writer = csv.DictWriter(f, fieldnames=METRICS_COLUMNS)
+            if new_file:
+                writer.writeheader()
+            writer.writerows(rows)
+
+    def flush(self):
+        """Write the queued rows now."""
+        rows = self._drain()
+        while rows:
+            self._write(rows)
+            rows = self._drain()
+
+    def close(self):
+        """Write the queued rows and close the current segment."""
+        self._stop.set()
+        self._thread.join(timeout=5)
+        self.flush()
+        with self._write_lock:
+            self._close_segment()
+
+    def stats(self) -> Dict:
+        return {
+            "queued": self._queue.qsize(),
+            "written": self.written,
+            "dropped": self.dropped,
+            "segments": self.segments,
+        }
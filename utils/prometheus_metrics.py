@@ -0,0 +1,93 @@
+import functools
+import os
+import time
+from contextlib import contextmanager
+from typing import Callable, Iterator, Optional
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+
+# LLM calls take seconds, retrieval and cache lookups milliseconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+
+STAGE_LATENCY = Histogram(
+    "agent_stage_latency_seconds", "Latency of a stage of the agent and creative flows",
+    ["flow", "stage"], buckets=LATENCY_BUCKETS,
+)
+STAGE_TOKENS = Counter("agent_stage_tokens", "LLM tokens used by a stage", ["flow", "stage"])
+STAGE_IN_FLIGHT = Gauge(
+    "agent_stage_in_flight", "Stages running now", ["flow", "stage"], multiprocess_mode="livesum",
+)
+STAGE_ERRORS = Counter("agent_stage_errors", "Stages that raised, by exception type", ["flow", "stage", "error"])
+LLM_QUEUE_DELAY = Histogram(
+    "agent_llm_queue_delay_seconds", "Time an LLM call waited for the RPM/TPM budget of its model",
+    ["model"], buckets=(0, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60),
+)
+LLM_RETRIES = Counter("agent_llm_retries", "LLM calls retried, by reason (rate_limit, server_error, timeout, connection)", ["model", "reason"])
+REQUEST_PEAK_MEMORY = Histogram(
+    "agent_upload_request_peak_memory_bytes", "Peak RSS growth of the worker during an upload request",
+    ["endpoint"], buckets=tuple(2**20 * size for size in (1, 5, 10, 25, 50, 100, 250, 500, 1000)),
+)
+
+
+class StageObservation:
+    """Handle of a running stage: the tokens added are counted when it ends."""
+
+    def __init__(self):
+        self.tokens = 0
+
+    def add_tokens(self, tokens: Optional[int]):
+        self.tokens += tokens or 0
+
+
+@contextmanager
+def observe_stage(flow: str, stage: str) -> Iterator[StageObservation]:
+    """Record the latency, tokens, in-flight count and errors of the code run in the block."""
+    observation = StageObservation()
+    in_flight = STAGE_IN_FLIGHT.labels(flow, stage)
+    in_flight.inc()
+    start_time = time.perf_counter()
+    try:
+        yield observation
+    except BaseException as e:
+        STAGE_ERRORS.labels(flow, stage, type(e).__name__).inc()
+        raise
+    finally:
+        in_flight.dec()
+        STAGE_LATENCY.labels(flow, stage).observe(time.perf_counter() - start_time)
+        if observation.tokens:
+            STAGE_TOKENS.labels(flow, stage).inc(observation.tokens)
+
+
+def instrument_stage(flow: str, stage: str, tokens: Optional[Callable] = None):
+    """Decorator of an async function observed as a stage; tokens(result) gives the tokens of its result."""
+    def decorator(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            with observe_stage(flow, stage) as observation:
+                result = await fn(*args, **kwargs)
+                if tokens is not None and result is not None:
+                    observation.add_tokens(tokens(result))
+                return result
+        return wrapper
+    return decorator
+
+
+def render_metrics() -> bytes:
+    """Prometheus text format of the metrics of this process, or of every worker in multiprocess mode
+    (PROMETHEUS_MULTIPROC_DIR set before the workers start)."""
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry)
+    return generate_latest()
+
+
+METRICS_CONTENT_TYPE = CONTENT_TYPE_LATEST
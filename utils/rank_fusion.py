@@ -0,0 +1,12 @@
+from typing import Hashable, List, Sequence, Tuple
+
+
+def reciprocal_rank_fusion(rankings: Sequence[Sequence[Hashable]], k: int = 60) -> List[Tuple[Hashable, float]]:
+    """Fuse several rankings (best first) with reciprocal rank fusion: score(d) = sum over rankings of 1 / (k + rank).
+
+    Returns (item, score) sorted by score, best first. Ties keep the order of first appearance."""
+    scores = {}
+    for ranking in rankings:
+        for rank, item in enumerate(ranking, start=1):
+            scores[item] = scores.get(item, 0.0) + 1.0 / (k + rank)
+    return sorted(scores.items(), key=lambda item: item[1], reverse=True)
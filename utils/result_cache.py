@@ -0,0 +1,112 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional
+
+
+class ResultCache:
+    """LRU + TTL cache of string results with an optional SQLite tier that survives restarts."""
+
+    def __init__(self, max_entries: int = 256, ttl_seconds: float = 24 * 3600, disk_path: Optional[str] = None):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.disk_path = disk_path
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        if self.disk_path:
+            os.makedirs(os.path.dirname(self.disk_path) or ".", exist_ok=True)
+            with self._connection() as conn:
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS result_cache (key TEXT PRIMARY KEY, value TEXT NOT NULL, created REAL NOT NULL)"
+                )
+
+    def _connection(self) -> sqlite3.Connection:
+        """One connection per thread, kept open (sqlite3 connections are not shared across threads).
+        Used as a context manager it only commits or rolls back the transaction, it is not closed."""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.disk_path, timeout=10)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def make_key(**parts) -> str:
+        """Content-addressed key: sha256 of the canonical JSON of the key parts."""
+        canonical = json.dumps(parts, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+        return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+    def _expired(self, created: float) -> bool:
+        return time.time() - created > self.ttl_seconds
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, created = entry
+                if not self._expired(created):
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+
+        if self.disk_path:
+            with self._connection() as conn:
+                row = conn.execute("SELECT value, created FROM result_cache WHERE key = ?", (key,)).fetchone()
+            if row is not None and not self._expired(row[1]):
+                with self._lock:
+                    self._store(key, row[0], row[1])
+                    self.hits += 1
+                    self.disk_hits += 1
+                return row[0]
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def _store(self, key: str, value: str, created: float):
+        self._entries[key] = (value, created)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def set(self, key: str, value: str):
+        created = time.time()
+        with self._lock:
+            self._store(key, value, created)
+
+        if self.disk_path:
+            with self._connection() as conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO result_cache (key, value, created) VALUES (?, ?, ?)",
+                    (key, value, created),
+                )
+                conn.execute("DELETE FROM result_cache WHERE created < ?", (created - self.ttl_seconds,))
+
+    def stats(self) -> Dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+
+def normalize_personas_json(personas_json: str) -> str:
+    """Canonical form of personas_json so key order and whitespace do not change the cache key."""
+    try:
+        return json.dumps(json.loads(personas_json), sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    except ValueError:
+        return personas_json.strip()
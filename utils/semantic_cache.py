@@ -0,0 +1,187 @@
+import os
+import re
+import sqlite3
+import threading
+import time
+from typing import Dict, FrozenSet, Optional, Tuple
+
+import numpy as np
+
+# Words that flip the meaning of a question while barely moving its embedding ("high WBC" / "low WBC"),
+# mapped to a canonical term. Questions must agree on them (and on their numbers) to share an answer.
+POLARITY_TERMS = {
+    "high": "high", "higher": "high", "elevated": "high", "raised": "high", "increased": "high", "increase": "high",
+    "above": "high", "over": "high", "excess": "high", "rising": "high", "rise": "high",
+    "low": "low", "lower": "low", "decreased": "low", "decrease": "low", "reduced": "low", "below": "low",
+    "under": "low", "deficient": "low", "deficiency": "low", "falling": "low", "drop": "low", "dropped": "low",
+    "normal": "normal", "abnormal": "abnormal", "positive": "positive", "negative": "negative",
+    "not": "not", "no": "not", "never": "not", "without": "not", "cannot": "not",
+}
+_WORD = re.compile(r"[a-z]+(?:'t)?")
+_NUMBER = re.compile(r"\d+(?:[.,]\d+)?")
+
+
+def question_signature(query: str) -> Tuple[FrozenSet[str], FrozenSet[str]]:
+    """(numbers, polarity terms) of a question: hyper-/hypo- prefixes and n't count as polarity terms."""
+    text = query.lower()
+    numbers = frozenset(number.replace(",", ".") for number in _NUMBER.findall(text))
+    terms = set()
+    for word in _WORD.findall(text):
+        if word.endswith("n't"):
+            terms.add("not")
+        elif word in POLARITY_TERMS:
+            terms.add(POLARITY_TERMS[word])
+        elif word.startswith("hyper"):
+            terms.add("high")
+        elif word.startswith("hypo"):
+            terms.add("low")
+    return numbers, frozenset(terms)
+
+
+class SemanticCache:
+    """Answers of the RAG flow keyed by the embedding of the question.
+
+    A lookup returns the stored answer of the most similar question when the cosine similarity
+    reaches threshold, the two questions have the same numbers and polarity/negation terms
+    (question_signature), the answer was built on the same LanceDB table version and it is not older
+    than ttl_seconds. Entries are persisted in a SQLite file in WAL mode so every uvicorn worker
+    shares them; each process keeps the normalized vectors in memory and loads only the rows added
+    since its last lookup. The file keeps the max_entries most recent answers."""
+
+    def __init__(self, path: str, threshold: float = 0.95, max_entries: int = 5000, ttl_seconds: float = 7 * 24 * 3600):
+        self.path = path
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self.rejected = 0
+        self._ids = []
+        self._versions = []
+        self._created = []
+        self._signatures = []
+        self._vectors = []
+        self._matrix = None
+        self._last_id = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        conn = self._connection()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS answers ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, model TEXT NOT NULL, table_version INTEGER NOT NULL, "
+            "query TEXT NOT NULL, vector BLOB NOT NULL, investigation TEXT NOT NULL, answer TEXT NOT NULL, created REAL NOT NULL, "
+            "summary TEXT)"
+        )
+        # Files created before the history summary was kept
+        if "summary" not in {row[1] for row in conn.execute("PRAGMA table_info(answers)")}:
+            conn.execute("ALTER TABLE answers ADD COLUMN summary TEXT")
+        conn.commit()
+
+    def _connection(self) -> sqlite3.Connection:
+        """One connection per thread (sqlite3 connections are not shared across threads)."""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def _normalize(vector) -> np.ndarray:
+        array = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(array)
+        return array / norm if norm else array
+
+    def _sync(self, model: str):
+        """Load the entries written (by this or another worker) since the last sync."""
+        rows = self._connection().execute(
+            "SELECT id, table_version, vector, created, query FROM answers WHERE id > ? AND model = ? ORDER BY id",
+            (self._last_id, model),
+        ).fetchall()
+        if not rows:
+            return
+        for entry_id, table_version, vector, created, query in rows:
+            self._ids.append(entry_id)
+            self._versions.append(table_version)
+            self._created.append(created)
+            self._signatures.append(question_signature(query))
+            self._vectors.append(self._normalize(np.frombuffer(vector, dtype=np.float32)))
+        self._last_id = rows[-1][0]
+        # Same bound as the file, oldest entries first
+        overflow = len(self._ids) - self.max_entries
+        if overflow > 0:
+            del self._ids[:overflow], self._versions[:overflow], self._created[:overflow]
+            del self._signatures[:overflow], self._vectors[:overflow]
+        self._matrix = np.stack(self._vectors)
+
+    def lookup(self, model: str, vector, table_version: int, query: Optional[str] = None) -> Tuple[Optional[Dict], float]:
+        """(entry, similarity) of the closest valid question; entry is None when the similarity is under threshold.
+        With query, only the questions with the same question_signature are valid."""
+        query_vector = self._normalize(vector)
+        with self._lock:
+            self._sync(model)
+            best_id, similarity = None, 0.0
+            if self._matrix is not None and self._matrix.shape[1] == query_vector.shape[0]:
+                similarities = self._matrix @ query_vector
+                oldest = time.time() - self.ttl_seconds
+                valid = (np.asarray(self._versions) == table_version) & (np.asarray(self._created) >= oldest)
+                if query is not None:
+                    signature = question_signature(query)
+                    same_signature = np.fromiter((entry == signature for entry in self._signatures), dtype=bool, count=len(self._signatures))
+                    if (valid & ~same_signature & (similarities >= self.threshold)).any() and \
+                            not (valid & same_signature & (similarities >= self.threshold)).any():
+                        # Near-duplicate question with other numbers or the opposite polarity
+                        self.rejected += 1
+                    valid &= same_signature
+                if valid.any():
+                    similarities = np.where(valid, similarities, -1.0)
+                    best = int(np.argmax(similarities))
+                    best_id, similarity = self._ids[best], float(similarities[best])
+
+            hit = best_id is not None and similarity >= self.threshold
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+        if not hit:
+            return None, similarity
+
+        row = self._connection().execute(
+            "SELECT query, investigation, answer, summary FROM answers WHERE id = ?", (best_id,)
+        ).fetchone()
+        if row is None:
+            # Evicted by another worker in the meantime
+            return None, similarity
+        return {"query": row[0], "investigation": row[1], "answer": row[2], "summary": row[3]}, similarity
+
+    def store(self, model: str, query: str, vector, table_version: int, investigation: str, answer: str,
+              summary: Optional[str] = None):
+        """Add the answer of a question; investigation is the InvestigationResponse as JSON and summary the
+        history summary the answer left in the session memory."""
+        array = np.asarray(vector, dtype=np.float32)
+        conn = self._connection()
+        conn.execute(
+            "INSERT INTO answers (model, table_version, query, vector, investigation, answer, created, summary) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (model, table_version, query, array.tobytes(), investigation, answer, time.time(), summary),
+        )
+        # Keep the max_entries most recent answers and drop the ones of older table versions
+        conn.execute(
+            "DELETE FROM answers WHERE table_version < ? OR id IN (SELECT id FROM answers ORDER BY id DESC LIMIT -1 OFFSET ?)",
+            (table_version, self.max_entries),
+        )
+        conn.commit()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._ids),
+                "threshold": self.threshold,
+                "hits": self.hits,
+                "misses": self.misses,
+                "rejected": self.rejected,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
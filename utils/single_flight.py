@@ -0,0 +1,99 @@
+import asyncio
+import functools
+import hashlib
+import json
+import logging
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from utils.sse import Emit
+
+logger = logging.getLogger(__name__)
+
+
+def canonical_key(*parts: Any) -> str:
+    """sha256 of the parts as canonical JSON (sorted keys, bytes by their own sha256)."""
+    def default(value):
+        if isinstance(value, (bytes, bytearray)):
+            return "sha256:" + hashlib.sha256(value).hexdigest()
+        return repr(value)
+
+    payload = json.dumps(parts, sort_keys=True, separators=(",", ":"), ensure_ascii=False, default=default)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class _Flight:
+    def __init__(self):
+        self.task: Optional[asyncio.Task] = None
+        self.waiters = 0
+        self.events: List[Tuple[str, Dict]] = []
+        self.subscribers: List[Emit] = []
+
+    def emit(self, event: str, data: Dict):
+        self.events.append((event, data))
+        for subscriber in list(self.subscribers):
+            subscriber(event, data)
+
+
+class SingleFlight:
+    """Concurrent calls with the same key share one in-flight computation and its result (or exception).
+
+    The computation runs as its own task: a caller that goes away (client disconnect) does not cancel it
+    for the others, it is cancelled only when no caller is left. Streaming callers get the progress events
+    of the computation, the ones emitted before they joined are replayed first. Nothing is kept once the
+    computation finishes: this is not a cache."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.started = 0
+        self.joined = 0
+        self._flights: Dict[str, _Flight] = {}
+
+    async def run(self, key: str, fn: Callable[[Optional[Emit]], Awaitable], on_event: Optional[Emit] = None) -> Any:
+        """Result of fn(emit) for key, started now or shared with the computation already running.
+        Callers with and without on_event should use different keys (the computation streams or not)."""
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = _Flight()
+            self._flights[key] = flight
+            flight.task = asyncio.create_task(fn(flight.emit if on_event is not None else None))
+            flight.task.add_done_callback(lambda _: self._finished(key, flight))
+            self.started += 1
+        else:
+            self.joined += 1
+            logger.info(f"Single-flight [{self.name}] request joined the in-flight computation {key[:12]}")
+            if on_event is not None:
+                for event, data in flight.events:
+                    on_event(event, data)
+
+        if on_event is not None:
+            flight.subscribers.append(on_event)
+        flight.waiters += 1
+        try:
+            return await asyncio.shield(flight.task)
+        except asyncio.CancelledError:
+            if not flight.task.done() and flight.waiters == 1:
+                flight.task.cancel()
+            raise
+        finally:
+            flight.waiters -= 1
+            if on_event is not None:
+                flight.subscribers.remove(on_event)
+
+    def _finished(self, key: str, flight: _Flight):
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+
+    def stats(self) -> Dict:
+        return {"in_flight": len(self._flights), "started": self.started, "joined": self.joined}
+
+
+def coalesce(flights: SingleFlight):
+    """Decorator of an async method without progress events: concurrent calls with the same arguments
+    (self excluded) share one execution."""
+    def decorator(fn):
+        @functools.wraps(fn)
+        async def wrapper(self, *args, **kwargs):
+            key = canonical_key(fn.__qualname__, args, kwargs)
+            return await flights.run(key, lambda _: fn(self, *args, **kwargs))
+        return wrapper
+    return decorator
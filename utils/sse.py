@@ -0,0 +1,43 @@
+import asyncio
+import json
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict
+
+Emit = Callable[[str, Dict], None]
+
+
+def format_sse(event: str, data: Dict) -> str:
+    """Format one server-sent event."""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def answer_payload(answer: Any) -> Dict:
+    return {"answer": answer}
+
+
+async def stream_events(run: Callable[[Emit], Awaitable[Any]],
+                        done_payload: Callable[[Any], Dict] = answer_payload) -> AsyncIterator[str]:
+    """Run a pipeline that reports progress through an emit(event, data) callback and yield its events as SSE.
+
+    The pipeline result is sent as a final "done" event with done_payload(result) (or "error" if it raised).
+    If the client disconnects the pipeline task is cancelled."""
+    queue: asyncio.Queue = asyncio.Queue()
+
+    def emit(event: str, data: Dict):
+        queue.put_nowait((event, data))
+
+    task = asyncio.create_task(run(emit))
+    task.add_done_callback(lambda _: queue.put_nowait(None))
+    try:
+        while True:
+            item = await queue.get()
+            if item is None:
+                break
+            yield format_sse(*item)
+
+        try:
+            yield format_sse("done", done_payload(task.result()))
+        except Exception as e:
+            yield format_sse("error", {"message": str(e)})
+    finally:
+        if not task.done():
+            task.cancel()
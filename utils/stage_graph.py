@@ -0,0 +1,54 @@
+import asyncio
+import logging
+import time
+from typing import Any, Awaitable, Callable, Dict
+
+logger = logging.getLogger(__name__)
+
+
+class StageGraph:
+    """Async stages of one request, each started as soon as the stages it depends on are done.
+
+    add(name, fn, *deps) schedules fn(*results of deps) right away, so independent stages run
+    concurrently. A stage started speculatively is dropped with discard() when its result is not
+    needed; close() cancels whatever is still running. The latency of every finished stage is kept
+    in timings."""
+
+    def __init__(self):
+        self.tasks: Dict[str, asyncio.Task] = {}
+        self.timings: Dict[str, float] = {}
+
+    def add(self, name: str, fn: Callable[..., Awaitable[Any]], *deps: str) -> asyncio.Task:
+        async def run():
+            results = [await self.tasks[dep] for dep in deps]
+            start_time = time.perf_counter()
+            try:
+                return await fn(*results)
+            finally:
+                self.timings[name] = time.perf_counter() - start_time
+
+        self.tasks[name] = asyncio.create_task(run(), name=name)
+        return self.tasks[name]
+
+    async def result(self, name: str) -> Any:
+        return await self.tasks[name]
+
+    def discard(self, name: str):
+        """Drop a stage whose result is not needed: cancelled if running, its error ignored if it failed."""
+        task = self.tasks.pop(name, None)
+        if task is None:
+            return
+        if not task.done():
+            task.cancel()
+        elif not task.cancelled() and task.exception() is not None:
+            logger.info(f"Discarded stage {name} had failed: {task.exception()}")
+        logger.info(f"Discarded stage {name}")
+
+    def close(self):
+        """Cancel the stages still running and retrieve the error of the finished ones, so a failed stage
+        nobody awaited (routing raised before reading it) is not reported as "never retrieved"."""
+        for name, task in list(self.tasks.items()):
+            if not task.done():
+                self.discard(name)
+            elif not task.cancelled() and task.exception() is not None:
+                logger.info(f"Stage {name} had failed: {task.exception()}")
@@ -0,0 +1,94 @@
+import logging
+from functools import lru_cache
+from typing import Dict, List, Optional, Sequence, Tuple, Union
+
+from tiktoken import Encoding, encoding_for_model, get_encoding
+
+logger = logging.getLogger(__name__)
+
+Piece = Union[str, List[str]]
+
+
+@lru_cache(maxsize=None)
+def get_model_encoding(model: str) -> Encoding:
+    """tiktoken encoding of the model (o200k_base for gpt-4o*, cl100k_base for gpt-4), cl100k_base if unknown (e.g. Azure deployment names)."""
+    try:
+        return encoding_for_model(model)
+    except KeyError:
+        return get_encoding("cl100k_base")
+
+
+class TokenBudget:
+    """Exact token counting and per-call budget allocation for the prompts built by the orchestrator.
+
+    allocate() keeps the required pieces (system prompt, user question) and fits the optional pieces
+    in the remaining budget, trimming the lowest-value ones first: lists (history messages, retrieved
+    chunks) lose their last items, texts (attachment) are truncated."""
+
+    def __init__(self, model: str):
+        self.model = model
+
+    @property
+    def encoding(self) -> Encoding:
+        # Loaded on first use: the encoding file may have to be downloaded
+        return get_model_encoding(self.model)
+
+    def count(self, text: Optional[str]) -> int:
+        if not text:
+            return 0
+        return len(self.encoding.encode(text, disallowed_special=()))
+
+    def truncate(self, text: Optional[str], max_tokens: int) -> str:
+        """First max_tokens tokens of the text."""
+        if not text or max_tokens <= 0:
+            return ""
+        tokens = self.encoding.encode(text, disallowed_special=())
+        if len(tokens) <= max_tokens:
+            return text
+        return self.encoding.decode(tokens[:max_tokens])
+
+    def allocate(self, stage: str, budget: int, required: Sequence[str],
+                 optional: Sequence[Tuple[str, Piece]]) -> Dict[str, Piece]:
+        """Fit the optional pieces in budget - tokens(required).
+
+        optional is ordered lowest value first; each piece is a text or a list of texts ordered most valuable first.
+        Returns the kept content by piece name (same type as given) and logs the decisions of the stage."""
+        required_tokens = sum(self.count(text) for text in required)
+        counts = {}
+        for name, piece in optional:
+            counts[name] = [self.count(part) for part in piece] if isinstance(piece, list) else self.count(piece)
+
+        def piece_tokens(value):
+            return sum(value) if isinstance(value, list) else value
+
+        total = required_tokens + sum(piece_tokens(value) for value in counts.values())
+        overflow = total - budget
+        kept = {name: piece for name, piece in optional}
+        decisions = []
+
+        for name, piece in optional:
+            if overflow <= 0:
+                break
+            if isinstance(piece, list):
+                items = list(piece)
+                item_counts = list(counts[name])
+                while items and overflow > 0:
+                    items.pop()
+                    overflow -= item_counts.pop()
+                kept[name] = items
+                decisions.append(f"{name} {len(piece)}->{len(items)} items")
+            else:
+                tokens = counts[name]
+                keep_tokens = max(0, tokens - overflow)
+                kept[name] = self.truncate(piece, keep_tokens)
+                overflow -= tokens - keep_tokens
+                decisions.append(f"{name} {tokens}->{keep_tokens} tokens")
+
+        used = budget + overflow if decisions else total
+        if decisions:
+            logger.info(f"Token budget [{stage}] {total} tokens over budget {budget}: trimmed {', '.join(decisions)}; now {used} tokens")
+        else:
+            logger.info(f"Token budget [{stage}] {total}/{budget} tokens, nothing trimmed")
+        if overflow > 0:
+            logger.warning(f"Token budget [{stage}] required pieces alone use {required_tokens} tokens, over budget {budget}")
+        return kept
@@ -0,0 +1,106 @@
+import asyncio
+import codecs
+import os
+from typing import BinaryIO, Optional
+
+from fastapi import UploadFile
+
+# Uploads are consumed in chunks of UPLOAD_CHUNK_BYTES. The multipart parser keeps each file in memory up to
+# UPLOAD_SPOOL_BYTES and spools it to a temporary file above (see Agent_API)
+UPLOAD_CHUNK_BYTES = int(os.getenv("UPLOAD_CHUNK_BYTES", str(64 * 1024)))
+UPLOAD_SPOOL_BYTES = int(os.getenv("UPLOAD_SPOOL_BYTES", str(1024 * 1024)))
+AGENT_UPLOAD_MAX_BYTES = int(os.getenv("AGENT_UPLOAD_MAX_BYTES", str(10 * 1024 * 1024)))
+CREATIVE_IMAGE_MAX_BYTES = int(os.getenv("CREATIVE_IMAGE_MAX_BYTES", str(20 * 1024 * 1024)))
+CREATIVE_BATCH_MAX_BYTES = int(os.getenv("CREATIVE_BATCH_MAX_BYTES", str(200 * 1024 * 1024)))
+# Bytes chardet sees at most when the upload is not UTF-8 (it usually settles in the first kilobytes)
+ENCODING_DETECT_MAX_BYTES = int(os.getenv("ENCODING_DETECT_MAX_BYTES", str(1024 * 1024)))
+
+
+class UploadTooLarge(ValueError):
+    """Upload over its size limit (answered with 413)."""
+
+    def __init__(self, name: str, limit: int):
+        super().__init__(f"{name} exceeds the upload limit of {limit} bytes")
+        self.limit = limit
+
+
+def check_upload_size(upload: UploadFile, max_bytes: int):
+    """Reject an upload whose size (known once the multipart body is parsed) is over max_bytes."""
+    if upload.size is not None and upload.size > max_bytes:
+        raise UploadTooLarge(upload.filename or "upload", max_bytes)
+
+
+def detect_encoding(file: BinaryIO, chunk_size: int = UPLOAD_CHUNK_BYTES, max_bytes: int = ENCODING_DETECT_MAX_BYTES) -> str:
+    """Encoding of a non UTF-8 file, fed to chardet chunk by chunk until it is confident."""
+    from chardet.universaldetector import UniversalDetector
+
+    detector = UniversalDetector()
+    file.seek(0)
+    read = 0
+    while not detector.done and read < max_bytes:
+        chunk = file.read(chunk_size)
+        if not chunk:
+            break
+        detector.feed(chunk)
+        read += len(chunk)
+    detector.close()
+    return detector.result.get("encoding") or "utf-8"
+
+
+async def read_text_upload(upload: UploadFile, max_bytes: int = AGENT_UPLOAD_MAX_BYTES,
+                           chunk_size: int = UPLOAD_CHUNK_BYTES) -> str:
+    """Text of an uploaded file decoded chunk by chunk: only the decoded text is kept, never the whole bytes.
+    UTF-8 is tried first; on the first invalid byte the encoding is detected and the file decoded again."""
+    check_upload_size(upload, max_bytes)
+    encoding, errors = "utf-8", "strict"
+    while True:
+        await upload.seek(0)
+        decoder = codecs.getincrementaldecoder(encoding)(errors=errors)
+        parts, size = [], 0
+        try:
+            while True:
+                chunk = await upload.read(chunk_size)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > max_bytes:
+                    raise UploadTooLarge(upload.filename or "upload", max_bytes)
+                parts.append(decoder.decode(chunk))
+            parts.append(decoder.decode(b"", final=True))
+            return "".join(parts)
+        except UnicodeDecodeError:
+            parts.clear()
+            encoding, errors = await asyncio.to_thread(detect_encoding, upload.file, chunk_size), "replace"
+
+
+async def read_binary_upload(upload: UploadFile, max_bytes: int, chunk_size: int = UPLOAD_CHUNK_BYTES) -> bytearray:
+    """Content of an uploaded file read chunk by chunk into one buffer (not copied again into bytes),
+    stopping as soon as it is over max_bytes."""
+    check_upload_size(upload, max_bytes)
+    await upload.seek(0)
+    buffer = bytearray()
+    while True:
+        chunk = await upload.read(chunk_size)
+        if not chunk:
+            break
+        if len(buffer) + len(chunk) > max_bytes:
+            raise UploadTooLarge(upload.filename or "upload", max_bytes)
+        buffer += chunk
+    return buffer
+
+
+def copy_upload(file: BinaryIO, destination: str, max_bytes: Optional[int] = None,
+                chunk_size: int = UPLOAD_CHUNK_BYTES) -> int:
+    """Copy an uploaded (spooled) file to destination chunk by chunk. Returns the bytes written."""
+    file.seek(0)
+    written = 0
+    with open(destination, "wb") as f:
+        while True:
+            chunk = file.read(chunk_size)
+            if not chunk:
+                break
+            written += len(chunk)
+            if max_bytes is not None and written > max_bytes:
+                raise UploadTooLarge(os.path.basename(destination), max_bytes)
+            f.write(chunk)
+    return written